@@ -1,29 +1,77 @@
+import itertools
+
+import numpy as np
+
+from . import utilities
+from .optimize import exe_map, MooseSimulation
+
 def _scan_params_job(settings):
-    return Simulation(single=True, **settings)
+    settings = dict(settings)
+    params = settings.pop('params')
+    values = settings.pop('values')
+    return MooseSimulation(params=params.updated(**values), single=True, **settings)
+
+def _scan_jobs(dir, IVs, params, names, combinations, options):
+    return [dict(options, dir=dir, currents=IVs, params=params,
+                 values={name: np.asarray(value).item()
+                         for name, value in zip(names, comb)})
+            for comb in combinations]
+
+def _fill(res, sims):
+    # simulations can be indexed like sequences, so numpy would unpack
+    # them if the array was assigned at once
+    for i, sim in enumerate(sims):
+        res.flat[i] = sim
 
-def scan_params(dir, IVs, **params):
-    values = [np.atleast_1d(p) for p in params.values()]
-    res = np.empty(tuple(p.size for p in values), dtype=object)
-    jobs = [dict(zip(params, comb)) for comb in itertools.product(*values)]
-    for job in jobs:
-        job['dir'] = dir
-        job['currents'] = IVs
+def convert_to_values(group, measurement, fitness, *what, full=0):
+    """Return the values of parameters what of each simulation in group
+
+    values is an array with a row for each simulation. If fitness is not
+    None, the fitness of each simulation against measurement is returned
+    too, otherwise None.
+    """
+    values = np.array([[getattr(sim.params[name], 'value', sim.params[name])
+                        for name in what]
+                       for sim in group],
+                      dtype=float).reshape(len(group), len(what))
+    if fitness is None:
+        scores = None
+    else:
+        scores = [fitness(sim, measurement, full=full) for sim in group]
+    return values, scores
+
+def scan_params(dir, IVs, params, values, **options):
+    """Simulate all combinations of values of parameters
+
+    params is the ParamSet to start from, and values a dict of the names of
+    its adjustable parameters to one or more values each. The simulations
+    are created with options (e.g. simtime, injection_delay and
+    injection_width) and run in the current executor. An array with one
+    :class:`MooseSimulation` per combination, with one axis per parameter
+    in values, is returned.
+    """
+    names = list(values)
+    values = [np.atleast_1d(values[name]) for name in names]
+    res = np.empty(tuple(v.size for v in values), dtype=object)
+    jobs = _scan_jobs(dir, IVs, params, names, itertools.product(*values), options)
 
     ans = exe_map()(_scan_params_job, jobs)
-    res.flat = ans
+    _fill(res, ans)
     return res
 
-def scan_missing(dir, group):
+def scan_missing(dir, group, params, **options):
+    """Simulate the combinations of parameter values missing from group
+
+    group is a list of simulations made by :func:`scan_params` with params,
+    some of which are missing. Returns an array of the new simulations.
+    """
     IVs = group[0].injection
-    params = group[0].params.keys()
-    values, _ = convert_to_values(group, None, None, *params)
+    names = [p.name for p in params.ajuparams]
+    values, _ = convert_to_values(group, None, None, *names)
     missing = utilities.find_missing(values)
-    res = np.empty((values.shape[0],), dtype=object)
-    jobs = [dict(zip(params, comb)) for comb in missing]
-    for job in jobs:
-        job['dir'] = dir
-        job['currents'] = IVs
+    jobs = _scan_jobs(dir, IVs, params, names, missing, options)
 
     ans = exe_map()(_scan_params_job, jobs)
-    res.flat = ans
+    res = np.empty((len(jobs),), dtype=object)
+    _fill(res, ans)
     return res
@@ -18,6 +18,24 @@ in parallel, where each one should be run out-of-process::
       -i=-5.0000000000000034e-11 \\
       --save-vm=ivdata--5.0000000000000034e-11.npy
 
+Multiple currents can be given after -i. The model is then built
+only once and each current is simulated in turn, and {} in the
+--save-vm filename is replaced by the current.
+
+The --save-vm-dtype, --save-vm-dt and --save-vm-encoding options make
+the saved traces smaller, see :func:`ajustador.storage.save_trace`.
+
+Hopeless simulations can be stopped early with the --abort-* options.
+The simulation then advances in chunks of --abort-check-interval and
+the voltage so far is checked after each chunk. When one of the limits
+is exceeded, the partial trace is saved and the reason is written to
+a file with ".aborted" appended to the --save-vm name.
+
+The same simulation can be run in a fork of an already initialized
+process with :func:`fork_main`. This is what :mod:`ajustador.optimize`
+does in its worker processes, so that moose, moose_nerp and the model
+module are imported only once per worker.
+
 This module is not automatically imported as a child of ajustador.
 An explicit import is needed:
 >>> import ajustador.basic_simulation
@@ -25,6 +43,8 @@ An explicit import is needed:
 import os
 import sys
 import tempfile
+import traceback
+import subprocess
 import re
 import importlib
 import numpy as np
@@ -43,6 +63,7 @@ from moose_nerp.prototypes import print_params
 from ajustador.regulate_chan_kinetics import chan_setting
 from ajustador.regulate_chan_kinetics import scale_voltage_dependents_tau_muliplier
 from ajustador.regulate_chan_kinetics import offset_voltage_dependents_vshift
+from ajustador import storage
 from ajustador.helpers.loggingsystem import getlogger
 
 import logging
@@ -92,7 +113,33 @@ def option_parser():
 
     p.add_argument('--cond', default=[], nargs='+', type=cond_setting, action=standard_options.AppendFlat)
     p.add_argument('--save-vm')
+    p.add_argument('--save-vm-dtype',
+                   help='type to store the voltage as, e.g. float32')
+    p.add_argument('--save-vm-dt', type=real,
+                   help='decimate the saved voltage to this sampling interval')
+    p.add_argument('--save-vm-encoding', choices=[e for e in storage.TRACE_ENCODINGS if e],
+                   help='lossless compression of the saved voltage')
+    p.add_argument('--snapshot', action='store_true',
+                   help='simulate the part before the injection once for all currents; '
+                        'the currents are then run one after another in forked branches, '
+                        'and the hdf5 output is not written')
+    p.add_argument('--copies', action='store_true',
+                   help='simulate all currents at once in copies of the neuron '
+                        '(the --abort-* options cannot be used with it)')
     p.add_argument('--chan', default=[], nargs='+', type=chan_setting, action=standard_options.AppendFlat)
+
+    p.add_argument('--abort-max-spikes', type=int,
+                   help='stop when more spikes were fired')
+    p.add_argument('--abort-block-time', type=real,
+                   help='stop when Vm stays above the spike threshold for this long')
+    p.add_argument('--abort-spike-threshold', type=real, default=-0.020,
+                   help='voltage used to detect spikes and depolarization block')
+    p.add_argument('--abort-baseline', type=real,
+                   help='expected Vm before the injection')
+    p.add_argument('--abort-baseline-tolerance', type=real,
+                   help='stop when Vm before the injection is further from --abort-baseline')
+    p.add_argument('--abort-check-interval', type=real, default=0.05,
+                   help='simulated time between checks')
     return p
 
 @util.listize
@@ -100,7 +147,7 @@ def serialize_options(opts):
     conds = []          # Channel conductances.
     chans = []          # Channel voltage dependent's tau multiplier and vshifts.
     for key,val in opts.items():
-        if key == 'junction_potential':
+        if key == 'junction_potential' or getattr(val, 'postprocessing', False):
             # ignore, handled by the caller
             continue
         if val is not None:
@@ -125,15 +172,30 @@ def serialize_options(opts):
         yield '--chan'
         yield from chans
 
+def find_morph_file(model, ntype, morph_file=None):
+    "Return the path of morph_file, or of the default morphology of ntype"
+    if morph_file:
+        return util.find_model_file(model, morph_file)
+    else:
+        return cell_proto.find_morph_file(model, ntype)
+
+def morph_file_contents(params):
+    """Return the contents of the morphology file used with params
+
+    params is a dict like the one passed to :func:`serialize_options`.
+    """
+    value = lambda key: getattr(params.get(key), 'value', params.get(key))
+    model = importlib.import_module('moose_nerp.' + value('model'))
+    path = find_morph_file(model, value('neuron_type'), value('morph_file'))
+    with open(path, 'rb') as f:
+        return f.read()
+
 def morph_morph_file(model, ntype, morph_file, new_file=None,
                      RA=None, RM=None, CM=None, Erest=None, Eleak=None):
     ''' Fuction to create a new_morph_file by updated values for RA, RM, CM,
         EREST_ACT and ELEAK input arguments.
     '''
-    if morph_file:
-        morph_file = util.find_model_file(model, morph_file)
-    else:
-        morph_file = cell_proto.find_morph_file(model, ntype)
+    morph_file = find_morph_file(model, ntype, morph_file)
 
     t = open(morph_file).read()
 
@@ -173,7 +235,7 @@ def setup_conductance(condset, name, index, value):
             attr[k] = value
     else:
         attr[keys[index]] = value
-def setup(param_sim, model):
+def setup(param_sim, model, save=True):
     #these next two overrides are not used in optimization as they are not passed in from optimize
     #they could be used if running basic_simulation directly
     if param_sim.calcium is not None:
@@ -216,7 +278,8 @@ def setup(param_sim, model):
 
     plotcomps=[model.param_cond.NAME_SOMA]
     fname=param_sim.neuron_type+'.h5'
-    param_sim.save=1
+    # The hdf5 output cannot be shared between forked branches
+    param_sim.save = 1 if save else 0
     #create neuron model and set up output
     syn,neurons,writer,tables=create_model_sim.create_model_sim(model,fname,param_sim,plotcomps)
     
@@ -240,12 +303,10 @@ def reset_baseline(neuron, baseline, Cond_Kir):
                 print("%s Em %f -> %f" % (w.path, w.Em, Em))
             w.Em = Em
 
-def run_simulation(injection_current, simtime, param_sim, model):
-    global pulse_gen
-    if logger.level==logging.DEBUG:
-        print("################## moose versions: ", moose.__version__)
-    print(u'◢◤◢◤◢◤◢◤ injection_current = {} ◢◤◢◤◢◤◢◤'.format(injection_current))
-    pulse_gen.firstLevel = injection_current
+def reinit_simulation(param_sim, model, neurons=None):
+    "Reinitialize moose and reset the baseline of each of the neurons"
+    if neurons is None:
+        neurons = [param_sim.neuron_type]
     moose.reinit()
     if param_sim.baseline is not None:
         condset = getattr(model.Condset, param_sim.neuron_type)
@@ -256,25 +317,280 @@ def run_simulation(injection_current, simtime, param_sim, model):
         else:
             keys = sorted(attr.keys())  #Check is this effecting cond Kir when 'axon' in dist, med param_cond?
             Cond_Kir = attr[keys[0]]
-            reset_baseline(param_sim.neuron_type, param_sim.baseline, Cond_Kir)
-    moose.start(simtime)
+            for neuron in neurons:
+                reset_baseline(neuron, param_sim.baseline, Cond_Kir)
+
+def abort_requested(param_sim):
+    return (param_sim.abort_max_spikes is not None or
+            param_sim.abort_block_time is not None or
+            (param_sim.abort_baseline is not None and
+             param_sim.abort_baseline_tolerance is not None))
+
+def check_abort(vm, dt, param_sim):
+    """Return the reason to stop the simulation early, or None
+
+    vm is the soma voltage simulated so far, sampled every dt.
+    """
+    above = vm >= param_sim.abort_spike_threshold
+
+    if param_sim.abort_max_spikes is not None:
+        spikes = np.count_nonzero(above[1:] & ~above[:-1])
+        if spikes > param_sim.abort_max_spikes:
+            return 'spikes: {} > {}'.format(spikes, param_sim.abort_max_spikes)
+
+    if param_sim.abort_block_time is not None and above.any():
+        # lengths of the runs of consecutive points above threshold
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], above.view(np.int8), [0]))))
+        longest = (edges[1::2] - edges[::2]).max() * dt
+        if longest >= param_sim.abort_block_time:
+            return 'block: {:.3g} s above {}'.format(longest, param_sim.abort_spike_threshold)
+
+    if (param_sim.abort_baseline is not None and
+        param_sim.abort_baseline_tolerance is not None and
+        vm.size * dt >= param_sim.injection_delay):
+        pre = vm[:int(param_sim.injection_delay / dt)]
+        baseline = np.median(pre[pre.size // 2:])
+        if abs(baseline - param_sim.abort_baseline) > param_sim.abort_baseline_tolerance:
+            return 'baseline: {:.4g} instead of {:.4g}'.format(baseline, param_sim.abort_baseline)
+
+    return None
+
+def advance(param_sim, duration, table):
+    """Simulate for duration, checking the abort criteria on the way
+
+    table is the soma voltage table. Returns the reason if the
+    simulation was stopped early, None otherwise.
+    """
+    if not abort_requested(param_sim):
+        moose.start(duration)
+        return None
+
+    clock = moose.element('/clock')
+    end = clock.currentTime + duration
+    while end - clock.currentTime > 1e-9:
+        moose.start(min(param_sim.abort_check_interval, end - clock.currentTime))
+        vm = table.vector
+        if vm.size > 1:
+            reason = check_abort(vm, clock.currentTime / vm.size, param_sim)
+            if reason is not None:
+                logger.info('aborted at {:.3g} s, {}'.format(clock.currentTime, reason))
+                return reason
+    return None
+
+def vm_table(param_sim):
+    return moose.element('/data/Vm{}_0'.format(param_sim.neuron_type))
+
+def run_simulation(injection_current, simtime, param_sim, model):
+    """Simulate injection_current from the beginning
+
+    Returns the reason if the simulation was aborted early, None otherwise.
+    """
+    if logger.level==logging.DEBUG:
+        print("################## moose versions: ", moose.__version__)
+    print(u'◢◤◢◤◢◤◢◤ injection_current = {} ◢◤◢◤◢◤◢◤'.format(injection_current))
+    pulse_gen.firstLevel = injection_current
+    reinit_simulation(param_sim, model)
+    return advance(param_sim, simtime, vm_table(param_sim))
+
+def run_branched_simulations(param_sim, model):
+    """Simulate the part before the injection once and branch for each current
+
+    The model is advanced up to `injection_delay`, which is the same for
+    all injection currents. The process is then forked once per current,
+    and each child sets the pulse level, simulates the rest and saves
+    the voltage. The state of the parent is not modified, so the next
+    child starts from the same snapshot.
+
+    The branches run one after another, not in parallel. The hdf5
+    writer cannot be shared between the branches, so :func:`main` sets
+    the model up without it (see :func:`setup`), and only the --save-vm
+    traces are written.
+    """
+    reinit_simulation(param_sim, model)
+    aborted = advance(param_sim, param_sim.injection_delay, vm_table(param_sim))
+
+    for injection_current in param_sim.injection_current:
+        print(u'◢◤◢◤◢◤◢◤ injection_current = {} (branched) ◢◤◢◤◢◤◢◤'.format(injection_current))
+        def branch():
+            pulse_gen.firstLevel = injection_current
+            reason = aborted or advance(param_sim,
+                                        param_sim.simtime - param_sim.injection_delay,
+                                        vm_table(param_sim))
+            if param_sim.save_vm:
+                save_vm(param_sim, injection_current, aborted=reason)
+        code = _run_forked(branch)
+        if code != 0:
+            raise RuntimeError('simulation of injection {} failed with code {}'
+                               .format(injection_current, code))
+
+def setup_copies(param_sim, model, pulse_gen, count):
+    """Create count-1 additional copies of the neuron for other injections
+
+    Each copy gets its own pulse generator (with the same timing as
+    pulse_gen) and its own soma voltage table. The copies share the
+    prototype, so they all have the same parameters. The solvers of the
+    copies are pointed at the copied neuron, and the new elements are
+    scheduled on the same clock ticks as the originals. Returns a list
+    of (neuron name, pulse generator, Vm table) tuples, starting with
+    the original neuron.
+    """
+    ntype = param_sim.neuron_type
+    soma = model.param_cond.NAME_SOMA
+    neuron = moose.element('/' + ntype)
+    data = moose.element('/data')
+    table = moose.element('/data/Vm{}_0'.format(ntype))
+    copies = [(ntype, pulse_gen, table)]
+
+    for k in range(1, count):
+        name = '{}_copy{}'.format(ntype, k)
+        copy = moose.element(moose.copy(neuron, '/', name))
+        # the solver still points at the original neuron
+        for solver in moose.wildcardFind(copy.path + '/##[ISA=HSolve]'):
+            orig = moose.element(solver.path.replace(copy.path, neuron.path, 1))
+            solver.dt = orig.dt
+            solver.target = solver.target.replace(neuron.path, copy.path, 1)
+            use_same_clock(orig, solver)
+
+        pg = moose.element(moose.copy(pulse_gen, pulse_gen.parent, 'pulse_' + name))
+        moose.connect(pg, 'output', moose.element(copy.path + '/' + soma), 'injectMsg')
+        use_same_clock(pulse_gen, pg)
+
+        tab = moose.Table(data.path + '/Vm{}_0'.format(name))
+        moose.connect(tab, 'requestOut', moose.element(copy.path + '/' + soma), 'getVm')
+        use_same_clock(table, tab)
+        copies.append((name, pg, tab))
+
+    return copies
+
+def use_same_clock(orig, elem):
+    "Schedule the process of elem on the clock tick of orig"
+    # copied and new elements are not scheduled like the ones set up by
+    # moose_nerp, and would not be run at all or run at a different dt
+    if orig.tick >= 0:
+        moose.useClock(orig.tick, elem.path, 'process')
+
+def run_copies_simulation(param_sim, model):
+    """Simulate all injection currents at once in copies of the neuron
+
+    All copies advance under a single reinit and start, so the scheduling
+    overhead is paid once. The voltage of each copy is saved separately.
+    The abort criteria cannot be checked in this mode, so :func:`main`
+    does not accept --abort-* options together with --copies.
+    """
+    currents = param_sim.injection_current
+    copies = setup_copies(param_sim, model, pulse_gen, len(currents))
+    for (name, pg, tab), injection_current in zip(copies, currents):
+        print(u'◢◤◢◤◢◤◢◤ injection_current = {} ({}) ◢◤◢◤◢◤◢◤'.format(injection_current, name))
+        pg.firstLevel = injection_current
+
+    reinit_simulation(param_sim, model, neurons=[name for name, pg, tab in copies])
+    moose.start(param_sim.simtime)
+
+    if param_sim.save_vm:
+        for (name, pg, tab), injection_current in zip(copies, currents):
+            save_trace(param_sim, param_sim.save_vm.format(injection_current), tab.vector)
+
+def save_trace(param_sim, filename, vector):
+    "Save vector, simulated up to the current time, in the --save-vm-* format"
+    storage.save_trace(filename, vector, moose.element('/clock').currentTime,
+                       dtype=param_sim.save_vm_dtype,
+                       dt=param_sim.save_vm_dt,
+                       encoding=param_sim.save_vm_encoding)
+
+def save_vm(param_sim, injection_current, aborted=None):
+    """Save the soma voltage of the last run to the --save-vm file
+
+    {} in the file name is replaced by the injection current.
+    If aborted is given, the simulated time and the reason are written
+    to a marker file next to it.
+    """
+    filename = param_sim.save_vm.format(injection_current)
+    save_trace(param_sim, filename, vm_table(param_sim).vector)
+    if aborted is not None:
+        with open(filename + '.aborted', 'w') as f:
+            print(moose.element('/clock').currentTime, aborted, file=f)
 
 def main(args):
+    """Build the model once and simulate each of the injection currents
+
+    The model is reinitialized between the injections, or, with
+    --snapshot, the common part before the injection is simulated once
+    (see :func:`run_branched_simulations`), or, with --copies, all
+    injections are simulated together (see :func:`run_copies_simulation`).
+    """
     global param_sim, pulse_gen
-    param_sim = option_parser().parse_args(args)
+    parser = option_parser()
+    param_sim = parser.parse_args(args)
+    if (param_sim.save_vm and len(param_sim.injection_current) > 1
+        and '{}' not in param_sim.save_vm):
+        parser.error('--save-vm must contain {} when simulating multiple injection currents')
+    if param_sim.snapshot and param_sim.copies:
+        parser.error('--snapshot and --copies cannot be used together')
+    if param_sim.copies and abort_requested(param_sim):
+        parser.error('the --abort-* options cannot be used with --copies')
+    branched = (param_sim.snapshot and len(param_sim.injection_current) > 1
+                and hasattr(os, 'fork'))
     model = importlib.import_module('moose_nerp.' + param_sim.model)
     model.param_cond.neurontypes=util.neurontypes(model.param_cond,[param_sim.neuron_type])
     logger.debug("param_sim::::::::: {}".format(param_sim))
-    pulse_gen, hdf5writer = setup(param_sim, model)
-    run_simulation(param_sim.injection_current[0], param_sim.simtime, param_sim, model)
-    hdf5writer.close()
+    pulse_gen, hdf5writer = setup(param_sim, model, save=not branched)
+    if branched:
+        run_branched_simulations(param_sim, model)
+    elif param_sim.copies and len(param_sim.injection_current) > 1:
+        run_copies_simulation(param_sim, model)
+    else:
+        for injection_current in param_sim.injection_current:
+            aborted = run_simulation(injection_current, param_sim.simtime, param_sim, model)
+            if param_sim.save_vm:
+                save_vm(param_sim, injection_current, aborted=aborted)
+    if hdf5writer is not None:
+        hdf5writer.close()
 
     if param_sim.plot_vm:
         neuron_graph.graphs(model, param_sim.plot_current, param_sim.simtime, compartments=[0])
         util.block_if_noninteractive()
-    if param_sim.save_vm:
-        elemname = '/data/Vm{}_0'.format(param_sim.neuron_type)
-        np.save(param_sim.save_vm, moose.element(elemname).vector)
+
+def _run_forked(function, *args):
+    "Call function(*args) in a forked child and return its exit code"
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            function(*args)
+            code = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    else:
+        return os.WEXITSTATUS(status)
+
+def fork_main(args):
+    """Run :func:`main` with args in a forked child of this process
+
+    The model module is imported in the parent before forking, so that
+    repeated calls from the same (long-lived) process only pay for the
+    construction and simulation of the neuron. The child starts from
+    the pristine state of the parent, so changes that :func:`setup` makes
+    to the model module and to the moose element tree are discarded
+    when the child exits.
+
+    Raises :class:`subprocess.CalledProcessError` if the child fails.
+    """
+    opts = option_parser().parse_args(args)
+    importlib.import_module('moose_nerp.' + opts.model)
+
+    code = _run_forked(main, args)
+    if code != 0:
+        raise subprocess.CalledProcessError(code, [__file__] + list(args))
 
 if __name__ == '__main__':
     main(sys.argv[1:])
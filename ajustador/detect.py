@@ -8,38 +8,135 @@ def arrayize(type):
         return functools.update_wrapper(wrapper, func)
     return decorator
 
-@arrayize(int)
 def detect_peaks(y, min_high_ratio=0.25, P_low=0.5, P_high=0.5, both=False):
+    """Return the indices of peaks in y
+
+    Starting at the first point above min_high_ratio of the maximum,
+    the running minimum and maximum are followed. A peak is the maximum
+    reached before y falls below the fraction P_high of the range
+    between them. After that, y must rise above the fraction P_low of
+    the range before the next peak is looked for. If both is true, the
+    minimums between peaks are returned too.
+
+    >>> detect_peaks(np.array([0., 1, 3, 1, 0, 2, 4, 2, 0]))
+    array([2, 6])
+    """
+    y = np.asarray(y)
+    n = y.size
+    found = []
     low_i, low = 0, y[0]
     high_i, high = 0, y[0]
 
     i = (y > y.max() * min_high_ratio).argmax() # find True
-    while True:
-        for i in range(i, len(y)):
-            if y[i] < low:
-                low_i, low = i, y[i]
-            if y[i] > high:
-                high_i, high = i, y[i]
-
-            if y[i] - low < (high - low) * P_high:
-                break
+    fall = True
+    chunk = 64
+    while i < n:
+        c = y[i:i + chunk]
+        lo = np.minimum.accumulate(c)
+        np.minimum(lo, low, out=lo)
+        hi = np.maximum.accumulate(c)
+        np.maximum(hi, high, out=hi)
+        if fall:
+            cond = c - lo < (hi - lo) * P_high
+        else:
+            cond = c - lo > (hi - lo) * P_low
+        k = cond.argmax()
+        if not cond[k]:
+            k = c.size - 1
+        # the first occurrence of a new extremum is where it was reached
+        if lo[k] < low:
+            low_i, low = i + c[:k + 1].argmin(), lo[k]
+        if hi[k] > high:
+            high_i, high = i + c[:k + 1].argmax(), hi[k]
+        if not cond[k]:
+            i += c.size
+            chunk *= 2
+            continue
+
+        i += k
+        if fall:
+            found.append(high_i)
+            low_i, low = i, y[i]
         else:
-            break
+            if both:
+                found.append(low_i)
+            high_i, high = i, y[i]
+        fall = not fall
+        chunk = 64
+    return np.array(found, dtype=int)
+
+def detect_peaks_batch(ys, min_high_ratio=0.25, P_low=0.5, P_high=0.5, both=False,
+                       chunk=256):
+    """Run :func:`detect_peaks` for each row of the 2-D array ys
+
+    Returns a list of arrays of indices. All rows are processed
+    together, chunk samples at a time: the running minimum and maximum
+    over the chunk are computed with numpy, and the state of the
+    detector is only changed in python at the first sample where the
+    condition of the current phase is met. The chunk size is adjusted
+    to how often that happens.
+    """
+    ys = np.asarray(ys)
+    rows, n = ys.shape
+    found = [[] for row in range(rows)]
+    if rows == 0:
+        return []
+
+    # state of each row: phase 0 looks for a fall after a peak,
+    # phase 1 looks for a rise after a trough
+    pos = (ys > ys.max(axis=1)[:, None] * min_high_ratio).argmax(axis=1)
+    phase = np.zeros(rows, dtype=int)
+    low, high = ys[:, 0].copy(), ys[:, 0].copy()
+    low_i, high_i = np.zeros(rows, dtype=int), np.zeros(rows, dtype=int)
+
+    active = np.arange(rows)
+    while active.size:
+        offsets = np.arange(chunk)
+        index = pos[active, None] + offsets
+        valid = index < n
+        c = ys[active[:, None], np.minimum(index, n - 1)]
+
+        lo = np.minimum(low[active, None], np.minimum.accumulate(c, axis=1))
+        hi = np.maximum(high[active, None], np.maximum.accumulate(c, axis=1))
+        fall = c - lo < (hi - lo) * P_high
+        rise = c - lo > (hi - lo) * P_low
+        cond = np.where(phase[active, None] == 0, fall, rise) & valid
+
+        hit = cond.any(axis=1)
+        k = np.where(hit, cond.argmax(axis=1), chunk - 1)
+        rng = np.arange(active.size)
+        new_low, new_high = lo[rng, k], hi[rng, k]
+
+        # the index of the first occurrence of a new extremum within c[:k+1]
+        upto = offsets <= k[:, None]
+        moved = new_low < low[active]
+        where = ((c == new_low[:, None]) & upto).argmax(axis=1)
+        low_i[active[moved]] = pos[active[moved]] + where[moved]
+        moved = new_high > high[active]
+        where = ((c == new_high[:, None]) & upto).argmax(axis=1)
+        high_i[active[moved]] = pos[active[moved]] + where[moved]
+        low[active], high[active] = new_low, new_high
 
-        yield high_i
-        low_i, low = i, y[i]
+        for j in np.flatnonzero(hit):
+            row = active[j]
+            i = pos[row] + k[j]
+            if phase[row] == 0:
+                found[row].append(high_i[row])
+                low_i[row], low[row] = i, ys[row, i]
+            else:
+                if both:
+                    found[row].append(low_i[row])
+                high_i[row], high[row] = i, ys[row, i]
+            phase[row] = 1 - phase[row]
+            pos[row] = i
 
-        for i in range(i, len(y)):
-            if y[i] < low:
-                low_i, low = i, y[i]
-            if y[i] > high:
-                high_i, high = i, y[i]
+        pos[active[~hit]] += chunk
+        active = active[pos[active] < n]
 
-            if y[i] - low > (high - low) * P_low:
-                break
+        # noisy traces change state every few samples, smooth ones rarely
+        if 2 * hit.sum() > hit.size:
+            chunk = max(chunk // 2, 16)
         else:
-            break
+            chunk = min(chunk * 2, 4096)
 
-        if both:
-            yield low_i
-        high_i, high = i, y[i]
+    return [np.array(peaks, dtype=int) for peaks in found]
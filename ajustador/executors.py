@@ -0,0 +1,338 @@
+"""Executors which run simulation jobs in parallel
+
+An executor provides the two methods of :class:`multiprocessing.Pool`
+which are used by :func:`ajustador.optimize.exe_map`:
+
+- map(function, iterable) returns a list of results,
+- map_async(function, iterable, callback=None) returns an object with
+  .ready(), .wait() and .get() methods, and calls callback with the list
+  of results once all of them are available.
+
+The executor used by :class:`ajustador.optimize.MooseSimulation`,
+:class:`ajustador.xml.NeurordSimulation` and
+:func:`ajustador.analysis.scan_params` is selected with
+:func:`set_executor`. By default a :class:`PoolExecutor` with one
+process per cpu is used.
+
+:class:`ClusterExecutor` sends jobs to worker nodes over TCP. A worker
+node is started on each machine with::
+
+  $ python3 -m ajustador.executors --listen=0.0.0.0:7070 --authkey=secret
+
+and the fit is told to use them with::
+
+  >>> executors.set_executor(executors.ClusterExecutor(
+  ...     ['node1:7070', 'node2:7070'], authkey=b'secret'))
+
+Simulations write their results to the fit directory, so it must be on
+a filesystem shared with all nodes.
+"""
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+from multiprocessing.connection import Listener, Client
+
+from ajustador.helpers.loggingsystem import getlogger
+import logging
+logger = getlogger(__name__)
+logger.setLevel(logging.INFO)
+
+class FuturesResult(object):
+    """The result of map_async for a list of concurrent.futures.Future objects
+
+    The interface matches multiprocessing.pool.AsyncResult.
+    """
+    def __init__(self, futures, callback=None):
+        self._futures = futures
+        self._callback = callback
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._remaining = len(futures)
+
+        if not futures:
+            self._finish()
+        for future in futures:
+            future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._remaining -= 1
+            last = self._remaining == 0
+        if last:
+            self._finish()
+
+    def _finish(self):
+        try:
+            if self._callback is not None and self.successful():
+                self._callback([future.result() for future in self._futures])
+        finally:
+            self._event.set()
+
+    def successful(self):
+        return all(future.exception() is None for future in self._futures)
+
+    def ready(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise multiprocessing.TimeoutError
+        return [future.result() for future in self._futures]
+
+class PoolExecutor(object):
+    "Run jobs in a local multiprocessing.Pool, created on first use"
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        return self._pool
+
+    def map(self, function, iterable):
+        return self.pool.map(function, iterable)
+
+    def map_async(self, function, iterable, callback=None):
+        return self.pool.map_async(function, iterable, callback=callback)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+class FuturesExecutor(object):
+    """Run jobs with a concurrent.futures executor
+
+    A ProcessPoolExecutor with one process per cpu is used if executor
+    is not specified.
+    """
+    def __init__(self, executor=None):
+        if executor is None:
+            executor = concurrent.futures.ProcessPoolExecutor(multiprocessing.cpu_count())
+        self.executor = executor
+
+    def submit(self, function, arg):
+        return self.executor.submit(function, arg)
+
+    def map(self, function, iterable):
+        futures = [self.submit(function, arg) for arg in iterable]
+        return [future.result() for future in futures]
+
+    def map_async(self, function, iterable, callback=None):
+        futures = [self.submit(function, arg) for arg in iterable]
+        return FuturesResult(futures, callback=callback)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+def parse_address(address):
+    "Convert 'host:port' to ('host', port)"
+    if isinstance(address, str):
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return tuple(address)
+
+class ClusterExecutor(FuturesExecutor):
+    """Run jobs on worker nodes started with :class:`WorkerNode`
+
+    Each node reports the number of processes it runs, and one connection
+    (a "slot") is opened for each of them. Jobs are taken from a common
+    queue by whichever slot becomes free first. function and its argument
+    are pickled, so function must be importable on the nodes.
+
+    A job sent to a node which is lost fails with ConnectionError. Once
+    all nodes are lost, the queued jobs and any new ones fail the same
+    way.
+    """
+    def __init__(self, addresses, authkey):
+        self.authkey = authkey
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._slots = 0
+
+        for address in addresses:
+            address = parse_address(address)
+            conn, processes = self._connect(address)
+            conns = [conn] + [self._connect(address)[0] for i in range(processes - 1)]
+            logger.info('connected to {}:{} with {} slots'.format(*address, processes))
+            for conn in conns:
+                self._slots += 1
+                thread = threading.Thread(target=self._slot, args=(conn,), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        if not self._threads:
+            raise ValueError('no worker nodes specified')
+
+    def _connect(self, address):
+        conn = Client(address, authkey=self.authkey)
+        hello, processes = conn.recv()
+        assert hello == 'hello', hello
+        return conn, processes
+
+    def _slot(self, conn):
+        try:
+            with conn:
+                self._serve_slot(conn)
+        finally:
+            with self._lock:
+                self._slots -= 1
+                if self._slots == 0:
+                    self._fail_queued()
+
+    def _serve_slot(self, conn):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, function, arg = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                conn.send((function, arg))
+            except (EOFError, OSError) as e:
+                future.set_exception(ConnectionError('worker node lost: {}'.format(e)))
+                break
+            except Exception as e:
+                # the job cannot be pickled, nothing was sent
+                future.set_exception(e)
+                continue
+            try:
+                status, value = conn.recv()
+            except (EOFError, OSError) as e:
+                future.set_exception(ConnectionError('worker node lost: {}'.format(e)))
+                break
+            except Exception as e:
+                # the reply cannot be unpickled, but it was read completely
+                future.set_exception(e)
+                continue
+            if status == 'ok':
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _fail_queued(self):
+        # called with the lock held when the last slot is gone
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self._fail(item[0])
+
+    @staticmethod
+    def _fail(future):
+        if future.set_running_or_notify_cancel():
+            future.set_exception(ConnectionError('no worker nodes left'))
+
+    def submit(self, function, arg):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._slots == 0:
+                self._fail(future)
+            else:
+                self._queue.put((future, function, arg))
+        return future
+
+    def shutdown(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+class WorkerNode(object):
+    """Accept jobs from a :class:`ClusterExecutor` and run them in a local pool
+
+    Each connection is served by a separate thread, which passes the
+    jobs to the pool one at a time.
+    """
+    def __init__(self, address, authkey, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = multiprocessing.Pool(self.processes)
+        self._listener = Listener(parse_address(address), authkey=authkey)
+
+    @property
+    def address(self):
+        return self._listener.address
+
+    def serve_forever(self):
+        logger.info('serving {} processes on {}:{}'.format(self.processes, *self.address))
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                # the listener was closed
+                break
+            except multiprocessing.AuthenticationError as e:
+                logger.warning('rejected connection: {}'.format(e))
+                continue
+            thread = threading.Thread(target=self._serve_connection, args=(conn,), daemon=True)
+            thread.start()
+
+    def _serve_connection(self, conn):
+        with conn:
+            conn.send(('hello', self.processes))
+            while True:
+                try:
+                    function, arg = conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    reply = 'ok', self._pool.apply(function, (arg,))
+                except BaseException as e:
+                    # always reply, the slot is waiting for it
+                    reply = 'error', e
+                try:
+                    conn.send(reply)
+                except (EOFError, OSError):
+                    break
+                except Exception as e:
+                    conn.send(('error', RuntimeError('cannot send the reply: {!r}'.format(e))))
+
+    def close(self):
+        self._listener.close()
+        self._pool.terminate()
+
+_executor = None
+
+def get_executor():
+    "Return the current executor, creating the default PoolExecutor if needed"
+    global _executor
+    if _executor is None:
+        _executor = PoolExecutor()
+    return _executor
+
+def set_executor(executor):
+    "Use executor for all subsequent simulations"
+    global _executor
+    _executor = executor
+
+def option_parser():
+    p = argparse.ArgumentParser(description='Run an ajustador worker node')
+    p.add_argument('--listen', required=True, help='host:port to listen on')
+    p.add_argument('--authkey', required=True, help='shared secret for connections')
+    p.add_argument('--processes', type=int, help='number of worker processes')
+    return p
+
+def main(args=None):
+    opts = option_parser().parse_args(args)
+    node = WorkerNode(opts.listen, opts.authkey.encode(), processes=opts.processes)
+    try:
+        node.serve_forever()
+    finally:
+        node.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import math
 from collections import namedtuple
 import pprint
+import pickle
 import numpy as np
 from scipy import optimize
 
@@ -109,6 +110,20 @@ class Feature:
     def report(self):
         return '\n'.join(self.report_attr(name) for name in self.provides)
 
+def _cut_mean(data, keep):
+    """Mean and σ of the values in each row of data where keep is true
+
+    Returns an array with .x and .dev, like :func:`vartype.array`.
+    """
+    count = keep.sum(axis=1)
+    mean = np.where(keep, data, 0).sum(axis=1) / count
+    var = np.where(keep, (data - mean[:, None])**2, 0).sum(axis=1) / (count - 1)
+    return np.rec.fromarrays((mean, var**0.5), names='x,dev')
+
+def _percentile_mean(data, low=40, high=60):
+    cutoffa, cutoffb = np.percentile(data, (low, high), axis=1)
+    return _cut_mean(data, (data >= cutoffa[:, None]) & (data <= cutoffb[:, None]))
+
 class SteadyState(Feature):
     """Find the baseline and injection steady states
 
@@ -251,24 +266,39 @@ class SteadyState(Feature):
 
 peak_and_threshold = namedtuple('peak_and_threshold', 'peaks thresholds')
 
-def _find_spikes(wave, min_height=0.0, max_charge_time=0.004, charge_threshold=0.02):
-    peaks = detect.detect_peaks(wave.y, P_low=0.75, P_high=0.50)
-    peaks = peaks[wave.y[peaks] > min_height]
-
-    thresholds = np.empty(peaks.size)
-    for i in range(len(peaks)):
-        start = (wave.x >= wave.x[peaks[i]] - max_charge_time).argmax()
-        x = wave.x[start:peaks[i] + 1]
-        y = wave.y[start:peaks[i] + 1]
-        yderiv = np.diff(y)
-        #spike threshold is point where derivative is 2% of steepest
-        try:
-            ythresh = charge_threshold * yderiv.max()
-            thresh = y[1:][yderiv > ythresh].min()
-            thresholds[i] = thresh
-        except Exception:
-            thresholds[i] = np.nan
-    return peak_and_threshold(peaks, thresholds)
+def _find_spikes(wave, min_height=0.0, max_charge_time=0.004, charge_threshold=0.02,
+                 peaks=None):
+    if peaks is None:
+        peaks = detect.detect_peaks(wave.y, P_low=0.75, P_high=0.50)
+    x, y = wave.x, wave.y
+    peaks = peaks[y[peaks] > min_height]
+    return peak_and_threshold(peaks, _spike_thresholds(x, y, peaks,
+                                                       max_charge_time, charge_threshold))
+
+def _spike_thresholds(x, y, peaks, max_charge_time, charge_threshold):
+    """Find the thresholds of all spikes at once
+
+    The window of each spike starts max_charge_time before the peak.
+    The windows are gathered into one array padded on the right, and
+    the padding is masked out of the derivative.
+    """
+    if peaks.size == 0:
+        return np.empty(0)
+    starts = np.searchsorted(x, x[peaks] - max_charge_time, side='left')
+    lengths = peaks - starts + 1
+    offsets = np.arange(lengths.max())
+    window = y[np.minimum(starts[:, None] + offsets, peaks[:, None])]
+    yderiv = np.diff(window, axis=1)
+    valid = offsets[1:] < lengths[:, None]
+
+    #spike threshold is point where derivative is 2% of steepest
+    with np.errstate(invalid='ignore'):
+        steepest = np.where(valid, yderiv, -np.inf).max(axis=1, initial=-np.inf)
+        above = valid & (yderiv > charge_threshold * steepest[:, None])
+        thresholds = np.where(above, window[:, 1:], np.inf).min(axis=1, initial=np.inf)
+    # windows without derivative or above-threshold points have no threshold
+    thresholds[~above.any(axis=1)] = np.nan
+    return thresholds
 
 class WaveRegion:
     def __init__(self, wave, left_i, right_i):
@@ -322,6 +352,86 @@ class WaveRegion:
     def report(self, prefix='WaveRegion = '):
         return '{}{}'.format(prefix, self)
 
+class WaveRegions:
+    """Many regions of one wave, stored as arrays of indices
+
+    The arrays .left_i and .right_i hold the indices of the edges, and
+    .left, .right and .width are computed for all regions at once.
+    Indexing returns a single :class:`WaveRegion`.
+    """
+    def __init__(self, wave, left_i, right_i):
+        self._wave = wave
+        self.left_i = np.asarray(left_i, dtype=int)
+        self.right_i = np.asarray(right_i, dtype=int)
+
+    def __len__(self):
+        return self.left_i.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return WaveRegions(self._wave, self.left_i[i], self.right_i[i])
+        return WaveRegion(self._wave, self.left_i[i], self.right_i[i])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def left(self):
+        "x coordinates of the left edges, like WaveRegion.left"
+        x = self._wave.x
+        return (x[np.maximum(self.left_i - 1, 0)] + x[self.left_i]) / 2
+
+    @property
+    def right(self):
+        "x coordinates of the right edges, like WaveRegion.right"
+        x = self._wave.x
+        right_i = np.minimum(self.right_i, x.size - 1)
+        right = (x[right_i] + x[np.minimum(right_i + 1, x.size - 1)]) / 2
+        # a region reaching past the end has no right edge
+        return np.where(self.right_i < x.size, right, np.nan)
+
+    @property
+    def width(self):
+        return self.right - self.left
+
+    def _segments(self):
+        """Return the y values of all regions padded to a common length
+
+        The result is (index, valid): a 2-D array of indices into the
+        wave, and a mask of the indices which belong to the regions.
+        """
+        last = np.minimum(self.right_i, self._wave.size - 1)
+        if len(self) == 0:
+            return np.empty((0, 0), dtype=int), np.empty((0, 0), dtype=bool)
+        offsets = np.arange((last - self.left_i).max() + 1)
+        index = self.left_i[:, None] + offsets
+        valid = index <= last[:, None]
+        return np.minimum(index, last[:, None]), valid
+
+    def __str__(self):
+        return '\n'.join(str(region) for region in self)
+
+def _advance(start, step, cond, width=16):
+    """Step from start until cond becomes false
+
+    For each element of start, return the first index j = start + step*t,
+    t >= 0, for which cond(rows, j) is false. cond is called with the
+    numbers of the searches and a 2-D array of indices to check, and
+    must be false for indices out of bounds, so that all searches stop.
+    """
+    result = np.empty_like(start)
+    pos = np.array(start)
+    rows = np.arange(start.size)
+    while rows.size:
+        index = pos[rows, None] + step * np.arange(width)
+        stop = ~cond(rows, index)
+        done = stop.any(axis=1)
+        result[rows[done]] = index[done, stop[done].argmax(axis=1)]
+        pos[rows[~done]] = index[~done, -1] + step
+        rows = rows[~done]
+        width *= 2
+    return result
+
 class Spikes(Feature):
     """Find the position and height of spikes
     """
@@ -420,18 +530,16 @@ class Spikes(Feature):
         "The FWHM box and other measurements for each spike"
         spikes, thresholds = self.spike_i_and_threshold
 
-        ans = []
         y = self._obj.wave.y
         halfheight = (self.spikes.y - thresholds) / 2 + thresholds
+        above = lambda rows, index: y[np.clip(index, 0, y.size - 1)] > halfheight[rows, None]
 
-        for i, k in enumerate(self.spike_i):
-            beg = end = k
-            while beg > 1 and y[beg - 1] > halfheight[i]:
-                beg -= 1
-            while end + 2 < y.size and y[end + 1] > halfheight[i]:
-                end += 1
-            ans.append(WaveRegion(self._obj.wave, beg, end))
-        return ans
+        # extend the box to both sides while y stays above halfheight
+        beg = _advance(spikes - 1, -1,
+                       lambda rows, index: (index >= 1) & above(rows, index)) + 1
+        end = _advance(spikes + 1, 1,
+                       lambda rows, index: (index + 1 < y.size) & above(rows, index)) - 1
+        return WaveRegions(self._obj.wave, beg, end)
 
     @property
     @utilities.once
@@ -444,7 +552,7 @@ class Spikes(Feature):
     @property
     @utilities.once
     def spike_width(self):
-        return np.array([bounds.width for bounds in self.spike_bounds])
+        return self.spike_bounds.width
 
     @property
     @utilities.once
@@ -521,7 +629,6 @@ class AHP(Feature):
     @property
     @utilities.once
     def spike_ahp_window(self):
-        spikes = self._obj.spikes
         spike_bounds = self._obj.spike_bounds
         thresholds = self._obj.spike_threshold
         injection_start = self._obj.injection_start
@@ -529,38 +636,59 @@ class AHP(Feature):
 
         x = self._obj.wave.x
         y = self._obj.wave.y
-        ans = []
-        for i in range(len(spikes)):
-            beg = spike_bounds[i].right_i
-
-            # Don't allow the ahp to straddle an injection start/stop edge.
-            # The ahp will be invalid anyway.
-            rlimit = min(spike_bounds[i+1].left if i < len(spikes)-1 else x[-1],
-                         injection_start if injection_start > x[beg] else np.infty,
-                         injection_end if injection_end > x[beg] else np.infty)
-
-            w = spike_bounds[i].width
-            if not np.isnan(w):
-                n_rolling_window = int(w // (x[1] - x[0])) + 1
-            else:
-                # FIXME: consider rejecting those outright
-                n_rolling_window = 5
-
-            # if we are before the AHP, or mostly going down, advance
-            while (beg < y.size - n_rolling_window and
-                   y[beg] >= thresholds[i] and x[beg + 1] < rlimit and
-                   y[beg] > y[beg + n_rolling_window]):
-                beg += 1
-
-            end = beg + n_rolling_window
-            while (end < x.size and
-                   (y[end] < thresholds[i] or end - beg < 5) and
-                   x[end] < rlimit):
-                end += 1
-
-            ans.append(WaveRegion(self._obj.wave, beg, end))
-
-        return ans
+        n = y.size
+        beg = spike_bounds.right_i
+
+        # Don't allow the ahp to straddle an injection start/stop edge.
+        # The ahp will be invalid anyway.
+        rlimit = np.minimum.reduce([
+            np.append(spike_bounds.left[1:], x[-1])[:beg.size],
+            np.where(injection_start > x[beg], injection_start, np.inf),
+            np.where(injection_end > x[beg], injection_end, np.inf)])
+
+        w = spike_bounds.width
+        # FIXME: consider rejecting those with nan width outright
+        n_rolling_window = np.where(np.isnan(w), 5,
+                                    np.nan_to_num(w // (x[1] - x[0])) + 1).astype(int)
+
+        def at(array, index):
+            return array[np.clip(index, 0, n - 1)]
+
+        # if we are before the AHP, or mostly going down, advance
+        def descending(rows, index):
+            return ((index < n - n_rolling_window[rows, None]) &
+                    (at(y, index) >= thresholds[rows, None]) &
+                    (at(x, index + 1) < rlimit[rows, None]) &
+                    (at(y, index) > at(y, index + n_rolling_window[rows, None])))
+        beg = _advance(beg, 1, descending)
+
+        def below(rows, index):
+            return ((index < n) &
+                    ((at(y, index) < thresholds[rows, None]) | (index - beg[rows, None] < 5)) &
+                    (at(x, index) < rlimit[rows, None]))
+        end = _advance(beg + n_rolling_window, 1, below)
+
+        return WaveRegions(self._obj.wave, beg, end)
+
+    def _bottom(self, width):
+        """Return the points of the AHP windows around their minimums
+
+        The result is (x, y, keep): 2-D arrays with the values of each
+        window, and a mask of the points closer than width/2 to the
+        minimum.
+        """
+        windows = self.spike_ahp_window
+        index, valid = windows._segments()
+        x = self._obj.wave.x[index]
+        y = np.where(valid, self._obj.wave.y[index], np.inf)
+        if len(windows) == 0:
+            return x, y, valid
+        lowest = x[np.arange(len(windows)), y.argmin(axis=1)]
+        with np.errstate(invalid='ignore'):
+            keep = (valid &
+                    (x >= (lowest - width / 2)[:, None]) &
+                    (x <= (lowest + width / 2)[:, None]))
+        return x, y, keep
 
     @property
     @utilities.once
@@ -574,20 +702,9 @@ class AHP(Feature):
         thresh=spikes.spike_threshold
         mean=vartype.array_mean(cut.y)-thresh[i], or ans[i]=mean.x-spikes.spike_threshold[i],mean.dev
         """
-        windows = self.spike_ahp_window
-        spikes = self._obj.spikes
-        spike_bounds = self._obj.spike_bounds
-
-        ans = np.empty((len(windows), 2))
-        for i in range(len(windows)):
-            w = spike_bounds[i].width
-            left = windows[i].x[windows[i].y.argmin()] - w/2
-            right = windows[i].x[windows[i].y.argmin()] + w/2
-            cut = windows[i].wave[(windows[i].x >= left) & (windows[i].x <= right)]
-            mean = vartype.array_mean(cut.y)
-            ans[i] = mean.x, mean.dev
-
-        return np.rec.fromarrays(ans.T, names='x,dev')
+        x, y, keep = self._bottom(self._obj.spike_bounds.width)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return _cut_mean(y, keep)
 
     @property
     @utilities.once
@@ -601,30 +718,28 @@ class AHP(Feature):
         TODO: add to plot
         """
         windows = self.spike_ahp_window
-        spikes = self._obj.spikes
-        spike_bounds = self._obj.spike_bounds
-
-        ans = np.empty((len(windows), 2))
-        for i in range(len(windows)):
-            step = windows[i].x[1] - windows[i].x[0]
-            # Make sure that we have at least a few points in the window,
-            # even if the spike is very narrow.
-            w = max(spike_bounds[i].width, 8 * step)
-            left = windows[i].x[windows[i].y.argmin()] - w/2
-            right = windows[i].x[windows[i].y.argmin()] + w/2
-            cut = windows[i].wave[(windows[i].x >= left) & (windows[i].x <= right)]
-            bottom = vartype.array_mean(cut.y)
-            relative = cut.y - bottom.x
-            weights = (relative / relative.ptp())**-2
-            weights = np.fmin(weights, 100)
-            avg = (cut.x * weights).sum() / weights.sum()
-            assert not np.isnan(avg)
-            dev = ((cut.x-avg)**2 * weights).sum()**0.5 / weights.sum()**0.5
-            assert not np.isnan(dev)
+        x = self._obj.wave.x
+        step = x[np.minimum(windows.left_i + 1, x.size - 1)] - x[windows.left_i]
+        # Make sure that we have at least a few points in the window,
+        # even if the spike is very narrow.
+        width = self._obj.spike_bounds.width
+        width = np.where(8 * step > width, 8 * step, width)
+
+        x, y, keep = self._bottom(width)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bottom = _cut_mean(y, keep)
+            relative = y - bottom.x[:, None]
+            ptp = (np.where(keep, relative, -np.inf).max(axis=1, initial=-np.inf) -
+                   np.where(keep, relative, np.inf).min(axis=1, initial=np.inf))
+            weights = (relative / ptp[:, None])**-2
+            weights = np.where(keep, np.fmin(weights, 100), 0)
+            total = weights.sum(axis=1)
+            avg = (x * weights).sum(axis=1) / total
+            assert not np.isnan(avg).any()
+            dev = ((x - avg[:, None])**2 * weights).sum(axis=1)**0.5 / total**0.5
+            assert not np.isnan(dev).any()
             # TODO: check the formula for dev
-            ans[i] = (avg, dev)
-
-        return np.rec.fromarrays(ans.T, names='x,dev')
+        return np.rec.fromarrays((avg, dev), names='x,dev')
 
     def _do_plots(self, axes):
         spikes = self._obj.spikes
@@ -688,20 +803,34 @@ class AHP(Feature):
             diff = r - l
             axes[i].set_xlim(l - diff*0.15, r + diff*0.15)
 
+def _smooth_part(y, lo, hi, window):
+    """Return smooth(y)[lo:hi], smoothing only the part which is needed
+
+    The hanning window only reaches window points to each side, so a
+    margin of twice that gives the same values as smoothing everything.
+    """
+    margin = 2 * window
+    a, b = max(lo - margin, 0), min(hi + margin, y.size)
+    return smooth(y[a:b], window='hanning', window_len=window)[lo - a : hi - a]
+
 def _find_falling_curve(wave, window=20, after=0.2, before=0.6):
+    # plain arrays, indexing the record array element by element is slow
+    x, y = wave.x, wave.y
     d = vartype.array_diff(wave)
-    dd = smooth(d.y, window='hanning', window_len=window)[(d.x > after) & (d.x < before)]
-    start = end = dd.argmin() + (d.x <= after).sum()
-    while start > 0 and wave[start - 1].y > wave[start].y and wave[start].x > after:
-        start -= 1
-    sm = smooth(wave.y, window='hanning', window_len=window)
-    smallest = sm[end]
+    dx = d.x
+    lo, hi = np.searchsorted(dx, after, side='right'), np.searchsorted(dx, before)
+    dd = _smooth_part(d.y, lo, hi, window)
+    end = dd.argmin() + lo
+    # the search below stays before x=before, plus one window
+    sm_hi = min(np.searchsorted(x, before) + window + 1, y.size)
+    sm = _smooth_part(y, lo, sm_hi, window)
+    smallest = sm[end - lo]
     # find minimum
-    while (end+window < wave.size and wave[end+window].x < before
-           and sm[end:end + window].min() < smallest):
-        smallest = sm[end]
+    while (end+window < y.size and x[end+window] < before
+           and sm[end - lo:end - lo + window].min() < smallest):
+        smallest = sm[end - lo]
         end += window // 2
-    start_override = (d.x > after).argmax()
+    start_override = (dx > after).argmax()
     ccut = wave[start_override + 1 : end]
     return ccut
 
@@ -713,22 +842,122 @@ def negative_exp(x, amp, tau):
 falling_param = namedtuple('falling_param', 'amp tau')
 function_fit = namedtuple('function_fit', 'function params good')
 
-def _fit_falling_curve(ccut, baseline, steady):
-    if ccut.size < 5 or not (steady-baseline).negative:
-        func = None
-        params = falling_param(vartype.vartype.nan,
-                               vartype.vartype.nan)
-        good = False
-    else:
-        init = (ccut.y.min()-baseline.x, ccut.x.ptp())
-        func = negative_exp
-        popt, pcov = optimize.curve_fit(func, ccut.x, ccut.y-baseline.x, (-1,1))
-        pcov = np.zeros((2,2)) + pcov
-        params = falling_param(vartype.vartype(popt[0], pcov[0,0]**0.5),
-                               vartype.vartype(popt[1], pcov[1,1]**0.5))
-        good = params.amp.negative and params.tau.positive
-    return function_fit(func, params, good)
-
+def _fit_falling_curve(ccut, baseline, steady, fast=False):
+    return _fit_falling_curves([ccut], [baseline], [steady], fast=fast)[0]
+
+def _fit_falling_curves(ccuts, baselines, steadys, fast=False,
+                        tolerance=0.1, iterations=8):
+    """Fit negative_exp to each of ccuts
+
+    With fast, the fits are done together: tau is estimated in closed
+    form from the sums over three consecutive blocks of the curve (or
+    from the time to reach 1-1/e of the final value, if that fails), amp by
+    linear least squares, and a few Gauss-Newton steps bring both to the
+    least-squares optimum. The covariance is
+    computed like curve_fit does. Curves where this does not converge,
+    or where the residual is larger than tolerance × amp, are fitted
+    with curve_fit.
+    """
+    ans = [None] * len(ccuts)
+    todo = []
+    for i, (ccut, baseline, steady) in enumerate(zip(ccuts, baselines, steadys)):
+        if ccut.size < 5 or not (steady-baseline).negative:
+            params = falling_param(vartype.vartype.nan,
+                                   vartype.vartype.nan)
+            ans[i] = function_fit(None, params, False)
+        else:
+            todo.append(i)
+
+    if fast and todo:
+        fits = _fast_exp_fits([ccuts[i] for i in todo],
+                              [baselines[i].x for i in todo],
+                              tolerance, iterations)
+        for i, fit in zip(todo, fits):
+            ans[i] = fit
+    for i in todo:
+        if ans[i] is None:
+            ans[i] = _curve_fit_falling_curve(ccuts[i], baselines[i])
+    return ans
+
+def _falling_fit(popt, pcov):
+    pcov = np.zeros((2,2)) + pcov
+    params = falling_param(vartype.vartype(popt[0], pcov[0,0]**0.5),
+                           vartype.vartype(popt[1], pcov[1,1]**0.5))
+    good = params.amp.negative and params.tau.positive
+    return function_fit(negative_exp, params, good)
+
+def _curve_fit_falling_curve(ccut, baseline):
+    popt, pcov = optimize.curve_fit(negative_exp, ccut.x, ccut.y-baseline.x, (-1,1))
+    return _falling_fit(popt, pcov)
+
+def _fast_exp_fits(ccuts, baselines, tolerance, iterations):
+    """Fit amp·(1 - exp(-t/tau)) to padded curves, see _fit_falling_curves
+
+    Returns a list with a function_fit or None (not converged) for each curve.
+    """
+    sizes = np.array([ccut.size for ccut in ccuts])
+    rows = np.arange(sizes.size)
+    t = np.zeros((sizes.size, sizes.max()))
+    f = np.zeros_like(t)
+    for i, ccut in enumerate(ccuts):
+        t[i, :ccut.size] = ccut.x - ccut.x[0]
+        f[i, :ccut.size] = ccut.y - baselines[i]
+
+    with np.errstate(all='ignore'):
+        # The sums over three consecutive blocks of an exponential approach
+        # differ by a constant factor, exp(-block/tau).
+        m = sizes // 3
+        c = np.cumsum(f, axis=1)
+        c1, c2, c3 = c[rows, m - 1], c[rows, 2*m - 1], c[rows, 3*m - 1]
+        s1, s2, s3 = c1, c2 - c1, c3 - c2
+        factor = (s3 - s2) / (s2 - s1)
+        tau = -t[rows, m] / np.log(np.where((factor > 0) & (factor < 1), factor, np.nan))
+        # when the curve levels off early, the last blocks are mostly
+        # noise; use the time to reach 1-1/e of the final value instead
+        final = s3 / m
+        valid = np.arange(t.shape[1]) < sizes[:, None]
+        reached = valid & (f / final[:, None] >= 1 - np.exp(-1))
+        tau = np.where(np.isnan(tau), t[rows, reached.argmax(axis=1)], tau)
+        ok = (tau > 0) & reached.any(axis=1)
+        # t and f are 0 in the padding, so g, r and the jacobian are 0 there too
+        g = 1 - np.exp(-t / tau[:, None])
+        amp = (g * f).sum(axis=1) / (g**2).sum(axis=1)
+
+        # Gauss-Newton steps; the normal matrix of the last step gives
+        # the covariance, like in curve_fit
+        normal = np.full((sizes.size, 3), np.nan)
+        ssr = np.full(sizes.size, np.nan)
+        active = np.flatnonzero(ok)
+        for step in range(iterations):
+            if active.size == 0:
+                break
+            ta, fa = t[active], f[active]
+            amp_a, tau_a = amp[active, None], tau[active, None]
+            e = np.exp(-ta / tau_a)
+            g = 1 - e
+            r = fa - amp_a * g
+            jac = -amp_a / tau_a**2 * ta * e
+            a11, a12, a22 = (g*g).sum(axis=1), (g*jac).sum(axis=1), (jac*jac).sum(axis=1)
+            b1, b2 = (g*r).sum(axis=1), (jac*r).sum(axis=1)
+            det = a11 * a22 - a12**2
+            d_tau = (a11 * b2 - a12 * b1) / det
+            amp[active] += (a22 * b1 - a12 * b2) / det
+            tau[active] += d_tau
+
+            done = np.abs(d_tau) <= 1e-5 * np.abs(tau[active])
+            normal[active[done]] = np.array([a11, a12, a22]).T[done]
+            ssr[active[done]] = (r[done]**2).sum(axis=1)
+            active = active[~done & np.isfinite(d_tau)]
+
+        a11, a12, a22 = normal.T
+        scale = ssr / (sizes - 2) / (a11 * a22 - a12**2)
+        residual = (ssr / sizes)**0.5 / np.abs(amp)
+
+    good = ok & (tau > 0) & np.isfinite(scale) & (residual < tolerance)
+    return [_falling_fit((amp[i], tau[i]),
+                         scale[i] * np.array([[a22[i], -a12[i]], [-a12[i], a11[i]]]))
+            if good[i] else None
+            for i in rows]
 
 class FallingCurve(Feature):
     requires = ('wave',
@@ -741,6 +970,9 @@ class FallingCurve(Feature):
     array_attributes = ('falling_curve_amp', 'falling_curve_tau',
                         'falling_curve_function')
 
+    # estimate the exponential directly and use curve_fit only as a fallback
+    fast_fit = True
+
     @property
     @utilities.once
     def falling_curve(self):
@@ -752,7 +984,8 @@ class FallingCurve(Feature):
     @property
     @utilities.once
     def falling_curve_fit(self):
-        return _fit_falling_curve(self.falling_curve, self._obj.baseline, self._obj.steady)
+        return _fit_falling_curve(self.falling_curve, self._obj.baseline, self._obj.steady,
+                                  fast=self.fast_fit)
 
     @property
     def falling_curve_amp(self):
@@ -792,6 +1025,14 @@ class FallingCurve(Feature):
         ax.figure.tight_layout()
 
 
+def _rectification(ccut, steady, window_len):
+    if ccut.size < window_len + 1:
+        return vartype.vartype.nan
+    pos = ccut.y.argmin()
+    end = max(pos + window_len//2, ccut.size-1)
+    bottom = vartype.array_mean(ccut[end-window_len : end+window_len+1].y)
+    return steady - bottom
+
 class Rectification(Feature):
     requires = ('injection_start',
                 'steady_after', 'steady_before',
@@ -805,15 +1046,7 @@ class Rectification(Feature):
     @property
     @utilities.once
     def rectification(self):
-        ccut = self._obj.falling_curve
-        steady = self._obj.steady
-
-        if ccut.size < self.window_len + 1:
-            return vartype.vartype.nan
-        pos = ccut.y.argmin()
-        end = max(pos + self.window_len//2, ccut.size-1)
-        bottom = vartype.array_mean(ccut[end-self.window_len : end+self.window_len+1].y)
-        return steady - bottom
+        return _rectification(self._obj.falling_curve, self._obj.steady, self.window_len)
 
     def plot(self, figure=None):
         ax = super().plot(figure)
@@ -922,3 +1155,258 @@ standard_features = (
     Rectification,
     ChargingCurve,
     )
+
+def _vartype_row(array, i):
+    return vartype.vartype(array.x[i], array.dev[i])
+
+class BatchFeatures:
+    """Compute features of many traces with a common time base at once
+
+    x is the time base, ys is a (traces × samples) array of voltages,
+    and params provides the measurement parameters (baseline_before,
+    injection_start, …), usually the first element of
+    Measurement.features.
+
+    The quantities of :class:`SteadyState` are computed for all rows in
+    single numpy passes, and spikes are found with
+    :func:`detect.detect_peaks_batch`. The falling curve search is
+    sequential, and is done row by row with the same helpers as
+    :class:`FallingCurve`. Each attribute is an array (or a list for
+    spikes and fits) with one element per row.
+
+    :meth:`install` stores the results in the feature objects of the
+    corresponding traces, so that the usual per-trace attributes are
+    served without computing anything. :func:`precompute` does all of
+    this for a list of traces, e.g. the waves of a measurement or of a
+    whole population of simulations.
+    """
+    def __init__(self, x, ys, params):
+        self.x = x
+        self.ys = ys
+        self.params = params
+
+    def __len__(self):
+        return len(self.ys)
+
+    def _wave(self, i):
+        return np.rec.fromarrays((self.x, self.ys[i]), names='x,y')
+
+    @property
+    @utilities.once
+    def baseline(self):
+        before = self.params.baseline_before
+        after = self.params.baseline_after
+        if before is None and after is None:
+            raise ValueError('cannot determine baseline')
+        region = ((self.x < before if before is not None else False) |
+                  (self.x > after if after is not None else False))
+        return _percentile_mean(self.ys[:, region])
+
+    @property
+    @utilities.once
+    def baseline_pre(self):
+        before = self.params.baseline_before
+        if before is None:
+            return vartype.vartype.array([vartype.vartype.nan] * len(self))
+        return _percentile_mean(self.ys[:, self.x < before])
+
+    @property
+    @utilities.once
+    def baseline_post(self):
+        after = self.params.baseline_after
+        if after is None:
+            return vartype.vartype.array([vartype.vartype.nan] * len(self))
+        return _percentile_mean(self.ys[:, self.x > after])
+
+    @property
+    @utilities.once
+    def steady(self):
+        region = (self.x > self.params.steady_after) & (self.x < self.params.steady_before)
+        data = self.ys[:, region]
+        cutoff = np.percentile(data, self.params.steady_cutoff, axis=1)
+        return _cut_mean(data, data <= cutoff[:, None])
+
+    @property
+    @utilities.once
+    def response(self):
+        return vartype.array_sub(self.steady, self.baseline)
+
+    @property
+    @utilities.once
+    def spike_i_and_threshold(self):
+        peaks = detect.detect_peaks_batch(self.ys, P_low=0.75, P_high=0.50)
+        return [_find_spikes(self._wave(i), peaks=peaks[i])
+                for i in range(len(self))]
+
+    @property
+    def spike_count(self):
+        return np.array([len(found.peaks) for found in self.spike_i_and_threshold])
+
+    @property
+    @utilities.once
+    def falling_curve(self):
+        return [_find_falling_curve(self._wave(i),
+                                    window=self.params.falling_curve_window,
+                                    after=self.params.injection_start,
+                                    before=self.params.steady_before)
+                for i in range(len(self))]
+
+    @property
+    @utilities.once
+    def falling_curve_fit(self):
+        return _fit_falling_curves(self.falling_curve,
+                                   [_vartype_row(self.baseline, i) for i in range(len(self))],
+                                   [_vartype_row(self.steady, i) for i in range(len(self))],
+                                   fast=FallingCurve.fast_fit)
+
+    @property
+    @utilities.once
+    def rectification(self):
+        return vartype.vartype.array(
+            [_rectification(ccut, _vartype_row(self.steady, i), Rectification.window_len)
+             for i, ccut in enumerate(self.falling_curve)])
+
+    @property
+    @utilities.once
+    def charging_curve_halfheight(self):
+        first = np.array([found.thresholds[0] if found.peaks.size else np.nan
+                          for found in self.spike_i_and_threshold])
+        baseline = self.baseline
+        dev = np.where(np.isnan(first), np.nan, baseline.dev / 2)
+        return np.rec.fromarrays(((first - baseline.x) / 2, dev), names='x,dev')
+
+    _installed = {
+        'baseline': SteadyState,
+        'baseline_pre': SteadyState,
+        'baseline_post': SteadyState,
+        'steady': SteadyState,
+        'response': SteadyState,
+        'spike_i_and_threshold': Spikes,
+        'falling_curve_fit': FallingCurve,
+        'rectification': Rectification,
+        'charging_curve_halfheight': ChargingCurve,
+    }
+
+    def install(self, waves, names=None):
+        """Store the values in the feature objects of waves
+
+        waves must correspond to the rows of ys. Only values which
+        have not been computed yet for a trace are set. names limits
+        the attributes which are computed and stored.
+        """
+        for name in (names or self._installed):
+            values = getattr(self, name)
+            cls = self._installed[name]
+            for i, wave in enumerate(waves):
+                obj = _feature_object(wave, cls)
+                attr = '_{}_value'.format(name)
+                if obj is None or hasattr(obj, attr):
+                    continue
+                value = values[i]
+                if isinstance(values, np.recarray):
+                    value = _vartype_row(values, i)
+                setattr(obj, attr, value)
+
+def _feature_object(wave, cls):
+    return next((obj for obj in wave._attributes.values() if isinstance(obj, cls)),
+                None)
+
+def _computed(wave, names):
+    for name in names:
+        obj = _feature_object(wave, BatchFeatures._installed[name])
+        if obj is not None and not hasattr(obj, '_{}_value'.format(name)):
+            return False
+    return True
+
+def precompute(waves, names=None):
+    """Compute the features of waves in batches and install them
+
+    Traces are grouped by time base and measurement parameters, and a
+    :class:`BatchFeatures` is used for each group. Traces for which
+    all the values are known already are skipped.
+    """
+    names = names or tuple(BatchFeatures._installed)
+    groups = {}
+    for wave in waves:
+        params = wave._attributes.get('baseline_before')
+        if params is None or _computed(wave, names):
+            continue
+        key = id(params), wave.wave.x.tobytes()
+        groups.setdefault(key, (params, []))[1].append(wave)
+
+    for params, group in groups.values():
+        x = group[0].wave.x
+        ys = np.array([wave.wave.y for wave in group])
+        try:
+            BatchFeatures(x, ys, params).install(group, names=names)
+        except Exception as e:
+            # the traces will be processed one by one when needed
+            logger.warning('batch feature extraction failed: {}'.format(e))
+
+def fingerprint(features):
+    """A description of the feature set, used to validate snapshots
+
+    Includes the names of the feature classes and the values of
+    attributes supplied by other providers (the measurement parameters),
+    since those change what the features compute.
+    """
+    parts = []
+    for feature in features:
+        if isinstance(feature, Feature) or (isinstance(feature, type) and
+                                            issubclass(feature, Feature)):
+            cls = feature if isinstance(feature, type) else type(feature)
+            parts.append(cls.__module__ + '.' + cls.__qualname__)
+        else:
+            parts.extend('{}={!r}'.format(name, getattr(feature, name))
+                         for name in getattr(feature, 'provides', ()))
+    return tuple(parts)
+
+def _snapshot_value(wave, value):
+    if isinstance(value, (WaveRegion, WaveRegions)):
+        return False
+    if (isinstance(value, (list, tuple)) and
+        any(isinstance(item, WaveRegion) for item in value)):
+        return False
+    if isinstance(value, np.ndarray) and np.may_share_memory(value, wave):
+        # a slice of the trace, cheap to recreate and big to store
+        return False
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return False
+    return True
+
+def snapshot(waves):
+    """Return the feature values which were already computed for waves
+
+    The result is a dict {injection: {feature class name: {attr: value}}}
+    with the values cached by :func:`utilities.once`. Wave regions and
+    slices of the trace are skipped. Use :func:`restore` to put the
+    values back into freshly loaded waves.
+    """
+    values = {}
+    for wave in waves:
+        per_wave = values[float(wave.injection)] = {}
+        for obj in set(wave._attributes.values()):
+            if not isinstance(obj, Feature):
+                continue
+            cached = {name[1:-6]:value
+                      for name, value in vars(obj).items()
+                      if name.startswith('_') and name.endswith('_value')
+                      and _snapshot_value(wave.wave, value)}
+            if cached:
+                per_wave[type(obj).__name__] = cached
+    return values
+
+def restore(waves, values):
+    "Set the feature values in waves from a :func:`snapshot`"
+    for wave in waves:
+        per_wave = values.get(float(wave.injection))
+        if per_wave is None:
+            continue
+        for obj in set(wave._attributes.values()):
+            cached = per_wave.get(type(obj).__name__)
+            if cached is None or not isinstance(obj, Feature):
+                continue
+            for name, value in cached.items():
+                setattr(obj, '_{}_value'.format(name), value)
@@ -42,19 +42,90 @@ def sub_mes_dev(reca, recb):
     else:
         return reca - recb
 
+# Conditions on the matched pairs of waves: each function gets a, b and
+# the indices of the waves of a and b in the pairs, and returns a mask
+# over the pairs.
+FILTERS = {
+    'low_injection': lambda a, b, i, j: b.injection[j] <= 110e-12,
+    'negative_injection': lambda a, b, i, j: b.injection[j] <= -10e-12,
+    'positive_injection': lambda a, b, i, j: b.injection[j] > 0,
+    'one_spike': lambda a, b, i, j: b.spike_count[j] >= 1,
+    'two_spikes': lambda a, b, i, j: b.spike_count[j] >= 2,
+    'any_spikes': lambda a, b, i, j: a.spike_count[i] + b.spike_count[j] > 0,
+}
+
+class Alignment(object):
+    """The pairs of waves of a and b with the same injection
+
+    The pairs are found once. Selections of pairs with one of the
+    named FILTERS are remembered, together with the aggregated
+    attributes of the selected waves, so that the fitness functions
+    combined in combined_fitness share them.
+    """
+    def __init__(self, a, b):
+        self.a, self.b = a, b
+        self.b_waves = b.waves
+        fitting = np.abs(a.injection[:,None] - b.injection) < 1e-12
+        logger.debug("{}".format(fitting))
+        self.ind1, self.ind2 = np.where(fitting)
+        logger.debug("{} {}".format(self.ind1, self.ind2))
+        self._selections = {}
+
+    def matches(self, b):
+        return b is self.b and b.waves is self.b_waves
+
+    def select(self, which=None):
+        """Return the copies of a and b with the pairs passing which
+
+        which is None, the name of one of FILTERS, or a boolean
+        array over the waves of b.
+        """
+        key = which if which is None or isinstance(which, str) else False
+        if key is not False and key in self._selections:
+            return self._selections[key]
+
+        ind1, ind2 = self.ind1, self.ind2
+        if isinstance(which, str):
+            keep = np.asarray(FILTERS[which](self.a, self.b, ind1, ind2), dtype=bool)
+            ind1, ind2 = ind1[keep], ind2[keep]
+        elif which is not None:
+            keep = np.asarray(which)[ind2]
+            ind1, ind2 = ind1[keep], ind2[keep]
+        ans = self.a[ind1], self.b[ind2]
+
+        if key is not False:
+            self._selections[key] = ans
+        return ans
+
+def alignment(a, b):
+    """Return the Alignment of a with b
+
+    It is kept in the cache of aggregated attributes of a, so it is
+    dropped together with them when the waves of a change. Only the
+    alignment with the last b is kept, since spike_time_fitness also
+    aligns the measurement with each simulation.
+    """
+    cache = a._aggregates() if hasattr(a, '_aggregates') else {}
+    align = cache.get(Alignment)
+    if align is None or not align.matches(b):
+        align = cache[Alignment] = Alignment(a, b)
+    return align
+
 def _select(a, b, which=None):
     ''' a -> sim, b -> measurments and which -> filter condition
         Note:- If filter condtion is not satisfied by any of the value, when indexed
                will return a nan.'''
-    if which is not None:
-        bsel = b[which]
-    else:
-        bsel = b
-    fitting = np.abs(a.injection[:,None] - bsel.injection) < 1e-12
-    logger.debug("{}".format(fitting))
-    ind1, ind2 = np.where(fitting)
-    logger.debug("{} {}".format(ind1, ind2))
-    return a[ind1], bsel[ind2]
+    return alignment(a, b).select(which)
+
+def targets(*names):
+    """Declare the attributes of the measurement a fitness function uses
+
+    See :attr:`combined_fitness.targets`.
+    """
+    def decorator(func):
+        func.targets = names
+        return func
+    return decorator
 
 def relative_diff_single(a, b, extra=0):
     x = getattr(a, 'x', a)
@@ -110,53 +181,62 @@ def _evaluate_single(a, b, error=ErrorCalc.relative):
     else:
         return ans
 
+@targets('response')
 def response_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     "Similarity of response to hyperpolarizing injection"
-    m1, m2 = _select(sim, measurement, measurement.injection <= 110e-12)
+    m1, m2 = _select(sim, measurement, 'low_injection')
     return _evaluate(m1.response, m2.response, error=error)
 
+@targets('baseline')
 def baseline_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     "Similarity of baselines"
     m1, m2 = _select(sim, measurement)
     return _evaluate(m1.baseline, m2.baseline, error=error)
 
+@targets('baseline_pre')
 def baseline_pre_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     "Similarity of baselines"
     m1, m2 = _select(sim, measurement)
     return _evaluate(m1.baseline_pre, m2.baseline_pre, error=error)
 
+@targets('baseline_post')
 def baseline_post_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     "Similarity of baselines"
     m1, m2 = _select(sim, measurement)
     return _evaluate(m1.baseline_post, m2.baseline_post, error=error)
 
+@targets('rectification')
 def rectification_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.injection <= -10e-12)
+    m1, m2 = _select(sim, measurement, 'negative_injection')
     return _evaluate(m1.rectification, m2.rectification, error=error)
 
 #This should be calculated for positive current injection, even if no spike.  Maybe only if no spike
+@targets('charging_curve_halfheight')
 def charging_curve_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.injection > 0)
+    m1, m2 = _select(sim, measurement, 'positive_injection')
     if len(m2) == 0:
         return vartype.vartype.nan
     return _evaluate(m1.charging_curve_halfheight, m2.charging_curve_halfheight,
                      error=error)
 
 #alternatively, could do falling curve for positive current injection if no spike
+@targets('falling_curve_tau')
 def falling_curve_time_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.injection <= -10e-12)
+    m1, m2 = _select(sim, measurement, 'negative_injection')
     if len(m2) == 0:
         return vartype.vartype.nan
     return _evaluate(m1.falling_curve_tau, m2.falling_curve_tau, error=error)
 
+@targets('spike_count', 'mean_isi')
 def mean_isi_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.spike_count >= 2)
+    m1, m2 = _select(sim, measurement, 'two_spikes')
     if len(m2) == 0:
         return vartype.vartype.nan
     return _evaluate(m1.mean_isi, m2.mean_isi, error=error)
 
+@targets('spike_count', 'isi_spread')
 def isi_spread_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.spike_count >= 2)
+    m1, m2 = _select(sim, measurement, 'two_spikes')
     if len(m2) == 0:
         return vartype.vartype.nan
     return _evaluate(m1.isi_spread, m2.isi_spread, error=error)
@@ -169,10 +249,11 @@ def _measurement_to_spikes(meas):
         frame.set_index(['index', 'injection'], inplace=True)
     return pd.concat(frames)
 
+@targets('spike_count', 'spikes')
 def spike_time_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.spike_count >= 2)
+    m1, m2 = _select(sim, measurement, 'two_spikes')
     if len(m1) == 0:
-        m1, m2 = _select(measurement, sim, sim.spike_count >= 2)
+        m1, m2 = _select(measurement, sim, 'two_spikes')
         if len(m1) == 0:
             # neither is spiking, cannot determine spike timing
             return np.nan
@@ -186,24 +267,29 @@ def spike_time_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     spikes2.fillna(sim[0].injection_interval, inplace=True)
     return _evaluate(spikes1['x'], spikes2['x'], error=error)
 
+@targets('spike_count')
 def spike_count_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     m1, m2 = _select(sim, measurement)
     return _evaluate(m1.spike_count, m2.spike_count, error=error)
 
+@targets('spike_count', 'spike_latency')
 def spike_latency_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.spike_count >= 1)
+    m1, m2 = _select(sim, measurement, 'one_spike')
     return _evaluate(m1.spike_latency, m2.spike_latency, error=error)
 
+@targets('spike_width')
 def spike_width_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     return _evaluate_single(sim.mean_spike_width, measurement.mean_spike_width,
                             error=error)
 
+@targets('spike_height')
 def spike_height_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     return _evaluate_single(sim.mean_spike_height, measurement.mean_spike_height,
                             error=error)
 
+@targets('spike_count', 'spike_ahp')
 def spike_ahp_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.spike_count >= 1)
+    m1, m2 = _select(sim, measurement, 'one_spike')
 
     # Just ignore any extra spikes. Let's assume that most spikes
     # and AHPs are similar, and that we're using a different fitness
@@ -253,11 +339,11 @@ def _pick_spikes(wave1, wave2):
     else:
         return np.linspace(0, n-1, 10, dtype=int)
 
+@targets('spike_count', 'spike_ahp_window', 'spike_ahp', 'spike_ahp_position')
 def ahp_curve_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     ''' Calculates
     '''
-    m1, m2 = _select(sim, measurement,
-                     sim.spike_count + measurement.spike_count > 0)
+    m1, m2 = _select(sim, measurement, 'any_spikes')
 
     diffs = [ahp_curve_compare(ahp_curve_centered(wave1, i),
                                ahp_curve_centered(wave2, i))
@@ -349,6 +435,7 @@ class WaveHistogram:
         figure.tight_layout()
         return ax1, ax2
 
+@targets('spike_count', 'wave')
 def spike_range_y_histogram_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     """Match histograms of y-values in spiking regions
 
@@ -374,6 +461,8 @@ def spike_range_y_histogram_fitness(sim, measurement, full=False, error=ErrorCal
         return vartype.array_rms(diffs, nan_replacement=NAN_REPLACEMENT)
 
 # Used in work-aju.py somebody might use this.
+@targets('response', 'baseline_pre', 'baseline_post', 'rectification',
+         'falling_curve_tau', 'spike_count')
 def hyperpol_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     a = response_fitness(sim, measurement, error=error)
     b1 = baseline_pre_fitness(sim, measurement, error=error)
@@ -390,6 +479,8 @@ def hyperpol_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     else:
         return vartype.array_rms(arr, nan_replacement=NAN_REPLACEMENT)
 
+@targets('spike_count', 'mean_isi', 'spike_latency', 'spike_width',
+         'spike_height', 'spike_ahp', 'spikes')
 def spike_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     a = mean_isi_fitness(sim, measurement, error=error)
     b = spike_latency_fitness(sim, measurement, error=error)
@@ -481,6 +572,21 @@ class combined_fitness:
             raise ValueError('"known" function specified in extra')
         self.pairs = pairs1 + pairs2
 
+    @property
+    def targets(self):
+        """The attributes of the measurement used by the fitness functions
+
+        None if one of the functions does not declare them with
+        :func:`targets`.
+        """
+        names = set()
+        for w, func in self.pairs:
+            func_targets = getattr(func, 'targets', None)
+            if func_targets is None:
+                return None
+            names.update(func_targets)
+        return names
+
     def _parts(self, sim, measurement, *, full=False):
         for w, func in self.pairs:
             if w or full:
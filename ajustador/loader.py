@@ -99,6 +99,9 @@ class IVCurve(Trace):
            -0.08034375, -0.08034375], dtype=float32)
     """
 
+    # the reason, for simulations stopped early (see optimize.load_simulation)
+    aborted = None
+
     def __init__(self, filename, fileinfo, injection, x, y, features):
         super().__init__(injection, x, y, features)
 
@@ -152,27 +155,57 @@ class Attributable(object):
             raise AttributeError(attr)
 
         if not attr.startswith('_') and attr in getattr(self, '_array_attributes', {}):
-            arr = [getattr(wave, attr) for wave in self.waves]
-            if not arr:
-                return np.empty(0)
-            if isinstance(arr[0], vartype):
-                return vartype.array(arr)
-            if isinstance(arr[0], np.recarray):
-                return recfunctions.stack_arrays(arr, asrecarray=True, usemask=False)
-            if isinstance(arr[0], np.ndarray):
-                return np.hstack(arr)
-            return np.array(arr)
+            cache = self._aggregates()
+            if attr not in cache:
+                value = self._aggregate(attr)
+                if isinstance(value, np.ndarray):
+                    # the value is shared by all later reads
+                    value.flags.writeable = False
+                cache[attr] = value
+            return cache[attr]
 
         if attr.startswith('mean_') and attr[5:] in getattr(self, '_mean_attributes', {}):
-            values = self.__getattr__(attr[5:])
-            return vartype.average(values)
+            cache = self._aggregates()
+            if attr not in cache:
+                cache[attr] = vartype.average(self.__getattr__(attr[5:]))
+            return cache[attr]
 
         raise AttributeError('{} object does not have {} attribute'.format(
             self.__class__.__name__, attr))
 
+    def _aggregates(self):
+        """The cache of aggregated attributes
+
+        The cache belongs to one array of waves, and is replaced when
+        .waves is set to something else.
+        """
+        waves = self.waves
+        cache = self.__dict__.get('_aggregates_value')
+        if cache is None or cache[0] is not waves:
+            cache = self._aggregates_value = (waves, {})
+        return cache[1]
+
+    def _aggregate(self, attr):
+        arr = [getattr(wave, attr) for wave in self.waves]
+        if not arr:
+            return np.empty(0)
+        if isinstance(arr[0], vartype):
+            return vartype.array(arr)
+        if isinstance(arr[0], np.recarray):
+            return recfunctions.stack_arrays(arr, asrecarray=True, usemask=False)
+        if isinstance(arr[0], np.ndarray):
+            return np.hstack(arr)
+        return np.array(arr)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_aggregates_value', None)
+        return state
+
     def __getitem__(self, index):
         if isinstance(index, (slice, np.ndarray, list)):
             c = copy.copy(self)
+            c.__dict__.pop('_aggregates_value', None)
             c.waves = self.waves[index]
             return c
         else:
@@ -215,6 +248,55 @@ class Measurement(Attributable):
         return '<{} {}>'.format(self.__class__.__name__, self.name)
 
 
+class FrozenTrace(object):
+    """The values of some attributes of a trace
+
+    Arrays are copied and made read-only, and no attributes can be
+    set, so the values stay as they were computed. Only the waveform
+    is dropped unless 'wave' is one of the names.
+    """
+    def __init__(self, trace, names):
+        values = {}
+        for name in names:
+            value = getattr(trace, name)
+            if isinstance(value, np.ndarray):
+                value = value.copy()
+            values[name] = value
+        self.__setstate__(dict(_values=values))
+
+    def __setstate__(self, state):
+        # the flags of arrays are not pickled
+        for value in state['_values'].values():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+        self.__dict__.update(state)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_values'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} object is read-only'.format(self.__class__.__name__))
+
+
+class FrozenMeasurement(Measurement):
+    """A measurement reduced to the values of the given attributes
+
+    The values are computed once, when the object is created, and
+    the object can be pickled cheaply. It is used in place of the
+    measurement by :class:`ajustador.optimize.Fit`, see
+    :attr:`ajustador.fitnesses.combined_fitness.targets`.
+    """
+    def __init__(self, measurement, names):
+        params, *features = measurement.features
+        super().__init__(measurement.dirname, params, features=features)
+
+        names = sorted(set(names) | {'injection'})
+        self.waves = np.array([FrozenTrace(wave, names) for wave in measurement.waves])
+
+
 class IVCurveSeries(Measurement):
     """Load a series of recordings from a directory
 
@@ -1,4 +1,5 @@
 import math
+import time
 import types
 import collections
 import itertools
@@ -10,14 +11,17 @@ import shutil
 import subprocess
 import glob
 import re
+import decimal
+import numbers
 import pickle
-import multiprocessing
+import sqlite3
 
 import numpy as np
 import cma
 
 # _features holds all feature classes.
-from . import loader, features as _features, fitnesses, utilities 
+from . import (loader, features as _features, fitnesses, utilities, executors, storage,
+               surrogate as _surrogate)
 
 from ajustador.helpers.loggingsystem import getlogger #SRIRAM 02152018
 import logging
@@ -28,18 +32,19 @@ def filtereddict(**kwargs):
     return dict((k,v) for (k,v) in kwargs.items() if v is not None)
 
 
-_exe = None
 def exe_map(single=False, async=False):
+    """Return a map function, running in the current executor unless single
+
+    The executor is chosen with :func:`executors.set_executor`.
+    """
     if single and not async:
         return map
     else:
-        global _exe
-        if _exe is None:
-            _exe = multiprocessing.Pool(multiprocessing.cpu_count() * 1)
+        exe = executors.get_executor()
         if async:
-            return _exe.map_async
+            return exe.map_async
         else:
-            return _exe.map
+            return exe.map
 
 def iv_filename(injection_current):
     return 'ivdata-{}.npy'.format(injection_current)
@@ -50,42 +55,222 @@ def iv_filename_to_current(ivfile):
     return injection_current
 
 def execute(p):
+    """Simulate a group of injections and load the results
+
+    All injections in the group are simulated by a single
+    basic_simulation run, so the model is only built once for them.
+    A list of :class:`loader.IVCurve` objects is returned.
+
+    options is a dict of execution options:
+
+    - warm: run the simulation in a fork of the calling worker process
+      (see :func:`basic_simulation.fork_main`), so imports are paid once
+      per worker and not once per injection. Otherwise, a new python
+      interpreter is started for every call.
+    - snapshot: simulate the part before the injection once for the
+      whole group (see :func:`basic_simulation.run_branched_simulations`).
+      The injections are then simulated one after another, and no hdf5
+      output is written.
+    - copies: simulate the whole group at once in copies of the neuron
+      (see :func:`basic_simulation.run_copies_simulation`).
+    - cache: a :class:`storage.SimulationCache`. Injections found in the
+      cache are not simulated, and new results are added to it. The
+      abort criteria and the trace format are part of the cache key.
+    - abort: a dict of criteria to stop hopeless simulations early, e.g.
+      dict(max_spikes=100, block_time=0.1), passed to basic_simulation as
+      the corresponding --abort-* options.
+    - trace_format: a dict of the storage format of the traces, e.g.
+      dict(dtype='float32', dt=1e-4, encoding='delta-zlib'), passed to
+      basic_simulation as the corresponding --save-vm-* options.
+    """
     from . import basic_simulation
-    dirname, injection, junction_potential, params, features = p
+    dirname, injections, junction_potential, params, features, options = p
+    params = dict(params)
     simtime = params['simtime']
-    logger.debug("Unseralized params:\n {} inject {}".format(params,injection)) #SRIRAM 02192018
+    logger.debug("Unseralized params:\n {} inject {}".format(params,injections)) #SRIRAM 02192018
     params['injection_delay'] = params['injection_delay'][0] #SRIRAM 02192018
     params['injection_width'] = params['injection_width'][0] #SRIRAM 02192018
-    params = basic_simulation.serialize_options(params)
-    result = iv_filename(injection) #result is filename
+
+    cache = options.get('cache')
+    with utilities.chdir(dirname):
+        if cache is not None:
+            morph = basic_simulation.morph_file_contents(params)
+            keyparams = _cache_params(params, options)
+            keys = {injection:cache.key(keyparams, injection, morph)
+                    for injection in injections}
+            missing = [injection for injection in injections
+                       if not cache.fetch(keys[injection], iv_filename(injection))]
+        else:
+            missing = injections
+
+        if missing:
+            _run_basic_simulation(missing, params, options)
+            if cache is not None:
+                for injection in missing:
+                    # aborted traces depend on the criteria, do not reuse them
+                    if not os.path.exists(iv_filename(injection) + '.aborted'):
+                        cache.store(keys[injection], iv_filename(injection))
+
+        ivs = [load_simulation(iv_filename(injection),
+                               simtime=simtime,
+                               junction_potential=junction_potential,
+                               features=features)
+               for injection in injections]
+    return ivs
+
+def _cache_params(params, options):
+    """Add the options which change the saved traces to params
+
+    A trace which was simulated in full without abort criteria would
+    have been aborted with them, so the criteria are part of the cache
+    key, like the storage format.
+    """
+    extra = {}
+    for name in ('trace_format', 'abort'):
+        value = tuple(sorted((key, float(value) if isinstance(value, numbers.Real) else value)
+                             for key, value in (options.get(name) or {}).items()))
+        if value:
+            extra[name] = value
+    return dict(params, **extra) if extra else params
+
+def _run_basic_simulation(injections, params, options):
+    from . import basic_simulation
+    args = basic_simulation.serialize_options(params)
+    if len(injections) == 1:
+        inject = ['-i={}'.format(injections[0])]
+        save = iv_filename(injections[0])
+    else:
+        inject = ['-i'] + [_current_argument(injection) for injection in injections]
+        save = iv_filename('{}')
+        if options.get('snapshot'):
+            inject.append('--snapshot')
+        elif options.get('copies'):
+            inject.append('--copies')
+    abort = ['--abort-{}={}'.format(key.replace('_', '-'), value)
+             for key, value in sorted((options.get('abort') or {}).items())]
+    abort += ['--save-vm-{}={}'.format(key, value)
+              for key, value in sorted((options.get('trace_format') or {}).items())
+              if value is not None]
     cmdline = [sys.executable,
                basic_simulation.__file__,
-               '-i={}'.format(injection),
-               '--save-vm={}'.format(result),
-    ] + params
+               *inject,
+               '--save-vm={}'.format(save),
+               *abort,
+    ] + args
     print('+', ' '.join(shlex.quote(term) for term in cmdline), flush=True)
     #logger.debug("Seralized params:\n {}".format(params))
     logger.debug("Basic_simulation command:\n {}".format(cmdline))
-    with utilities.chdir(dirname):
+    if options.get('warm') and hasattr(os, 'fork'):
+        basic_simulation.fork_main(cmdline[2:])
+    else:
         subprocess.check_call(cmdline)
-        iv = load_simulation(result,
-                             simtime=simtime,
-                             junction_potential=junction_potential,
-                             features=features)
-    return iv
+
+def _current_argument(injection):
+    # argparse takes '-1e-10' for an option and only accepts negative
+    # numbers without an exponent, so the exact value is written out
+    return format(decimal.Decimal(repr(float(injection))), 'f')
 
 def load_simulation(ivfile, simtime, junction_potential, features):
+    """Load the trace saved by basic_simulation
+
+    If the simulation was aborted, the trace only covers the simulated
+    part, and the .aborted attribute of the result is set to the reason.
+    """
     injection_current = iv_filename_to_current(ivfile)
-    voltage = np.load(ivfile)
-    x = np.linspace(0, float(simtime), voltage.size)
+    voltage, dt = storage.load_trace(ivfile)
+    aborted = None
+    if os.path.exists(ivfile + '.aborted'):
+        with open(ivfile + '.aborted') as f:
+            aborted = f.read()
+    return _ivcurve(injection_current, voltage, simtime, junction_potential, features,
+                    aborted=aborted, dt=dt)
+
+def _ivcurve(injection_current, voltage, simtime, junction_potential, features,
+             aborted=None, dt=None):
+    # aborted is the contents of the .aborted marker
+    if aborted is not None:
+        endtime, aborted = aborted.strip().split(' ', 1)
+        simtime = endtime
+    if dt is not None:
+        x = np.arange(voltage.size) * dt
+    else:
+        x = np.linspace(0, float(simtime), voltage.size)
     logger.debug("type of voltage {} type of junction_potential {}".format(type(voltage),
                                                                            type(junction_potential)))
     iv = loader.IVCurve(None, None,
                         injection=injection_current,
                         x=x, y=voltage - float(junction_potential),
                         features=features)
+    iv.aborted = aborted
     return iv
 
+FEATURES_FILE = 'features.pickle'
+
+def save_features(dirname, features, waves, snapshot=None):
+    """Store the feature values computed for waves in dirname
+
+    See :func:`features.snapshot`. The snapshot is stored together with
+    the injections of waves, and is only restored into the same set of
+    injections. The file is replaced atomically, so that readers never
+    see a partial snapshot. snapshot is the result of
+    :func:`features_snapshot`, if it was already computed.
+    """
+    if snapshot is None:
+        snapshot = features_snapshot(features, waves)
+    path = os.path.join(dirname, FEATURES_FILE)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(snapshot, f)
+    os.replace(tmp, path)
+
+def features_snapshot(features, waves):
+    "Return the feature values of waves, as stored by :func:`save_features`"
+    return _features.fingerprint(features), _injections(waves), _features.snapshot(waves)
+
+def _injections(waves):
+    return tuple(sorted(float(wave.injection) for wave in waves))
+
+def _snapshot_keys(values):
+    # the feature values present in a snapshot
+    return frozenset((injection, name, attr)
+                     for injection, per_wave in values.items()
+                     for name, cached in per_wave.items()
+                     for attr in cached)
+
+def _read_features(dirname):
+    path = os.path.join(dirname, FEATURES_FILE)
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning('cannot load {}: {}'.format(path, e))
+        return None
+
+def restore_features(snapshot, features, waves):
+    """Restore the feature values from a :func:`features_snapshot`
+
+    Returns False if it was made with different features or measurement
+    parameters, or for different injections.
+    """
+    fingerprint, injections, values = snapshot
+    if (fingerprint != _features.fingerprint(features) or
+        injections != _injections(waves)):
+        return False
+    _features.restore(waves, values)
+    return True
+
+def load_features(dirname, features, waves):
+    """Restore the feature values saved with :func:`save_features`
+
+    Returns False if there is no snapshot, or if it was made with
+    different features or measurement parameters, or for different
+    injections.
+    """
+    snapshot = _read_features(dirname)
+    return snapshot is not None and restore_features(snapshot, features, waves)
+
 
 class Simulation(loader.Attributable):
     def __init__(self, dir, *, params, features):
@@ -99,6 +284,8 @@ class Simulation(loader.Attributable):
         logger.debug("Logger in Simulation!!!") #SRIRAM 02192018
         logger.debug("Params of simulation\n {}".format(self.name)) #SRIRAM 02192018
 
+        self._result = None
+        self._created = time.time()
         self.tmpdir = utilities.TemporaryDirectory(dir=dir)
         # print("Directory {} created".format(self.tmpdir.name))
 
@@ -118,6 +305,27 @@ class Simulation(loader.Attributable):
         if self._result is not None:
             self._result.wait()
 
+    def ready(self):
+        "Return True if the simulation has finished, without blocking"
+        return self._result is None or self._result.ready()
+
+    def _mark_complete(self, injections=()):
+        "Tag the directory as complete and add it to the manifest of the fit"
+        tag = os.path.join(self.tmpdir.name, '.complete')
+        open(tag, 'w').close()
+
+        dirname, name = os.path.split(self.tmpdir.name)
+        try:
+            storage.Manifest(dirname).add(name, self.params, injections,
+                                          created=self._created)
+        except sqlite3.Error as e:
+            logger.warning('cannot add {} to the manifest: {}'.format(name, e))
+
+def _baseline_aborted(waves):
+    "Return True if any of waves was aborted because of its baseline"
+    return any((getattr(wave, 'aborted', None) or '').startswith('baseline')
+               for wave in waves)
+
 class MooseSimulation(Simulation):
     def __init__(self, dir,
                  currents=None,
@@ -126,27 +334,153 @@ class MooseSimulation(Simulation):
                  injection_delay,    #SRIRAM add injection width and delay here.
                  injection_width,  #SRIRMA add injection_interval
                  morph_file=None,
+                 simdt=None,
                  single=False,
                  async=False,
+                 warm=True,
+                 multi_injection=False,
+                 snapshot=False,
+                 copies=False,
+                 cache=None,
+                 abort=None,
+                 source=None,
+                 planned=None,
+                 archive=False,
+                 trace_format=None,
                  features=None,
                  params):
-
+        """source is a MooseSimulation with the same physics parameters.
+        If given, its traces are reused, and only the post-processing
+        parameters are applied again.
+
+        planned is the list of all currents which will be simulated,
+        if only some of them are given in currents and the rest will be
+        added with :meth:`add_currents`. The simulation is marked as
+        complete on disk once all planned currents are done.
+
+        With archive=True, the results are appended to the
+        :class:`storage.ResultArchive` of the fit directory once complete,
+        and the simulation directory is removed.
+
+        trace_format is a dict of the storage format of the traces, see
+        :func:`execute`. dt='measurement' is replaced by the sampling
+        interval of the measurement in :meth:`make`.
+
+        copies=True cannot be combined with abort, because the abort
+        criteria are not checked when the copies are simulated together.
+        The baseline in abort is the one of the measurement. The traces
+        are compared to it after junction_potential is subtracted, so
+        the worker is given baseline + junction_potential to check the
+        simulated voltage against.
+        """
+        if copies and abort:
+            raise ValueError('abort criteria cannot be used with copies=True')
         junction_potential = params['junction_potential'].value # FIXME: nicer syntax?
+        if abort and abort.get('baseline') is not None:
+            abort = dict(abort, baseline=abort['baseline'] + float(junction_potential))
+        params = dict(params.items())
+        if morph_file is not None:
+            params['morph_file'] = morph_file
         params = filtereddict(simtime=simtime,
+                              simdt=simdt,
                               injection_delay=injection_delay,   #SRIRAM 02192018
                               injection_width=injection_width,   #SRIRAM 02192018
-                              **dict(params.items()))
+                              **params)
         super().__init__(dir, params=params, features=features)
-
-        if currents is None:
+        self.warm = warm
+        self.multi_injection = multi_injection
+        self.snapshot = snapshot
+        self.copies = copies
+        self.cache = cache
+        self.abort = abort
+        self.archive = archive
+        self.trace_format = trace_format
+        self._source = source
+        self._junction_potential = junction_potential
+        self.planned = tuple(planned if planned is not None else
+                             currents if currents is not None else ())
+
+        if source is not None:
+            logger.debug("reusing the traces of {}".format(source.tmpdir.name))
+            self._result = source._result
+            if source.ready():
+                self._derive_result(async=async)
+        elif currents is None:
             self.waves = np.array([], dtype=object)
         else:
             print("Simulating{} at {} points".format(" asynchronously" if async else "", len(currents)))
             self.execute_for(currents, junction_potential, single, async=async)
 
+    def wait(self):
+        super().wait()
+        if self._source is not None:
+            self._derive_result()
+
+    def ready(self):
+        ans = super().ready()
+        if ans and self._source is not None:
+            self._derive_result(async=True)
+            ans = super().ready()
+        return ans
+
+    def _derive_result(self, async=False):
+        # Shift the traces of the source by the difference in
+        # junction_potential, and link its trace files, so that the
+        # results can be loaded from this directory later.
+        source, self._source = self._source, None
+        source.wait()
+        if _baseline_aborted(source.waves):
+            # the baseline was checked with the junction_potential of the
+            # source, it might be fine with this one
+            logger.debug("not reusing the traces of {}, aborted on the baseline"
+                         .format(source.tmpdir.name))
+            self._result = None
+            self.execute_for([wave.injection for wave in source.waves],
+                             self._junction_potential, False, async=async)
+            return
+        shift = float(source._junction_potential) - float(self._junction_potential)
+        for ivfile in glob.glob(os.path.join(source.tmpdir.name, 'ivdata-*')):
+            target = os.path.join(self.tmpdir.name, os.path.basename(ivfile))
+            try:
+                os.link(ivfile, target)
+            except OSError:
+                shutil.copyfile(ivfile, target)
+        waves = [loader.IVCurve(None, None,
+                                injection=wave.injection,
+                                x=wave.wave.x, y=wave.wave.y + shift,
+                                features=self.features)
+                 for wave in source.waves]
+        for wave, orig in zip(waves, source.waves):
+            wave.aborted = orig.aborted
+        self._set_result([waves])
+
+    def _injection_groups(self, injection_currents):
+        # With multi_injection all currents share a single model, otherwise
+        # each one is simulated separately, which parallelizes better.
+        # Branching from a snapshot or running copies of the neuron only
+        # makes sense within one model.
+        if self.multi_injection or self.snapshot or self.copies:
+            return [tuple(injection_currents)]
+        else:
+            return [(inj,) for inj in injection_currents]
+
+    def add_currents(self, currents, single=False, async=False):
+        "Simulate more injection currents, adding to the current waves"
+        self.wait()
+        print("Simulating{} at {} more points".format(" asynchronously" if async else "", len(currents)))
+        self.execute_for(currents, self._junction_potential, single, async=async)
+
+    def missing(self):
+        "Return the planned currents which were not simulated yet"
+        done = {wave.injection for wave in self.__dict__.get('waves', ())}
+        return [current for current in self.planned if current not in done]
+
     def execute_for(self, injection_currents, junction_potential, single, async):
-        params = ((self.tmpdir.name, inj, junction_potential, self.params, self.features)
-                  for inj in injection_currents)
+        options = dict(warm=self.warm, snapshot=self.snapshot, copies=self.copies,
+                       cache=self.cache, abort=self.abort,
+                       trace_format=self.trace_format)
+        params = ((self.tmpdir.name, group, junction_potential, self.params, self.features, options)
+                  for group in self._injection_groups(injection_currents))
         if async:
             logger.debug("MooseSimulation, Params in execute_for \n {}".format(params)) #SRIRAM
             self._result = exe_map(single=False, async=True)(execute, params, callback=self._set_result)
@@ -157,18 +491,52 @@ class MooseSimulation(Simulation):
             self._set_result(result)
 
     def _set_result(self, result):
-        self.waves = np.array(result, dtype=object)
+        waves = [iv for ivs in result for iv in ivs]
+        previous = self.__dict__.get('waves', ())
+        if len(previous):
+            # waves from earlier add_currents calls
+            waves.extend(previous)
+            waves.sort(key=operator.attrgetter('injection'))
+        self.waves = np.array(waves, dtype=object)
 
-        tag = os.path.join(self.tmpdir.name, '.complete')
-        open(tag, 'w').close()
+        if not self.missing():
+            self._mark_complete([wave.injection for wave in waves])
+            if self.archive:
+                self._archive_result()
+
+    def _archive_result(self):
+        dtype = (self.trace_format or {}).get('dtype')
+        traces = [(wave.injection,
+                   (wave.wave.y + float(self._junction_potential)).astype(dtype or float))
+                  for wave in self.waves]
+        aborted = {wave.injection: '{} {}'.format(wave.wave.x[-1], wave.aborted)
+                   for wave in self.waves if wave.aborted}
+        dt = {wave.injection: wave.wave.x[1] - wave.wave.x[0]
+              for wave in self.waves if self.trace_format and wave.wave.size > 1}
+        dirname, name = os.path.split(self.tmpdir.name)
+        storage.ResultArchive(dirname).append(name, self.params, traces,
+                                              aborted=aborted, dt=dt, created=self._created)
+        self.tmpdir.cleanup()
 
     @classmethod
-    def make(cls, *, dir, model, measurement, params):
+    def make(cls, *, dir, model, measurement, params, currents=None, planned=None,
+             **options):
+        """Create a simulation of the injections in measurement
+
+        If currents is given, only those are simulated at first, and the
+        rest of measurement.injection can be added with :meth:`add_currents`.
+        planned is the subset of measurement.injection after which the
+        simulation is complete, all of them by default.
+        """
         # A hack wrapper to push moose-specific stuff out from Fit
         simtime = measurement.waves[0].time
         injection_delay=measurement.features[0].injection_start,    #SRIRAM 02192018
         injection_width=measurement.features[0].injection_interval,  #SRIRAM 02192018
         baseline = measurement.mean_baseline.x
+        trace_format = options.get('trace_format')
+        if trace_format and trace_format.get('dt') == 'measurement':
+            wave = measurement.waves[0].wave
+            options['trace_format'] = dict(trace_format, dt=float(wave.x[1] - wave.x[0]))
         #logger.debug("Logger in MooseSimulation.make!!!") #SRIRAM
         logger.debug("Params \n {}".format(params))
 
@@ -178,25 +546,42 @@ class MooseSimulation(Simulation):
                    # neuron_type=,
                    injection_delay=injection_delay,    #SRIRAM 02192018
                    injection_width=injection_width,  #SRIRAM 02192018
-                   currents=measurement.injection,
+                   currents=measurement.injection if currents is None else currents,
+                   planned=measurement.injection if planned is None else planned,
                    simtime=simtime,
                    features=measurement.features,
-                   params=params)
+                   params=params,
+                   **options)
+
+def as_paramset(params):
+    """Convert the contents of params.pickle to a ParamSet
+
+    Simulations pickle a dict of names to Param objects or plain values.
+    Values which cannot be represented as a Param are skipped.
+    """
+    if isinstance(params, ParamSet):
+        return params
+    if not isinstance(params, dict):
+        return ParamSet(*params)
+    return ParamSet(*(value if isinstance(value, Param) else Param(name, value)
+                      for name, value in params.items()
+                      if isinstance(value, (Param, float, int, str))))
 
 class SimulationResult(loader.Attributable):
-    def __init__(self, dirname, features):
+    def __init__(self, dirname, features, params=None):
         self.name = os.path.basename(dirname)
 
         if not isinstance(features, (list, tuple)):
             features = [features, *_features.standard_features]
 
-        jar = os.path.join(dirname, 'params.pickle')
-        if os.path.exists(jar):
-            with open(jar, 'rb') as f:
-                params = pickle.load(f)
-        else:
-            params = {}
-        params = ParamSet(*params)
+        if params is None:
+            jar = os.path.join(dirname, 'params.pickle')
+            if os.path.exists(jar):
+                with open(jar, 'rb') as f:
+                    params = pickle.load(f)
+            else:
+                params = {}
+        params = as_paramset(params)
 
         super().__init__(features)
         self.features = features
@@ -204,8 +589,9 @@ class SimulationResult(loader.Attributable):
 
 
     def _param_str(self, sep=' '):
+        values = ((k, getattr(v, 'value', v)) for k, v in self.params.items())
         return sep.join(('{}={:.3g}' if isinstance(v, float) else '{}={}').format(k, v)
-                        for k, v in self.params.items())
+                        for k, v in values)
 
     def __repr__(self):
         return '{}({!r}, {})'.format(self.__class__.__name__, self.name,
@@ -230,21 +616,64 @@ class SimulationResult(loader.Attributable):
         pass
 
 class MooseSimulationResult(SimulationResult):
-    def __init__(self, dirname, features):
-        super().__init__(dirname, features)
+    """The results of a complete MooseSimulation, loaded from its directory
+
+    The traces are only read on first access to .waves (or to any
+    attribute derived from them), so a result which is only used for its
+    parameters or fitness does not hold the voltage in memory. Once
+    loaded, the traces are ordinary arrays: the junction potential is
+    subtracted from the whole trace, so memory-mapping the files would
+    not save anything.
+
+    archived is a :class:`storage.ArchiveEntry` to load the results
+    from, instead of the directory. params are the parameters of the
+    simulation, e.g. from the manifest, so that params.pickle does not
+    need to be read.
+    """
+    def __init__(self, dirname, features, archived=None, params=None):
+        super().__init__(dirname, features,
+                         params=archived.params if archived is not None else params)
+        self.dirname = dirname
+        self._archived = archived
+
+    @property
+    @utilities.once
+    def waves(self):
+        if self._archived is not None:
+            return self._archived_waves()
 
-        ivfiles = glob.glob(os.path.join(dirname, 'ivdata-*.npy'))
+        ivfiles = glob.glob(os.path.join(self.dirname, 'ivdata-*.npy'))
 
         junction_potential = self.params.get('junction_potential', 0)
         simtime = self.params.get('simtime')
         waves = [load_simulation(ivfile,
                                  simtime=simtime,
                                  junction_potential=junction_potential,
-                                 features=features)
+                                 features=self.features)
                  for ivfile in ivfiles]
 
         waves.sort(key=operator.attrgetter('injection'))
-        self.waves = np.array(waves, dtype=object)
+        self._restore_features(_read_features(self.dirname), waves)
+        return np.array(waves, dtype=object)
+
+    def _restore_features(self, snapshot, waves):
+        if snapshot is not None and restore_features(snapshot, self.features, waves):
+            # see Fit._save_features
+            self._features_saved = _snapshot_keys(snapshot[2])
+
+    @waves.setter
+    def waves(self, value):
+        self._waves_value = value
+
+    def _archived_waves(self):
+        junction_potential = self.params.get('junction_potential', 0)
+        simtime = self.params.get('simtime')
+        waves = [_ivcurve(injection, voltage, simtime, junction_potential, self.features,
+                          aborted=aborted, dt=self._archived.dt.get(injection))
+                 for injection, voltage, aborted in self._archived.traces()]
+        waves.sort(key=operator.attrgetter('injection'))
+        self._restore_features(self._archived.features, waves)
+        return np.array(waves, dtype=object)
 
 class SimulationResults(object):
     def __init__(self, dirname, features, *, constructor=MooseSimulationResult):
@@ -252,22 +681,114 @@ class SimulationResults(object):
         self.features = features
         self._constructor = constructor
 
-    def _dirs(self, last=None):
+    def archived(self):
+        "Return a dict of the entries in the :class:`storage.ResultArchive` by name"
+        archive = storage.ResultArchive(self.dirname)
+        return collections.OrderedDict((entry.name, entry) for entry in archive.entries())
+
+    def manifest(self):
+        """Return the :class:`storage.Manifest` of the directory, or None
+
+        If there is no manifest yet, e.g. for simulations from before the
+        manifest was introduced, it is built with :meth:`rebuild_manifest`.
+        Otherwise the directories are not scanned, and simulations which
+        are not listed are only added by an explicit :meth:`rebuild_manifest`.
+        None is returned if the manifest cannot be created.
+        """
+        if storage.Manifest.exists(self.dirname):
+            return storage.Manifest(self.dirname)
+        try:
+            return self.rebuild_manifest()
+        except sqlite3.Error as e:
+            logger.warning('cannot create the manifest of {}: {}'.format(self.dirname, e))
+            return None
+
+    def _complete_dirs(self):
         paths = glob.glob(os.path.join(self.dirname, '*/.complete'))
-        dirs = (os.path.dirname(path) for path in paths)
+        return [os.path.dirname(path) for path in paths]
+
+    def _scan_dirs(self):
+        dirs = self._complete_dirs()
         # sort by the simulation initialization order
         compare = lambda dir: os.stat(os.path.join(dir, 'params.pickle')).st_mtime
-        ans = sorted(dirs, key=compare)
+        return sorted(dirs, key=compare)
+
+    def _scan(self, last=None, archived=None):
+        "Return (dir, None) for the complete simulations, without the manifest"
+        if archived is None:
+            archived = self.archived()
+        ans = [(os.stat(os.path.join(dir, 'params.pickle')).st_mtime, dir)
+               for dir in self._scan_dirs()]
+        ans += [(entry.created, os.path.join(self.dirname, name))
+                for name, entry in archived.items()]
+        ans = [(dir, None) for created, dir in sorted(ans)]
         if last is None:
             return ans
         else:
             return ans[-last:]
 
-    def load(self, last=None):
-        dirs = self._dirs(last=last)
-        n = len(dirs)
-        for i, dir in enumerate(dirs):
-            yield i, n, self._constructor(dir, self.features)
+    def _result(self, dir, archived, params=None):
+        entry = archived.get(os.path.basename(dir))
+        if entry is not None:
+            return self._constructor(dir, self.features, archived=entry)
+        if params is not None:
+            return self._constructor(dir, self.features, params=params)
+        return self._constructor(dir, self.features)
+
+    def rebuild_manifest(self):
+        """Add all complete simulations in the directory to the manifest
+
+        This is needed for simulations which were not added when they
+        completed, e.g. from before the manifest was introduced, and is
+        done automatically if there is no manifest at all.
+        """
+        manifest = storage.Manifest(self.dirname)
+        known = set(manifest.names())
+        for dir in self._scan_dirs():
+            name = os.path.basename(dir)
+            if name in known:
+                continue
+            jar = os.path.join(dir, 'params.pickle')
+            with open(jar, 'rb') as f:
+                params = pickle.load(f)
+            injections = sorted(iv_filename_to_current(ivfile)
+                                for ivfile in glob.glob(os.path.join(dir, 'ivdata-*.npy')))
+            manifest.add(name, params, injections, created=os.stat(jar).st_mtime)
+        for name, entry in self.archived().items():
+            if name not in known:
+                manifest.add(name, entry.params, entry.injections, created=entry.created)
+        return manifest
+
+    def load(self, last=None, skip=None):
+        """Load the complete simulations, in the order of creation
+
+        Simulations in directories and in the archive are both loaded.
+        The simulations and their parameters are taken from the manifest,
+        see :meth:`manifest`. skip is called with the ParamSet of each
+        simulation, and the simulation is not loaded if it returns True.
+        """
+        archived = self.archived()
+        manifest = self.manifest()
+        if manifest is not None:
+            entries = [(os.path.join(self.dirname, name), params)
+                       for name, params, injections, fitness in manifest.entries(last=last)]
+        else:
+            entries = self._scan(last=last, archived=archived)
+        n = len(entries)
+        for i, (dir, params) in enumerate(entries):
+            if params is not None and skip is not None and skip(as_paramset(params)):
+                continue
+            yield i, n, self._result(dir, archived, params=params)
+
+    def top(self, k):
+        "Load the k simulations with the lowest fitness listed in the manifest"
+        manifest = self.manifest()
+        if manifest is None:
+            return []
+        archived = self.archived()
+        return [self._result(os.path.join(self.dirname, name), archived,
+                             params=manifest.entry(name)[0])
+                for name, fitness in manifest.top(k)]
 
     def ordered(self, measurement, *, fitness=fitnesses.combined_fitness):
         values, fitnesses = convert_to_values(self.results, measurement, fitness)
@@ -281,24 +802,35 @@ class ParamMechanism:
 
 ParamMechanism.unspecified = ParamMechanism()
 
+# Parameters which are applied to the simulated traces, and not passed to
+# the simulation. Changing them never requires a new simulation.
+POSTPROCESSING_PARAMS = {'junction_potential'}
+
 class Param:
     """ Base class for AjuParam class encapsulated set of values (name, value, fixed, mech).
     used for simulation.
+
+    postprocessing defaults to True for the names in POSTPROCESSING_PARAMS.
     """
     min = max = None
+    postprocessing = False
 
-    def __init__(self, name, value, fixed=True, mech=ParamMechanism.unspecified):
+    def __init__(self, name, value, fixed=True, mech=ParamMechanism.unspecified,
+                 postprocessing=None):
         self.name = name
         assert isinstance(value, (float, int, str)), value
         self.value = value
         self.fixed = fixed
         self.mech = mech
+        if postprocessing is None:
+            postprocessing = name in POSTPROCESSING_PARAMS
+        self.postprocessing = postprocessing
 
     def __repr__(self):
         return 'Param {}={}'.format(self.name, self.value)
 
     def __float__(self):
-        return self.value
+        return float(self.value)
 
     @staticmethod
     def make(args):
@@ -326,9 +858,11 @@ class AjuParam(Param):
     """
     def __init__(self, name, value, *, min=None, max=None,
                  fixed=False,
-                 mech=ParamMechanism.unspecified):
+                 mech=ParamMechanism.unspecified,
+                 postprocessing=None):
 
-        super().__init__(name, value, fixed=fixed, mech=mech)
+        super().__init__(name, value, fixed=fixed, mech=mech,
+                         postprocessing=postprocessing)
         self.min = min
         self.max = max
 
@@ -365,7 +899,8 @@ class AjuParam(Param):
                         min=self.min,
                         max=self.max,
                         fixed=self.fixed,
-                        mech=self.mech)
+                        mech=self.mech,
+                        postprocessing=self.postprocessing)
 
 class ParamSet:
     def __init__(self, *params, **other):
@@ -373,6 +908,7 @@ class ParamSet:
         self.params = params + other
         self.fixedparams = tuple(p for p in self.params if p.fixed)
         self.ajuparams = tuple(p for p in self.params if not p.fixed)
+        self.postprocessing = tuple(p for p in self.params if p.postprocessing)
 
     @property
     def scaled(self):
@@ -398,6 +934,16 @@ class ParamSet:
                                for p in self.fixedparams))
         return collections.OrderedDict(gen)
 
+    def physics_key(self, scaled_values):
+        """The part of scaled_values which determines the simulated traces
+
+        Points which differ only in post-processing parameters have the
+        same key and can share one simulation.
+        """
+        assert len(scaled_values) == len(self.ajuparams)
+        return tuple(v for p, v in zip(self.ajuparams, scaled_values)
+                     if not p.postprocessing)
+
     def updated(self, **kwargs):
         args = (p.updated(kwargs[p.name]) if p.name in kwargs else p
                 for p in self.params)
@@ -438,13 +984,62 @@ class ParamSet:
                       for p in self.params)
         return 'ParamSet ' + vv
 
+class Fidelity:
+    """A cheap simulation used to screen the candidates before the full one
+
+    simdt is the simulation time step, injections is a subset of the
+    measurement injections to simulate (all by default), and morph_file
+    is a reduced morphology. Of each population, only the promote
+    candidates (by default half) with the best cheap fitness are
+    simulated at full fidelity.
+    """
+    def __init__(self, *, simdt=None, injections=None, morph_file=None, promote=None):
+        self.simdt = simdt
+        self.injections = injections
+        self.morph_file = morph_file
+        self.promote = promote
+
+    def __repr__(self):
+        return 'Fidelity(simdt={}, injections={}, morph_file={}, promote={})'.format(
+            self.simdt, self.injections, self.morph_file, self.promote)
+
+    def options(self):
+        "Return the simulation options for this level"
+        return filtereddict(simdt=self.simdt,
+                            currents=self.injections,
+                            planned=self.injections,
+                            morph_file=self.morph_file)
+
 class Fit:
     fitness_max = 200
 
     def __init__(self, dirname, measurement, model, neuron_type, fitness_func, params,
                  feature_list=None,
+                 simulation_options=None,
+                 abort_criteria=None,
+                 racing=False,
+                 fidelity=None,
                  _make_simulation=None,
                  _result_constructor=MooseSimulationResult):
+        """simulation_options are passed on to each simulation, e.g.
+        dict(multi_injection=True) for :class:`MooseSimulation`.
+
+        abort_criteria is a dict of limits which stop a simulation early,
+        e.g. dict(max_spikes=100, block_time=0.1, baseline_tolerance=0.01),
+        see the --abort-* options of :mod:`ajustador.basic_simulation`.
+        The expected baseline is taken from the measurement unless given,
+        and is shifted by the junction_potential of each simulation (see
+        :class:`MooseSimulation`). Aborted simulations get the worst fitness.
+
+        With racing=True, the injections of each population are simulated
+        one at a time and candidates which are clearly worse than the
+        previous population are not simulated further, see
+        :meth:`_fitness_multi_racing`.
+
+        fidelity is a :class:`Fidelity` used to screen each population
+        before the full simulations, see :meth:`_fitness_multi_screened`.
+        Aborted candidates get the worst cheap fitness.
+        """
         self.dirname = dirname
         self.measurement = measurement
         self.model = model
@@ -456,11 +1051,37 @@ class Fit:
         self.optimizer = None
         self._make_simulation = _make_simulation
         self._result_constructor = _result_constructor
+        self.simulation_options = dict(simulation_options or ())
+        self.abort_criteria = dict(abort_criteria or ())
+        if 'baseline_tolerance' in self.abort_criteria:
+            self.abort_criteria.setdefault('baseline', measurement.mean_baseline.x)
+        # simulations by the values of parameters other than post-processing ones
+        self._physics_sims = {}
+        self.racing = racing
+        self._currents = None
+        self._racing_threshold = None
+        self._injection_fitness = collections.defaultdict(list)
+        self.fidelity = fidelity
+        # pairs of (cheap fitness, full fitness)
+        self._calibration = []
 
         # we assume that the first param value does not need penalties
         self._fitness_worst = None
         utilities.mkdir_p(dirname)
 
+    @property
+    @utilities.once
+    def targets(self):
+        """The measurement, with the values used by fitness_func computed
+
+        This is a :class:`loader.FrozenMeasurement` if fitness_func
+        declares the attributes it uses, and the measurement otherwise.
+        """
+        names = getattr(self.fitness_func, 'targets', None)
+        if names is None:
+            return self.measurement
+        return loader.FrozenMeasurement(self.measurement, names)
+
     def load(self, last=None):
         try:
             self._sim_value
@@ -471,7 +1092,8 @@ class Fit:
                                 features=self.measurement.features,
                                 constructor=self._result_constructor)
         need_erase = False
-        for i, n, sim in new.load(last=last):
+        skip = lambda params: tuple(params.scaled) in self._sim_value
+        for i, n, sim in new.load(last=last, skip=skip):
             print('{}/{} {}'.format(i, n, sim.name), end='\r')
             need_erase = True
             key = tuple(sim.params.scaled)
@@ -488,15 +1110,87 @@ class Fit:
 
     @utilities.cached
     def sim(self, scaled_params):
+        """Simulate the model at scaled_params
+
+        If a point differing only in post-processing parameters (e.g.
+        junction_potential) was already simulated, its traces are reused.
+        """
         unscaled = self.params.unscaled_dict(scaled_params)
+        options = dict(self.simulation_options)
+        if self._async:
+            options['async'] = True
+        if self.abort_criteria:
+            options['abort'] = self.abort_criteria
+        if self._currents is not None:
+            options['currents'] = self._currents
+        key = self.params.physics_key(scaled_params)
+        source = self._physics_sims.get(key)
+        if source is not None:
+            options['source'] = source
         sim = self._make_simulation(dir=self.dirname,
                                     model=self.model,
                                     measurement=self.measurement,
-                                    params=self.params.updated(**unscaled)) #define params here SRIRAM
+                                    params=self.params.updated(**unscaled), #define params here SRIRAM
+                                    **options)
+        self._physics_sims.setdefault(key, sim)
         return sim
 
+    def _aborted_fitness(self, sim, full):
+        if not full:
+            return self.fitness_max
+        pairs = getattr(self.fitness_func, 'pairs', None)
+        if pairs is not None:
+            size = sum(1 for w, func in pairs if w)
+        else:
+            size = len(self.fitness_func(sim, self.targets, full=True))
+        return np.full(size, float(self.fitness_max))
+
+    @utilities.cached
+    def screening_sim(self, scaled_params):
+        """Simulate the model at scaled_params at the cheap fidelity level
+
+        The abort criteria are applied like in :meth:`sim`. The simulation
+        is complete once the injections of the level are done.
+        """
+        unscaled = self.params.unscaled_dict(scaled_params)
+        options = dict(self.simulation_options)
+        if self._async:
+            options['async'] = True
+        if self.abort_criteria:
+            options['abort'] = self.abort_criteria
+        options.update(self.fidelity.options())
+        dirname = os.path.join(self.dirname, 'screening')
+        os.makedirs(dirname, exist_ok=True)
+        return self._make_simulation(dir=dirname,
+                                     model=self.model,
+                                     measurement=self.measurement,
+                                     params=self.params.updated(**unscaled),
+                                     **options)
+
+    def calibrated(self, cheap):
+        """Convert cheap fitness values to an estimate of the full fitness
+
+        A straight line is fitted to the pairs of cheap and full fitness
+        values of all candidates simulated at both levels so far.
+        """
+        pairs = np.array(self._calibration, dtype=float).reshape(-1, 2)
+        pairs = pairs[np.isfinite(pairs).all(axis=1)]
+        x, y = pairs.T
+        if x.size < 3 or np.unique(x).size < 2:
+            return cheap
+        slope, intercept = np.polyfit(x, y, 1)
+        return intercept + slope * cheap
+
     def sim_fitness(self, sim, full=False, max_fitness=None):
-        fitness = self.fitness_func(sim, self.measurement, full=full)
+        # simulations are asynchronous once fitness_multi or do_fit has run
+        sim.wait()
+        if any(getattr(wave, 'aborted', None) for wave in sim.waves):
+            fitness = self._aborted_fitness(sim, full)
+        else:
+            fitness = self.fitness_func(sim, self.targets, full=full)
+        if not full:
+            self._record_fitness(sim, fitness)
+        self._save_features(sim)
         if full and max_fitness is not None:
             for i in range(len(fitness)):
                 if fitness[i] > max_fitness:
@@ -504,6 +1198,48 @@ class Fit:
         self._history.append(fitness)
         return fitness
 
+    def _save_features(self, sim):
+        """Store the feature values of sim, if any were computed since last time
+
+        The snapshot is written next to the traces, or appended to the
+        :class:`storage.ResultArchive` if the simulation was archived.
+        """
+        # partial simulations (racing, screening) and aborted ones are not
+        # loaded later, and their features would be incomplete
+        missing = getattr(sim, 'missing', None)
+        if ((missing is not None and missing()) or
+            any(getattr(wave, 'aborted', None) for wave in sim.waves)):
+            return
+        snapshot = features_snapshot(sim.features, sim.waves)
+        keys = _snapshot_keys(snapshot[2])
+        if not keys or keys == getattr(sim, '_features_saved', None):
+            return
+        tmpdir = getattr(sim, 'tmpdir', None)
+        dirname = tmpdir.name if tmpdir is not None else getattr(sim, 'dirname', None)
+        if dirname is None:
+            return
+        try:
+            if os.path.isdir(dirname):
+                save_features(dirname, sim.features, sim.waves, snapshot=snapshot)
+            elif getattr(sim, 'archive', False) or getattr(sim, '_archived', None) is not None:
+                parent, name = os.path.split(dirname)
+                storage.ResultArchive(parent).append_features(name, snapshot)
+            else:
+                return
+        except OSError as e:
+            logger.warning('cannot save features of {}: {}'.format(dirname, e))
+            return
+        sim._features_saved = keys
+
+    def _record_fitness(self, sim, fitness):
+        tmpdir = getattr(sim, 'tmpdir', None)
+        name = os.path.basename(tmpdir.name) if tmpdir is not None else sim.name
+        if np.isfinite(fitness) and storage.Manifest.exists(self.dirname):
+            try:
+                storage.Manifest(self.dirname).set_fitness(name, fitness)
+            except sqlite3.Error as e:
+                logger.warning('cannot record fitness of {}: {}'.format(name, e))
+
     @property
     def name(self):
         return os.path.basename(self.dirname)
@@ -534,13 +1270,175 @@ class Fit:
 
     def fitness_multi(self, many_values):
         self._async = True
+        if self.fidelity is not None:
+            return self._fitness_multi_screened(many_values)
+        if self.racing:
+            return self._fitness_multi_racing(many_values)
         #many values is the population_size set of parameter values
         sims = [self.sim(values) for values in many_values]
         for sim in sims:
             sim.wait()
+        self._precompute_features(sims)
         results = [self.fitness(values) for values in many_values]
         return results
 
+    def _precompute_features(self, sims):
+        "Extract the features of the traces of sims in batches"
+        waves = [wave
+                 for sim in sims
+                 if not any(getattr(wave, 'aborted', None) for wave in sim.waves)
+                 for wave in sim.waves]
+        _features.precompute(waves)
+
+    def _fitness_multi_screened(self, many_values):
+        """Simulate all candidates cheaply and promote the best ones
+
+        The promoted candidates are simulated at full fidelity and their
+        fitness is used to calibrate the cheap fitness. The others get
+        the calibrated cheap fitness, but not less than the worst fitness
+        of the promoted candidates, so that the ranking of the cheap
+        level is preserved.
+        """
+        sims = [self.screening_sim(values) for values in many_values]
+        for sim in sims:
+            sim.wait()
+        self._precompute_features(sims)
+        cheap = np.array([self.fitness_max
+                          if any(getattr(wave, 'aborted', None) for wave in sim.waves)
+                          else self.fitness_func(sim, self.targets)
+                          for sim in sims],
+                         dtype=float)
+        cheap[~np.isfinite(cheap)] = self.fitness_max
+
+        promote = self.fidelity.promote or max(len(many_values) // 2, 1)
+        promoted = np.argsort(cheap)[:promote]
+        full_sims = [self.sim(many_values[i]) for i in promoted]
+        for sim in full_sims:
+            sim.wait()
+        self._precompute_features(full_sims)
+
+        results = [None] * len(many_values)
+        finite = []
+        for i in promoted:
+            value = self.fitness(many_values[i])
+            if np.isfinite(value):
+                self._calibration.append((cheap[i], value))
+                finite.append(value)
+            else:
+                value = self.fitness_max
+            results[i] = value
+        worst = max(finite) if finite else self.fitness_max
+        for i in range(len(many_values)):
+            if results[i] is None:
+                results[i] = float(max(self.calibrated(cheap[i]), worst))
+        logger.info('fidelity: simulated {} of {} candidates fully'
+                    .format(len(promoted), len(many_values)))
+        return results
+
+    def injection_order(self):
+        """Return the injections of the measurement, most discriminating first
+
+        Injections are ordered by the spread of their fitness among the
+        candidates simulated so far. Without enough history, the most
+        depolarizing injections come first.
+        """
+        def spread(injection):
+            values = self._injection_fitness.get(injection, ())
+            return np.std(values) if len(values) > 1 else 0
+        return sorted(self.measurement.injection,
+                      key=lambda injection: (-spread(injection), -injection))
+
+    def _record_injection_fitness(self, sim):
+        if any(getattr(wave, 'aborted', None) for wave in sim.waves):
+            return
+        for injection in sim.injection:
+            part = sim[sim.injection == injection]
+            value = self.fitness_func(part, self.targets)
+            if np.isfinite(value):
+                self._injection_fitness[injection].append(value)
+
+    def _fitness_multi_racing(self, many_values):
+        """Simulate injections one at a time and drop hopeless candidates
+
+        After k of n injections, sqrt(k/n) times the fitness computed from
+        the k simulated traces is used as an estimate of the lower bound
+        of the final fitness (exact when all fitness components are rms
+        values over the traces). Candidates with a bound above the worst
+        fitness accepted by the optimizer in the previous population are
+        not simulated further. The optimizer is told their bound, which
+        is above the threshold, so they rank below the accepted ones.
+        The bound is not stored as their fitness, and their directories
+        are removed, see :meth:`_drop_sim`. Aborted candidates are dropped
+        the same way, and the optimizer is told fitness_max for them.
+        """
+        order = self.injection_order()
+        n = len(order)
+        self._currents = order[:1]
+        try:
+            sims = [self.sim(values) for values in many_values]
+        finally:
+            self._currents = None
+
+        active = [sim for sim in sims if isinstance(sim, MooseSimulation)]
+        dropped = {}
+        for k in range(1, n):
+            for sim in active:
+                sim.wait()
+            factor = math.sqrt(k / n)
+            survivors = []
+            for sim in active:
+                if any(getattr(wave, 'aborted', None) for wave in sim.waves):
+                    logger.info('racing: dropping {} after {}/{} injections, aborted'
+                                .format(sim.tmpdir.name, k, n))
+                    dropped[id(sim)] = self.fitness_max
+                    continue
+                if self._racing_threshold is not None:
+                    bound = factor * self.fitness_func(sim, self.targets)
+                    if bound > self._racing_threshold:
+                        logger.info('racing: dropping {} after {}/{} injections, {:.3g} > {:.3g}'
+                                    .format(sim.tmpdir.name, k, n, bound, self._racing_threshold))
+                        dropped[id(sim)] = bound
+                        continue
+                survivors.append(sim)
+            active = survivors
+            for sim in active:
+                missing = sim.missing()
+                currents = [current for current in order[:k + 1] if current in missing]
+                if currents:
+                    sim.add_currents(currents, async=True)
+
+        for sim in sims:
+            sim.wait()
+        results, complete = [], []
+        for values, sim in zip(many_values, sims):
+            if id(sim) in dropped:
+                results.append(float(dropped[id(sim)]))
+                self._drop_sim(values, sim)
+            else:
+                value = self.fitness(values)
+                results.append(value)
+                if np.isfinite(value):
+                    complete.append(value)
+                self._record_injection_fitness(sim)
+        if complete:
+            # cma selects the best half of the population by default
+            mu = max(len(results) // 2, 1)
+            self._racing_threshold = sorted(complete)[min(mu, len(complete)) - 1]
+        return results
+
+    def _drop_sim(self, values, sim):
+        """Forget a simulation stopped by racing
+
+        It is removed from the cache of :meth:`sim`, so that the point is
+        simulated again if it is asked for later, and its directory is
+        removed.
+        """
+        self.__dict__.get('_sim_value', {}).pop(tuple(values), None)
+        key = self.params.physics_key(values)
+        if self._physics_sims.get(key) is sim:
+            del self._physics_sims[key]
+        sim.tmpdir.cleanup()
+
     def finished(self):
         quit = fitnesses.fit_finished(self._history)
         return quit.any()
@@ -557,7 +1455,34 @@ class Fit:
                 values[i, j] = item.params[param].value
         return values
 
-    def do_fit(self, count, params=None, sigma=1, popsize=8, seed=123):
+    def do_fit(self, count, params=None, sigma=1, popsize=8, seed=123,
+               steady_state=False, window=None,
+               surrogate=None, oversample=4, explore=None):
+        """Run count generations of the optimizer
+
+        With steady_state=True, simulations are started as soon as others
+        finish, see :meth:`_do_fit_steady_state`. The points are simulated
+        one at a time, so steady_state cannot be combined with surrogate,
+        nor used by a Fit with racing or fidelity; ValueError is raised.
+
+        surrogate is a model of the fitness, e.g. a
+        :class:`surrogate.RBFSurrogate` (True selects the default one).
+        When given, oversample*popsize points are asked from the optimizer
+        in each generation, and only the popsize points with the best
+        predicted fitness are simulated, except for explore (by default
+        a quarter of popsize) points picked at random from the rest.
+        oversample must be a positive integer and explore at most
+        popsize. See :meth:`_prescreen`.
+        """
+        if steady_state:
+            unsupported = [name for name, value in (('surrogate', surrogate),
+                                                    ('racing', self.racing),
+                                                    ('fidelity', self.fidelity))
+                           if value]
+            if unsupported:
+                raise ValueError('steady_state cannot be used with {}'
+                                 .format(', '.join(unsupported)))
+
         # what is the order of params which position represents which params?
         if self.optimizer is None:
             if params is None:
@@ -566,11 +1491,116 @@ class Fit:
             opts = dict(bounds=bounds, popsize=popsize, seed=seed)
             self.optimizer = cma.CMAEvolutionStrategy(params, sigma, opts)
 
+        if steady_state:
+            return self._do_fit_steady_state(count, window=window)
+
+        if surrogate is True:
+            surrogate = _surrogate.RBFSurrogate()
+        if surrogate is not None:
+            popsize = self.optimizer.popsize
+            if explore is None:
+                explore = max(popsize // 4, 1)
+            if int(oversample) != oversample or oversample < 1:
+                raise ValueError('oversample must be a positive integer, not {}'
+                                 .format(oversample))
+            if not 0 <= explore <= popsize:
+                raise ValueError('explore must be between 0 and popsize={}, not {}'
+                                 .format(popsize, explore))
+
         for i in range(count):
             if self.optimizer.stop():
                 break
-            points = self.optimizer.ask()
+            if surrogate is not None:
+                points = self._prescreen(surrogate, oversample, explore)
+            else:
+                points = self.optimizer.ask()
             values = self.fitness_multi(points) # runs simulation and computes total fitness across featuers.
             self.optimizer.tell(points, values)
             self.optimizer.logger.add()  # write plottable data to disc.
             self.optimizer.disp()
+
+    def _prescreen(self, surrogate, oversample, explore):
+        """Ask for an oversampled batch and return the most promising points
+
+        The surrogate is trained on all fitness values computed so far.
+        Until there are enough of them to train on, the points are
+        returned as asked.
+        """
+        popsize = self.optimizer.popsize
+        history = [(key, value)
+                   for key, value in getattr(self, '_fitness_value', {}).items()
+                   if np.isfinite(value)]
+        if len(history) < max(popsize, 2 * len(self.params.ajuparams)):
+            return self.optimizer.ask()
+
+        keys, values = zip(*history)
+        surrogate.fit(np.array(keys), np.minimum(values, self.fitness_max))
+        candidates = self.optimizer.ask(popsize * int(oversample))
+        order = np.argsort(surrogate.predict(np.array(candidates)))
+        best, rest = order[:popsize - explore], order[popsize - explore:]
+        rng = np.random.RandomState(len(history))
+        chosen = np.concatenate((best, rng.choice(rest, explore, replace=False)))
+        logger.info('surrogate: simulating {} of {} candidates'
+                    .format(len(chosen), len(candidates)))
+        return [candidates[i] for i in chosen]
+
+    def _do_fit_steady_state(self, count, window=None, poll=0.1):
+        """Keep window simulations running and tell the optimizer as they finish
+
+        Points are asked for a population at a time, so that mirrored and
+        injected solutions of pycma are all returned, and the simulations
+        are started from that batch whenever others finish, so the pool
+        stays busy. Every time popsize results are available, they are
+        passed to the optimizer together, regardless of the generation in
+        which they were asked for. A slow candidate thus only delays its
+        own result and not the whole generation.
+
+        pycma only accepts one tell per ask. If no points were asked since
+        the last tell, a new batch is asked first and replaces the points
+        of the older batch which were not started yet. Its points are not
+        simulated if they would not be told in count generations.
+
+        pycma assumes that the told points were sampled from its current
+        distribution. Here, a point may have been asked before one or more
+        tell calls updated the distribution, and the optimizer is not told
+        about this. The larger the window, the older the distributions
+        the told points may come from.
+        """
+        self._async = True
+        popsize = self.optimizer.popsize
+        if window is None:
+            window = popsize
+
+        batch, pending, finished = [], [], []
+        generations = started = 0
+        asked = False       # whether points were asked since the last tell
+        while generations < count and not self.optimizer.stop():
+            # do not start points which would not be told in count generations
+            while len(pending) < window and started < count * popsize:
+                if not batch:
+                    batch, asked = list(self.optimizer.ask()), True
+                point = batch.pop(0)
+                self.sim(point)   # starts the simulation
+                pending.append(point)
+                started += 1
+
+            still_pending = []
+            for point in pending:
+                if self.sim(point).ready():
+                    finished.append(point)
+                else:
+                    still_pending.append(point)
+            if len(still_pending) == len(pending):
+                time.sleep(poll)
+            pending = still_pending
+
+            while len(finished) >= popsize and generations < count:
+                if not asked:
+                    batch, asked = list(self.optimizer.ask()), True
+                points, finished = finished[:popsize], finished[popsize:]
+                values = [self.fitness(point) for point in points]
+                self.optimizer.tell(points, values)
+                self.optimizer.logger.add()  # write plottable data to disc.
+                self.optimizer.disp()
+                generations += 1
+                asked = False
@@ -0,0 +1,446 @@
+"""Persistent storage of simulation results
+
+- :class:`SimulationCache` stores voltage traces by their inputs,
+- :class:`Manifest` is an index of the simulations in a fit directory,
+- :class:`ResultArchive` holds the results of many simulations in one file,
+- :func:`save_trace` and :func:`load_trace` write and read voltage traces
+  in a compact format.
+"""
+
+import io
+import collections
+import os
+import json
+import struct
+import time
+import numbers
+import pickle
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import contextlib
+import zlib
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ajustador.helpers.loggingsystem import getlogger
+import logging
+logger = getlogger(__name__)
+logger.setLevel(logging.INFO)
+
+TRACE_ENCODINGS = (None, 'delta-zlib')
+
+# integer types used to take differences of floating point values
+_INT_VIEWS = {2: np.int16, 4: np.int32, 8: np.int64}
+
+def encode_delta_zlib(values):
+    """Losslessly compress an array of floating point values
+
+    The values are reinterpreted as integers, and the differences between
+    consecutive ones are compressed with zlib. Neighbouring samples of a
+    voltage trace have similar bit patterns, so the differences are small.
+    """
+    ints = np.ascontiguousarray(values).view(_INT_VIEWS[values.dtype.itemsize])
+    delta = ints.copy()
+    delta[1:] -= ints[:-1]
+    return zlib.compress(delta.tobytes())
+
+def decode_delta_zlib(data, dtype):
+    "The inverse of :func:`encode_delta_zlib`"
+    dtype = np.dtype(dtype)
+    delta = np.frombuffer(zlib.decompress(data), dtype=_INT_VIEWS[dtype.itemsize])
+    return np.cumsum(delta, dtype=delta.dtype).view(dtype)
+
+def save_trace(filename, voltage, duration, *, dtype=None, dt=None, encoding=None):
+    """Save a voltage trace sampled uniformly from 0 to duration
+
+    dtype is the type to store the values as (e.g. 'float32'), dt is the
+    sampling interval to decimate the trace to, and encoding is one of
+    TRACE_ENCODINGS. Without any of those, a plain .npy file is written.
+    Otherwise, the file is an .npz archive (under the same name) which
+    also holds the sampling interval. Either can be read with
+    :func:`load_trace`.
+    """
+    voltage = np.asarray(voltage)
+    if dtype is None and dt is None and encoding is None:
+        with open(filename, 'wb') as f:
+            np.save(f, voltage)
+        return
+
+    if encoding not in TRACE_ENCODINGS:
+        raise ValueError('unknown trace encoding {!r}'.format(encoding))
+    sample_dt = duration / max(voltage.size - 1, 1)
+    if dt is not None:
+        step = max(int(round(dt / sample_dt)), 1)
+        voltage = voltage[::step]
+        sample_dt *= step
+    if dtype is not None:
+        voltage = voltage.astype(dtype)
+
+    arrays = dict(dt=np.float64(sample_dt))
+    if encoding == 'delta-zlib':
+        arrays['delta_zlib'] = np.frombuffer(encode_delta_zlib(voltage), dtype=np.uint8)
+        arrays['dtype'] = np.array(voltage.dtype.str)
+    else:
+        arrays['voltage'] = voltage
+    with open(filename, 'wb') as f:
+        np.savez(f, **arrays)
+
+def load_trace(filename):
+    """Read a trace written by :func:`save_trace` or np.save
+
+    Returns (voltage, dt). dt is None for plain .npy files, which do not
+    record the sampling interval.
+    """
+    data = np.load(filename)
+    if not hasattr(data, 'files'):
+        return data, None
+    with data:
+        dt = float(data['dt'])
+        if 'delta_zlib' in data.files:
+            voltage = decode_delta_zlib(data['delta_zlib'].tobytes(), str(data['dtype']))
+        else:
+            voltage = data['voltage']
+    return voltage, dt
+
+class SimulationCache(object):
+    """A content-addressed store of simulated voltage traces
+
+    Traces are stored under a hash of everything that determines them:
+    the simulation parameters (including model, neuron_type and
+    simtime), the contents of the morphology file and the injection
+    current. The cache is a plain directory, so it survives the process
+    and can be shared between fits, and between runs of the same script.
+
+    >>> cache = SimulationCache('/tmp/simcache')
+    >>> fit = aju.optimize.Fit(..., simulation_options=dict(cache=cache))
+    """
+
+    VERSION = b'1'
+
+    # Those do not change the simulated trace
+    IGNORED_PARAMS = {'junction_potential'}
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.dirname)
+
+    @classmethod
+    def key(cls, params, injection, morph=b''):
+        """Return a stable hash of the inputs of one simulation
+
+        params is a dict of names to values or Param objects.
+        """
+        h = hashlib.sha1(cls.VERSION)
+        for name, value in sorted(params.items()):
+            if name in cls.IGNORED_PARAMS or getattr(value, 'postprocessing', False):
+                continue
+            value = getattr(value, 'value', value)
+            if isinstance(value, numbers.Real):
+                # numpy scalars have a different repr
+                value = float(value)
+            h.update(repr((name, value)).encode())
+        h.update(repr(('injection', float(injection))).encode())
+        h.update(morph)
+        return h.hexdigest()
+
+    def _path(self, key, filename):
+        _, ext = os.path.splitext(filename)
+        return os.path.join(self.dirname, key[:2], key + ext)
+
+    def fetch(self, key, filename):
+        """Put the cached trace for key in filename
+
+        Returns False if key is not in the cache.
+        """
+        path = self._path(key, filename)
+        if not os.path.exists(path):
+            return False
+        try:
+            os.link(path, filename)
+        except OSError:
+            shutil.copyfile(path, filename)
+        logger.info('{} found in cache as {}'.format(filename, key))
+        return True
+
+    def store(self, key, filename):
+        "Add the trace in filename to the cache under key"
+        path = self._path(key, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write under a temporary name first, so that concurrent readers
+        # never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(filename, tmp)
+        os.replace(tmp, path)
+
+class Manifest(object):
+    """An index of the simulations in a fit directory
+
+    Each simulation is added when it is complete, with its parameters,
+    injection currents and creation time. The fitness is added when it
+    is computed. Listing and sorting the simulations then only needs the
+    index, and not a scan of all the directories.
+
+    The index is an SQLite database in the fit directory. A new
+    connection is used for each operation, so the object can be shared
+    between threads, and the database between processes. SQLite relies
+    on file locking, which is unreliable on NFS: processes on different
+    hosts must not write to the same manifest.
+    """
+
+    FILENAME = 'manifest.sqlite'
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.filename = os.path.join(dirname, self.FILENAME)
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS simulations (
+                              id INTEGER PRIMARY KEY AUTOINCREMENT,
+                              name TEXT UNIQUE NOT NULL,
+                              created REAL NOT NULL,
+                              params BLOB,
+                              injections TEXT,
+                              fitness REAL)''')
+
+    @classmethod
+    def exists(cls, dirname):
+        return os.path.exists(os.path.join(dirname, cls.FILENAME))
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.dirname)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, name, params, injections, created=None):
+        """Record the complete simulation in subdirectory name
+
+        params is pickled, injections is a list of currents.
+        """
+        if created is None:
+            created = time.time()
+        with self._connect() as conn:
+            conn.execute('''INSERT OR REPLACE INTO simulations
+                            (name, created, params, injections)
+                            VALUES (?, ?, ?, ?)''',
+                         (name, created, pickle.dumps(params),
+                          json.dumps([float(inj) if isinstance(inj, numbers.Real) else str(inj)
+                                      for inj in injections])))
+
+    def set_fitness(self, name, fitness):
+        with self._connect() as conn:
+            conn.execute('UPDATE simulations SET fitness=? WHERE name=?',
+                         (float(fitness), name))
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM simulations').fetchone()[0]
+
+    def names(self, last=None):
+        "Return the names of the simulations, in the order of creation"
+        with self._connect() as conn:
+            rows = conn.execute('SELECT name FROM simulations ORDER BY created, id').fetchall()
+        names = [name for name, in rows]
+        return names if last is None else names[-last:]
+
+    def entries(self, last=None):
+        """Return (name, params, injections, fitness) of the simulations
+
+        The simulations are in the order of creation, like :meth:`names`.
+        """
+        with self._connect() as conn:
+            rows = conn.execute('''SELECT name, params, injections, fitness FROM simulations
+                                   ORDER BY created, id''').fetchall()
+        if last is not None:
+            rows = rows[-last:]
+        return [(name, pickle.loads(params), json.loads(injections), fitness)
+                for name, params, injections, fitness in rows]
+
+    def top(self, k=None):
+        "Return (name, fitness) of the k simulations with the lowest fitness"
+        query = '''SELECT name, fitness FROM simulations
+                   WHERE fitness IS NOT NULL ORDER BY fitness'''
+        with self._connect() as conn:
+            if k is None:
+                return conn.execute(query).fetchall()
+            return conn.execute(query + ' LIMIT ?', (k,)).fetchall()
+
+    def entry(self, name):
+        """Return (params, injections, fitness) of simulation name
+
+        Raises KeyError if it is not in the manifest.
+        """
+        with self._connect() as conn:
+            row = conn.execute('''SELECT params, injections, fitness FROM simulations
+                                  WHERE name=?''', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        params, injections, fitness = row
+        return pickle.loads(params), json.loads(injections), fitness
+
+class ArchiveEntry(object):
+    """One simulation in a :class:`ResultArchive`
+
+    The parameters and metadata are read with the entry, the traces
+    only when :meth:`traces` is called. features is the last snapshot
+    added with :meth:`ResultArchive.append_features`, or None.
+    """
+    def __init__(self, filename, meta, offset):
+        self.filename = filename
+        self.name = meta['name']
+        self.created = meta['created']
+        self.params = meta['params']
+        self.aborted = meta['aborted']
+        self.dt = meta.get('dt', {})
+        self.features = meta.get('features')
+        self._index = meta['traces']
+        self._offset = offset
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.name)
+
+    @property
+    def injections(self):
+        return [injection for injection, start in self._index]
+
+    def traces(self):
+        "Yield (injection, voltage, aborted) for each trace"
+        with open(self.filename, 'rb') as f:
+            for injection, start in self._index:
+                f.seek(self._offset + start)
+                voltage = np.lib.format.read_array(f)
+                yield injection, voltage, self.aborted.get(injection)
+
+class ResultArchive(object):
+    """An append-only file with the results of many simulations
+
+    Each record holds the name, creation time and parameters of one
+    simulation and its voltage traces in .npy format, or a snapshot of
+    the feature values of a simulation added earlier. Appends are
+    serialized with an exclusive lock on the file, so several processes
+    can add to the same archive. A record that is still being written
+    is skipped by readers, and one left incomplete by a writer which
+    crashed is removed by the next :meth:`append`.
+    """
+
+    FILENAME = 'results.archive'
+    MAGIC = b'AJU1'
+    HEADER = struct.Struct('<4sQQ')     # magic, metadata length, traces length
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.filename = os.path.join(dirname, self.FILENAME)
+
+    @classmethod
+    def exists(cls, dirname):
+        return os.path.exists(os.path.join(dirname, cls.FILENAME))
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.dirname)
+
+    def append(self, name, params, traces, aborted=None, dt=None, created=None):
+        """Add the results of one simulation
+
+        traces is a list of (injection, voltage) pairs. aborted is a dict
+        of injection to the contents of the .aborted marker, and dt a dict
+        of injection to the sampling interval, for traces which do not
+        cover the whole simulation time uniformly.
+        """
+        data = io.BytesIO()
+        index = []
+        for injection, voltage in traces:
+            index.append((float(injection), data.tell()))
+            np.lib.format.write_array(data, np.asarray(voltage))
+        meta = pickle.dumps(dict(name=name,
+                                 created=time.time() if created is None else created,
+                                 params=params,
+                                 traces=index,
+                                 aborted={float(k): v for k, v in (aborted or {}).items()},
+                                 dt={float(k): v for k, v in (dt or {}).items()}))
+        self._write(meta, data.getvalue())
+
+    def append_features(self, name, features):
+        """Add a snapshot of the feature values of simulation name
+
+        The snapshot is stored in a record of its own, because the features
+        are computed after the simulation was archived. The last snapshot
+        of each simulation is returned in :attr:`ArchiveEntry.features`.
+        """
+        self._write(pickle.dumps(dict(name=name, features=features)), b'')
+
+    def _write(self, meta, data):
+        record = self.HEADER.pack(self.MAGIC, len(meta), len(data)) + meta + data
+
+        with open(self.filename, 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._truncate_incomplete(f)
+                f.write(record)
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _truncate_incomplete(self, f):
+        # Called with the lock held, so an incomplete record at the end
+        # was left by a writer which crashed. It is removed, otherwise
+        # the new record would be written after it and never be found.
+        size = os.fstat(f.fileno()).st_size
+        end = 0
+        for offset, meta_len, data_len in self._records(f, size):
+            end = offset + self.HEADER.size + meta_len + data_len
+        if end < size:
+            logger.warning('{}: removing an incomplete record of {} bytes at offset {}'
+                           .format(self.filename, size - end, end))
+            f.truncate(end)
+
+    def _records(self, f, size):
+        "Yield (offset, metadata length, traces length) of the complete records"
+        offset = 0
+        while offset + self.HEADER.size <= size:
+            f.seek(offset)
+            magic, meta_len, data_len = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != self.MAGIC:
+                raise ValueError('{}: bad record at offset {}'.format(self.filename, offset))
+            end = offset + self.HEADER.size + meta_len + data_len
+            if end > size:
+                break
+            yield offset, meta_len, data_len
+            offset = end
+
+    def entries(self):
+        "Yield an :class:`ArchiveEntry` for each complete simulation record"
+        if not os.path.exists(self.filename):
+            return
+        entries = collections.OrderedDict()
+        with open(self.filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            for offset, meta_len, data_len in self._records(f, size):
+                f.seek(offset + self.HEADER.size)
+                meta = pickle.loads(f.read(meta_len))
+                if 'traces' not in meta:
+                    # a features snapshot of an earlier record
+                    entry = entries.get(meta['name'])
+                    if entry is not None:
+                        entry.features = meta['features']
+                    continue
+                entries[meta['name']] = ArchiveEntry(self.filename, meta,
+                                                     offset + self.HEADER.size + meta_len)
+        yield from entries.values()
@@ -0,0 +1,58 @@
+"""Cheap models of the fitness, used to pre-screen candidates
+
+A surrogate is trained on the (scaled parameters → fitness) pairs which
+were already simulated, and predicts the fitness of new points. It
+provides two methods:
+
+- fit(points, values) trains the model,
+- predict(points) returns an array of predicted values.
+
+See :meth:`ajustador.optimize.Fit.do_fit` for how it is used.
+"""
+
+import numpy as np
+
+class RBFSurrogate(object):
+    """Gaussian radial basis function regression with a ridge penalty
+
+    scale is the width of the basis functions in the space of scaled
+    parameters. By default the median distance between the training
+    points is used. Only the last max_points points are used for
+    training, to keep the cost of fit bounded.
+
+    >>> s = RBFSurrogate()
+    >>> s.fit([[0], [1], [2], [3]], [9, 4, 1, 0])
+    >>> print(s.predict([[0.5], [2.5]]).argmin())
+    1
+    """
+    def __init__(self, scale=None, ridge=1e-3, max_points=500):
+        self.scale = scale
+        self.ridge = ridge
+        self.max_points = max_points
+
+    @staticmethod
+    def _distances(a, b):
+        return np.sqrt(((a[:, None, :] - b[None, :, :])**2).sum(axis=-1))
+
+    def _kernel(self, a, b):
+        return np.exp(-(self._distances(a, b) / self._scale)**2)
+
+    def fit(self, points, values):
+        points = np.asarray(points, dtype=float)[-self.max_points:]
+        values = np.asarray(values, dtype=float)[-self.max_points:]
+        if self.scale is not None:
+            self._scale = self.scale
+        else:
+            dist = self._distances(points, points)
+            nonzero = dist[dist > 0]
+            self._scale = np.median(nonzero) if nonzero.size else 1.0
+
+        self._points = points
+        self._offset = values.mean()
+        kernel = self._kernel(points, points)
+        kernel[np.diag_indices_from(kernel)] += self.ridge
+        self._coef = np.linalg.lstsq(kernel, values - self._offset, rcond=None)[0]
+
+    def predict(self, points):
+        points = np.asarray(points, dtype=float)
+        return self._offset + self._kernel(points, self._points).dot(self._coef)
@@ -0,0 +1,30 @@
+import types
+import concurrent.futures
+
+import numpy as np
+
+from ajustador import analysis, executors, optimize
+
+def _simulation(*, params, dir, currents, single, simtime):
+    return types.SimpleNamespace(params=params, dir=dir, injection=currents)
+
+def test_scan_params(tmpdir, monkeypatch):
+    monkeypatch.setattr(analysis, 'MooseSimulation', _simulation)
+    monkeypatch.setattr(executors, '_executor',
+                        executors.FuturesExecutor(concurrent.futures.ThreadPoolExecutor(2)))
+    params = optimize.ParamSet(optimize.AjuParam('RA', 5.0, min=1, max=10),
+                               optimize.AjuParam('RM', 1.0, min=0.1, max=10),
+                               optimize.AjuParam('junction_potential', 0.0, fixed=True))
+
+    res = analysis.scan_params(str(tmpdir), [1e-10], params,
+                               dict(RA=[2, 4, 6], RM=np.array([0.5, 1.5])), simtime=0.9)
+    assert res.shape == (3, 2)
+    assert res[2, 0].params['RA'].value == 6 and res[2, 0].params['RM'].value == 0.5
+    assert res[2, 0].params['junction_potential'].value == 0.0
+
+    values, scores = analysis.convert_to_values(list(res.flat), None, None, 'RA', 'RM')
+    np.testing.assert_array_equal(values[:2], [[2, 0.5], [2, 1.5]])
+    assert scores is None
+
+    missing = analysis.scan_missing(str(tmpdir), list(res.flat)[:-1], params, simtime=0.9)
+    assert [(sim.params['RA'].value, sim.params['RM'].value) for sim in missing] == [(6, 1.5)]
@@ -0,0 +1,309 @@
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import types
+from unittest import mock
+
+import numpy as np
+import pytest
+
+import ajustador
+
+FAKE_MOOSE = any(importlib.util.find_spec(name) is None
+                 for name in ('moose', 'moose_nerp'))
+
+class _AppendFlat(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, (getattr(namespace, self.dest) or []) + list(values))
+
+def _standard_options(default_injection_delay, default_injection_width,
+                      default_injection_current, default_simulation_time,
+                      default_plot_vm):
+    "The options of moose_nerp used by basic_simulation"
+    p = argparse.ArgumentParser()
+    p.add_argument('--injection-current', '-i', type=float, nargs='+',
+                   default=default_injection_current)
+    p.add_argument('--injection-delay', type=float, default=default_injection_delay)
+    p.add_argument('--injection-width', type=float, default=default_injection_width)
+    p.add_argument('--simtime', type=float, default=default_simulation_time)
+    p.add_argument('--plot-vm', default=default_plot_vm)
+    p.add_argument('--plot-current')
+    p.add_argument('--calcium')
+    p.add_argument('--spines')
+    return p
+
+def _listize(func):
+    return lambda *args, **kwargs: list(func(*args, **kwargs))
+
+@pytest.fixture
+def basic_simulation(monkeypatch):
+    """Import basic_simulation, with fake moose and moose_nerp if they are missing
+
+    With the fakes, only the parts which do not talk to moose can be
+    used, or moose must be replaced in the test.
+    """
+    if not FAKE_MOOSE:
+        from ajustador import basic_simulation
+        yield basic_simulation
+        return
+
+    prototypes = mock.MagicMock()
+    prototypes.util.listize = _listize
+    prototypes.standard_options = types.SimpleNamespace(standard_options=_standard_options,
+                                                        AppendFlat=_AppendFlat)
+    modules = {'moose': mock.MagicMock(),
+               'moose_nerp': mock.MagicMock(prototypes=prototypes),
+               'moose_nerp.prototypes': prototypes,
+               'moose_nerp.prototypes.chan_proto': prototypes.chan_proto,
+               'moose_nerp.graph': mock.MagicMock()}
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    from ajustador import basic_simulation
+    yield basic_simulation
+
+    # do not leave the modules using the fakes behind
+    for name in ('basic_simulation', 'regulate_chan_kinetics'):
+        sys.modules.pop('ajustador.' + name, None)
+        ajustador.__dict__.pop(name, None)
+
+@pytest.fixture
+def model(monkeypatch):
+    "A model module which is found by importlib without moose_nerp"
+    module = types.ModuleType('moose_nerp.fakemodel')
+    module.param_cond = types.SimpleNamespace(NAME_SOMA='soma')
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    return module
+
+def _args(*args):
+    return ['--model=fakemodel', '--neuron-type=D1'] + list(args)
+
+def test_copies_reject_abort(basic_simulation, model, monkeypatch):
+    monkeypatch.setattr(basic_simulation, 'setup', mock.Mock())
+    with pytest.raises(SystemExit):
+        basic_simulation.main(_args('-i', '1e-10', '2e-10', '--copies',
+                                    '--abort-max-spikes=3', '--save-vm=iv-{}.npy'))
+    assert not basic_simulation.setup.called
+
+def test_simulation_rejects_copies_with_abort(tmpdir):
+    from ajustador import optimize
+    params = optimize.ParamSet(optimize.AjuParam('junction_potential', 0.0, fixed=True))
+    with pytest.raises(ValueError):
+        optimize.MooseSimulation(str(tmpdir), [1e-10, 2e-10], simtime=0.9,
+                                 injection_delay=0.2, injection_width=0.4,
+                                 copies=True, abort=dict(max_spikes=3), params=params)
+    assert tmpdir.listdir() == []
+
+def _element(path, tick=-1, **attrs):
+    return mock.MagicMock(path=path, tick=tick, **attrs)
+
+def test_setup_copies_uses_the_same_clocks(basic_simulation, model, monkeypatch):
+    fake = mock.MagicMock()
+    elements = {'/D1': _element('/D1'),
+                '/data': _element('/data'),
+                '/data/VmD1_0': _element('/data/VmD1_0', tick=18),
+                '/D1/hsolve': _element('/D1/hsolve', tick=2, dt=5e-5)}
+    def element(path):
+        if not isinstance(path, str):
+            return path
+        return elements.setdefault(path, _element(path))
+    def copy(orig, parent, name):
+        return _element(getattr(parent, 'path', parent).rstrip('/') + '/' + name)
+    def wildcard(path):
+        name = path.split('/')[1]
+        return [_element('/{}/hsolve'.format(name), target='/D1/soma')]
+    fake.element.side_effect = element
+    fake.copy.side_effect = copy
+    fake.wildcardFind.side_effect = wildcard
+    fake.Table.side_effect = _element
+    monkeypatch.setattr(basic_simulation, 'moose', fake)
+
+    pulse_gen = _element('/input/pulse', tick=7)
+    pulse_gen.parent = types.SimpleNamespace(path='/input')
+    param_sim = argparse.Namespace(neuron_type='D1')
+    copies = basic_simulation.setup_copies(param_sim, model, pulse_gen, 3)
+
+    assert [name for name, pg, tab in copies] == ['D1', 'D1_copy1', 'D1_copy2']
+    assert copies[0][1:] == (pulse_gen, elements['/data/VmD1_0'])
+    for name, pg, tab in copies[1:]:
+        assert pg.path == '/input/pulse_' + name
+        assert tab.path == '/data/Vm{}_0'.format(name)
+        fake.useClock.assert_any_call(7, pg.path, 'process')
+        fake.useClock.assert_any_call(18, tab.path, 'process')
+        fake.useClock.assert_any_call(2, '/{}/hsolve'.format(name), 'process')
+    solvers = [call[0][1] for call in fake.useClock.call_args_list if call[0][0] == 2]
+    assert len(solvers) == 2
+
+@pytest.mark.skipif(FAKE_MOOSE, reason='needs moose and moose_nerp')
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_copies_match_separate_runs(basic_simulation, tmpdir):
+    currents = ['-1e-10', '2e-10']
+    common = ['--model=d1d2', '--neuron-type=D1', '--simtime=0.4']
+    with tmpdir.as_cwd():
+        basic_simulation.fork_main(common + ['-i'] + currents +
+                                   ['--copies', '--save-vm=copies-{}.npy'])
+        for current in currents:
+            basic_simulation.fork_main(common + ['-i={}'.format(current),
+                                                 '--save-vm=single-{}.npy'.format(current)])
+        for current in currents:
+            np.testing.assert_allclose(np.load('copies-{}.npy'.format(current)),
+                                       np.load('single-{}.npy'.format(current)),
+                                       atol=1e-6)
+
+class _Run:
+    """Replaces the moose parts of basic_simulation by recording calls
+
+    The simulated time is the sum of the durations passed to advance.
+    save_vm writes the injection current and the durations to the
+    --save-vm file.
+    """
+    def __init__(self, basic_simulation, monkeypatch, aborted=None):
+        self.setups = []
+        self.durations = []
+        self.aborted = aborted
+        self.pulse_gen = types.SimpleNamespace(firstLevel=0)
+        for name in ('setup', 'reinit_simulation', 'advance', 'save_vm'):
+            monkeypatch.setattr(basic_simulation, name, getattr(self, name))
+        monkeypatch.setattr(basic_simulation, 'vm_table', lambda param_sim: None)
+        monkeypatch.setattr(basic_simulation, 'util', mock.MagicMock())
+
+    def setup(self, param_sim, model, save=True):
+        self.setups.append(save)
+        return self.pulse_gen, None
+
+    def reinit_simulation(self, param_sim, model, neurons=None):
+        self.durations.clear()
+
+    def advance(self, param_sim, duration, table):
+        self.durations.append(duration)
+        return self.aborted
+
+    def save_vm(self, param_sim, injection_current, aborted=None):
+        np.save(param_sim.save_vm.format(injection_current),
+                [self.pulse_gen.firstLevel] + self.durations)
+        if aborted is not None:
+            with open(param_sim.save_vm.format(injection_current) + '.aborted', 'w') as f:
+                f.write(aborted)
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_branched_simulations(basic_simulation, model, monkeypatch, tmpdir):
+    run = _Run(basic_simulation, monkeypatch)
+    with tmpdir.as_cwd():
+        basic_simulation.main(_args('-i', '-0.0000000001', '2e-10', '--snapshot',
+                                    '--simtime=0.9', '--injection-delay=0.2',
+                                    '--save-vm=iv-{}.npy'))
+        # each branch continues from the state before the injection
+        np.testing.assert_allclose(np.load('iv--1e-10.npy'), [-1e-10, 0.2, 0.7])
+        np.testing.assert_allclose(np.load('iv-2e-10.npy'), [2e-10, 0.2, 0.7])
+    # the parent only simulated the common part, without the hdf5 output
+    assert run.setups == [False]
+    assert run.durations == [0.2]
+    assert run.pulse_gen.firstLevel == 0
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_branched_simulations_aborted_before_injection(basic_simulation, model,
+                                                        monkeypatch, tmpdir):
+    run = _Run(basic_simulation, monkeypatch, aborted='baseline: -0.05 instead of -0.08')
+    with tmpdir.as_cwd():
+        basic_simulation.main(_args('-i', '-0.0000000001', '2e-10', '--snapshot',
+                                    '--injection-delay=0.2', '--save-vm=iv-{}.npy'))
+        # the branches are saved as they are, without simulating further
+        for name in ('iv--1e-10.npy', 'iv-2e-10.npy'):
+            assert np.load(name)[1:].tolist() == [0.2]
+            assert tmpdir.join(name + '.aborted').read() == run.aborted
+
+def test_snapshot_of_one_injection_is_not_branched(basic_simulation, model,
+                                                   monkeypatch, tmpdir):
+    run = _Run(basic_simulation, monkeypatch)
+    with tmpdir.as_cwd():
+        basic_simulation.main(_args('-i=2e-10', '--snapshot', '--simtime=0.9',
+                                    '--save-vm=iv-{}.npy'))
+        np.testing.assert_allclose(np.load('iv-2e-10.npy'), [2e-10, 0.9])
+    assert run.setups == [True]
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_run_forked(basic_simulation):
+    changed = []
+    assert basic_simulation._run_forked(changed.append, 1) == 0
+    # the child has its own copy of the memory
+    assert changed == []
+    assert basic_simulation._run_forked(sys.exit, 3) == 1
+    assert basic_simulation._run_forked(lambda: 1 / 0) == 1
+    assert basic_simulation._run_forked(lambda: os.kill(os.getpid(), 9)) == -9
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_fork_main(basic_simulation, model, monkeypatch, tmpdir):
+    def main(args):
+        model.changed = True
+        tmpdir.join('args').write(' '.join(args))
+    monkeypatch.setattr(basic_simulation, 'main', main)
+    args = _args('-i=2e-10', '--save-vm=iv.npy')
+    basic_simulation.fork_main(args)
+    assert tmpdir.join('args').read() == ' '.join(args)
+    # changes made by main are discarded with the child
+    assert not hasattr(model, 'changed')
+
+    monkeypatch.setattr(basic_simulation, 'main', lambda args: 1 / 0)
+    with pytest.raises(subprocess.CalledProcessError) as info:
+        basic_simulation.fork_main(args)
+    assert info.value.returncode == 1
+
+def _commands(basic_simulation, monkeypatch):
+    "Record the basic_simulation command lines of optimize instead of running them"
+    from ajustador import optimize
+    commands = []
+    monkeypatch.setattr(basic_simulation, 'fork_main',
+                        lambda args: commands.append(('fork', args)))
+    monkeypatch.setattr(optimize.subprocess, 'check_call',
+                        lambda cmdline: commands.append(('exec', cmdline[2:])))
+    return optimize, commands
+
+def test_warm_simulation_is_forked(basic_simulation, monkeypatch):
+    optimize, commands = _commands(basic_simulation, monkeypatch)
+    params = dict(model='fakemodel', neuron_type='D1', RA=4.5)
+    optimize._run_basic_simulation([2e-10], params, dict(warm=True))
+    optimize._run_basic_simulation([2e-10], params, dict(warm=False))
+
+    args = ['-i=2e-10', '--save-vm=' + optimize.iv_filename(2e-10),
+            '--model=fakemodel', '--neuron-type=D1', '--RA=4.5']
+    expected = 'fork' if hasattr(os, 'fork') else 'exec'
+    assert commands == [(expected, args), ('exec', args)]
+
+def test_multiple_injections(basic_simulation, model, monkeypatch, tmpdir):
+    run = _Run(basic_simulation, monkeypatch, aborted='spikes: 5 > 3')
+    simulated = []
+    def run_simulation(injection_current, simtime, param_sim, model):
+        simulated.append((injection_current, simtime))
+        return run.aborted if injection_current > 1e-10 else None
+    monkeypatch.setattr(basic_simulation, 'run_simulation', run_simulation)
+    with tmpdir.as_cwd():
+        basic_simulation.main(_args('-i', '-0.0000000001', '2e-10', '--simtime=0.9',
+                                    '--save-vm=iv-{}.npy'))
+        assert not tmpdir.join('iv--1e-10.npy.aborted').exists()
+        assert tmpdir.join('iv-2e-10.npy.aborted').read() == run.aborted
+    # the model is built once and reinitialized for each current
+    assert run.setups == [True]
+    assert simulated == [(-1e-10, 0.9), (2e-10, 0.9)]
+
+    with pytest.raises(SystemExit):
+        basic_simulation.main(_args('-i', '1e-10', '2e-10', '--save-vm=iv.npy'))
+
+def test_multiple_injections_command_line(basic_simulation, model, monkeypatch):
+    optimize, commands = _commands(basic_simulation, monkeypatch)
+    params = dict(model='fakemodel', neuron_type='D1')
+    injections = [-1.5e-10, 2e-10, np.float64(-5e-11)]
+    optimize._run_basic_simulation(injections, params, dict(warm=False, snapshot=True))
+
+    (how, args), = commands
+    assert args[:5] == ['-i', '-0.00000000015', '0.0000000002', '-0.00000000005',
+                        '--snapshot']
+    assert args[5] == '--save-vm=' + optimize.iv_filename('{}')
+
+    # all currents are parsed back exactly, as a single option
+    parser = basic_simulation.option_parser()
+    opts = parser.parse_args(args)
+    assert opts.injection_current == injections
+    assert opts.snapshot
+    saved = [opts.save_vm.format(injection) for injection in opts.injection_current]
+    assert saved == [optimize.iv_filename(injection) for injection in injections]
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from ajustador import detect
+
+def _reference(y, min_high_ratio=0.25, P_low=0.5, P_high=0.5, both=False):
+    # the original sample-by-sample implementation
+    ans = []
+    low_i, low = 0, y[0]
+    high_i, high = 0, y[0]
+
+    i = (y > y.max() * min_high_ratio).argmax()
+    while True:
+        for i in range(i, len(y)):
+            if y[i] < low:
+                low_i, low = i, y[i]
+            if y[i] > high:
+                high_i, high = i, y[i]
+            if y[i] - low < (high - low) * P_high:
+                break
+        else:
+            break
+        ans.append(high_i)
+        low_i, low = i, y[i]
+
+        for i in range(i, len(y)):
+            if y[i] < low:
+                low_i, low = i, y[i]
+            if y[i] > high:
+                high_i, high = i, y[i]
+            if y[i] - low > (high - low) * P_low:
+                break
+        else:
+            break
+        if both:
+            ans.append(low_i)
+        high_i, high = i, y[i]
+    return ans
+
+def _traces(count=12, size=3000):
+    rng = np.random.RandomState(7)
+    t = np.arange(size) * 1e-4
+    for i in range(count):
+        freq = rng.uniform(5, 60)
+        y = -0.07 + 0.1 * np.clip(np.sin(2 * np.pi * freq * t), 0, None) ** 8
+        yield y + rng.normal(0, 0.002 * (i % 3), size)
+
+@pytest.mark.parametrize('both', [False, True])
+def test_detect_peaks_matches_reference(both):
+    traces = np.array(list(_traces()))
+    for y in traces:
+        expected = _reference(y, P_low=0.75, P_high=0.5, both=both)
+        peaks = detect.detect_peaks(y, P_low=0.75, P_high=0.5, both=both)
+        assert peaks.tolist() == expected
+
+    batch = detect.detect_peaks_batch(traces, P_low=0.75, P_high=0.5, both=both, chunk=64)
+    assert [peaks.tolist() for peaks in batch] == \
+        [_reference(y, P_low=0.75, P_high=0.5, both=both) for y in traces]
+
+def test_detect_peaks_flat():
+    assert detect.detect_peaks(np.zeros(100)).tolist() == _reference(np.zeros(100))
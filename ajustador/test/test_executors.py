@@ -0,0 +1,73 @@
+import math
+import pickle
+import concurrent.futures
+
+import pytest
+
+from ajustador import executors
+
+def _check(executor):
+    values = [-3, 1, -4, 1, -5]
+    assert executor.map(abs, values) == [3, 1, 4, 1, 5]
+
+    results = []
+    res = executor.map_async(abs, values, callback=results.append)
+    assert res.get(timeout=10) == [3, 1, 4, 1, 5]
+    res.wait()
+    assert res.ready()
+    assert results == [[3, 1, 4, 1, 5]]
+
+def test_futures_executor():
+    executor = executors.FuturesExecutor(concurrent.futures.ThreadPoolExecutor(2))
+    _check(executor)
+    executor.shutdown()
+
+def test_cluster_executor():
+    nodes = [executors.WorkerNode(('localhost', 0), b'test', processes=2)
+             for i in range(2)]
+    threads = [executors.threading.Thread(target=node.serve_forever, daemon=True)
+               for node in nodes]
+    for thread in threads:
+        thread.start()
+
+    executor = executors.ClusterExecutor([node.address for node in nodes], authkey=b'test')
+    try:
+        _check(executor)
+
+        with pytest.raises(ValueError):
+            executor.map(math.sqrt, [4, -1])
+
+        # jobs which cannot be pickled fail without taking the slots down
+        res = executor.map_async(lambda x: x, [1] * 8)
+        with pytest.raises((pickle.PicklingError, AttributeError)):
+            res.get(timeout=10)
+        _check(executor)
+    finally:
+        executor.shutdown()
+        for node in nodes:
+            node.close()
+
+def _lost_node(listener):
+    "Accept one job and close the connection without replying"
+    with listener.accept() as conn:
+        conn.send(('hello', 1))
+        conn.recv()
+
+def test_cluster_executor_lost_node():
+    listener = executors.Listener(('localhost', 0), authkey=b'test')
+    thread = executors.threading.Thread(target=_lost_node, args=(listener,), daemon=True)
+    thread.start()
+
+    executor = executors.ClusterExecutor([listener.address], authkey=b'test')
+    try:
+        res = executor.map_async(abs, [-3, 1, -4])
+        with pytest.raises(ConnectionError):
+            res.get(timeout=10)
+        assert all(future.done() for future in res._futures)
+
+        # there are no nodes left to run new jobs
+        with pytest.raises(ConnectionError):
+            executor.map(abs, [-5])
+    finally:
+        executor.shutdown()
+        listener.close()
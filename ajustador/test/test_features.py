@@ -0,0 +1,169 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from ajustador import loader, features, fitnesses
+
+class _Params:
+    requires = ()
+    provides = ('baseline_before', 'baseline_after',
+                'steady_after', 'steady_before', 'steady_cutoff',
+                'injection_start', 'injection_end', 'injection_interval',
+                'falling_curve_window')
+    baseline_before = 0.2
+    baseline_after = 0.75
+    steady_after = 0.25
+    steady_before = 0.6
+    steady_cutoff = 80
+    injection_start = 0.2
+    injection_end = 0.6
+    injection_interval = 0.4
+    falling_curve_window = 20
+
+def _traces():
+    rng = np.random.RandomState(3)
+    x = np.arange(9000) * 1e-4
+    inside = (x > 0.2) & (x < 0.6)
+    for injection in (-2e-10, -1e-10, 1e-10, 2e-10):
+        y = np.full(x.size, -0.08)
+        if injection < 0:
+            y[inside] += injection * 1e8 * (1 - np.exp(-(x[inside] - 0.2) / 0.02))
+        else:
+            y[inside] += 0.01 + 0.1 * np.clip(np.sin(2 * np.pi * injection * 1e11 * x[inside]),
+                                              0, None) ** 8
+        yield injection, x, y + rng.normal(0, 0.0005, x.size)
+
+def _waves():
+    params = _Params()
+    return [loader.Trace(injection, x, y, (params, *features.standard_features))
+            for injection, x, y in _traces()]
+
+def _same(a, b):
+    if isinstance(a, features.vartype.vartype):
+        np.testing.assert_allclose([a.x, a.dev], [b.x, b.dev], rtol=1e-6)
+    else:
+        np.testing.assert_allclose(a, b, rtol=1e-6)
+
+def test_batch_features_match_traces():
+    expected, batched = _waves(), _waves()
+    features.precompute(batched)
+
+    for one, other in zip(expected, batched):
+        assert hasattr(other._attributes['spikes'], '_spike_i_and_threshold_value')
+        for name in ('baseline', 'baseline_pre', 'baseline_post', 'steady', 'response',
+                     'spike_i', 'spike_threshold', 'rectification',
+                     'charging_curve_halfheight',
+                     'falling_curve_amp', 'falling_curve_tau'):
+            _same(getattr(one, name), getattr(other, name))
+
+    assert [wave.spike_count for wave in batched] == [0, 0, 4, 8]
+
+def test_spike_thresholds():
+    for injection, x, y in _traces():
+        peaks = features.detect.detect_peaks(y, P_low=0.75, P_high=0.50)
+        peaks = np.r_[0, 1, peaks]
+        expected = []
+        for peak in peaks:
+            start = (x >= x[peak] - 0.004).argmax()
+            window = y[start:peak + 1]
+            yderiv = np.diff(window)
+            try:
+                expected.append(window[1:][yderiv > 0.02 * yderiv.max()].min())
+            except ValueError:
+                expected.append(np.nan)
+        thresholds = features._spike_thresholds(x, y, peaks, 0.004, 0.02)
+        np.testing.assert_array_equal(thresholds, expected)
+
+def test_spike_bounds():
+    wave = _waves()[-1]
+    bounds = wave.spike_bounds
+    assert len(bounds) == wave.spike_count == 8
+
+    y = wave.wave.y
+    halfheight = (wave.spikes.y + wave.spike_threshold) / 2
+    for i, k in enumerate(wave.spike_i):
+        beg = end = k
+        while beg > 1 and y[beg - 1] > halfheight[i]:
+            beg -= 1
+        while end + 2 < y.size and y[end + 1] > halfheight[i]:
+            end += 1
+        assert (bounds.left_i[i], bounds.right_i[i]) == (beg, end)
+        assert bounds[i].width == bounds.width[i]
+
+    windows = wave.spike_ahp_window
+    assert (windows.left_i >= bounds.right_i).all()
+    assert (wave.spike_ahp.x < wave.spike_threshold).all()
+
+def test_fast_falling_curve_fit():
+    rng = np.random.RandomState(5)
+    x = np.arange(2000) * 1e-4 + 0.2
+    ccuts = [np.rec.fromarrays((x, -0.08 + amp * (1 - np.exp(-(x - 0.2) / tau))
+                                + rng.normal(0, noise, x.size)), names='x,y')
+             for amp, tau, noise in [(-0.01, 0.02, 0), (-0.02, 0.005, 0.0005), (-0.005, 0.05, 0)]]
+    baselines = [features.vartype.vartype(-0.08, 0.0001)] * 3
+    steadys = [features.vartype.vartype(-0.1, 0.0001)] * 3
+
+    # no fallback to curve_fit is needed for these
+    assert None not in features._fast_exp_fits(ccuts, [-0.08] * 3, 0.1, 8)
+    fast = features._fit_falling_curves(ccuts, baselines, steadys, fast=True)
+    slow = features._fit_falling_curves(ccuts, baselines, steadys, fast=False)
+    for one, other in zip(fast, slow):
+        assert one.good and other.good
+        for a, b in zip(one.params, other.params):
+            np.testing.assert_allclose([a.x, a.dev], [b.x, b.dev], rtol=1e-3, atol=1e-12)
+    np.testing.assert_allclose([fit.params.tau.x for fit in fast], [0.02, 0.005, 0.05], rtol=0.05)
+
+class _Set(loader.Attributable):
+    def __init__(self, waves):
+        super().__init__((_Params(),) + tuple(features.standard_features))
+        self.waves = np.array(waves, dtype=object)
+
+def test_alignment_is_shared():
+    sim, measurement = _Set(_waves()[1:]), _Set(_waves())
+    m1, m2 = fitnesses._select(sim, measurement, 'negative_injection')
+    assert list(m1.injection) == list(m2.injection) == [-1e-10]
+    assert fitnesses._select(sim, measurement, 'negative_injection')[0] is m1
+
+    m1, m2 = fitnesses._select(sim, measurement, measurement.injection > 0)
+    assert list(m1.injection) == list(m2.injection) == [1e-10, 2e-10]
+
+    sim.waves = sim.waves[::-1]
+    m1, m2 = fitnesses._select(sim, measurement, 'negative_injection')
+    assert list(m1.injection) == [-1e-10]
+
+def test_alignment_of_some_injections():
+    waves = _waves()
+    measurement = _Set(waves)
+    sim = _Set([waves[0], waves[3]])
+    m1, m2 = fitnesses._select(sim, measurement, 'any_spikes')
+    assert list(m1.injection) == list(m2.injection) == [2e-10]
+    assert fitnesses.ahp_curve_fitness(sim, measurement) < 1e-6
+
+    sim = _Set([waves[1]])
+    m1, m2 = fitnesses._select(sim, measurement, 'any_spikes')
+    assert len(m1) == len(m2) == 0
+
+class _Measurement(loader.Measurement):
+    def _waves(self):
+        return _waves()
+
+def test_frozen_measurement():
+    measurement = _Measurement('recording/cell.1', _Params(),
+                               features=features.standard_features)
+    params = _Params()
+    sim = _Set([loader.Trace(injection, x, y + 0.002, (params, *features.standard_features))
+                for injection, x, y in _traces()])
+    fitness = fitnesses.combined_fitness('new_combined_fitness', spike_time=0,
+                                         spike_range_y_histogram=0)
+    frozen = loader.FrozenMeasurement(measurement, fitness.targets)
+    frozen = pickle.loads(pickle.dumps(frozen))
+
+    assert frozen.name == 'cell'
+    assert list(frozen.injection) == list(measurement.injection)
+    assert fitness(sim, frozen) == fitness(sim, measurement)
+
+    with pytest.raises(AttributeError):
+        frozen.waves[0].steady
+    with pytest.raises(ValueError):
+        frozen.waves[-1].spike_ahp_position[0] = 0
@@ -0,0 +1,305 @@
+import numpy as np
+import pytest
+
+from ajustador import loader, optimize, fitnesses, features
+
+class _Params:
+    requires = ()
+    provides = ('baseline_before', 'baseline_after',
+                'steady_after', 'steady_before', 'steady_cutoff',
+                'injection_start', 'injection_end', 'injection_interval',
+                'falling_curve_window')
+    baseline_before = 0.2
+    baseline_after = 0.75
+    steady_after = 0.25
+    steady_before = 0.6
+    steady_cutoff = 80
+    injection_start = 0.2
+    injection_end = 0.6
+    injection_interval = 0.4
+    falling_curve_window = 20
+
+INJECTIONS = (-2e-10, -1e-10, 1e-10, 2e-10)
+
+def _trace(injection, resistance, features):
+    "A passive response to injection, without any noise"
+    x = np.arange(901) * 1e-3
+    inside = (x >= 0.2) & (x < 0.6)
+    y = np.full(x.size, -0.08)
+    y[inside] += injection * resistance * (1 - np.exp(-(x[inside] - 0.2) / 0.02))
+    return loader.IVCurve(None, None, injection, x, y, features)
+
+class _Measurement(loader.Measurement):
+    def _waves(self):
+        return [_trace(injection, 1e8, self.features) for injection in INJECTIONS]
+
+class _Simulation(optimize.MooseSimulation):
+    "Computes the traces in the calling process instead of running moose"
+    executed = []
+
+    def execute_for(self, injection_currents, junction_potential, single, **options):
+        self.executed.append(tuple(injection_currents))
+        self._result = None
+        resistance = self.params['resistance'].value
+        self._set_result([[_trace(injection, resistance, self.features)
+                           for injection in injection_currents]])
+
+class _Optimizer:
+    "Asks for random points around 1 and records what it is told"
+    def __init__(self, popsize, stop_after=None):
+        self.popsize = popsize
+        self.random = np.random.RandomState(0)
+        self.asked, self.told = [], []
+        self.logger = self
+        self.stop_after = stop_after
+
+    def ask(self, number=None):
+        points = [list(1 + self.random.uniform(-0.8, 2, 1))
+                  for i in range(number or self.popsize)]
+        self.asked.extend(points)
+        return points
+
+    def tell(self, points, values):
+        assert len(points) == len(values) == self.popsize
+        self.told.extend(zip(points, values))
+
+    def stop(self):
+        return self.stop_after is not None and len(self.told) >= self.stop_after
+
+    def add(self):
+        pass
+
+    def disp(self):
+        pass
+
+def _fit(tmpdir, params=None, **options):
+    measurement = _Measurement(str(tmpdir.join('recording')), _Params(),
+                               features=features.standard_features)
+    if params is None:
+        params = optimize.ParamSet(optimize.AjuParam('resistance', 1e8, min=1e7, max=1e9),
+                                   optimize.AjuParam('junction_potential', 0.0, fixed=True))
+    fitness = fitnesses.combined_fitness('empty', response=1, baseline=1,
+                                         spike_count=1, ahp_curve=1)
+    return optimize.Fit(str(tmpdir.join('fit')), measurement, None, None, fitness, params,
+                        _make_simulation=_Simulation.make, **options)
+
+def _complete(fit):
+    return sorted(sim.name for i, n, sim in
+                  optimize.SimulationResults(fit.dirname, fit.measurement.features).load())
+
+def test_racing(tmpdir):
+    fit = _fit(tmpdir, racing=True)
+    first = fit.fitness_multi([[1.0], [1.2], [2.0], [3.0]])
+    assert len(_complete(fit)) == 4
+    assert first[0] < 1e-6 < first[1] < first[2] < first[3]
+
+    _Simulation.executed.clear()
+    second = fit.fitness_multi([[0.9], [6.0], [1.1], [8.0]])
+    # the hopeless candidates are only simulated at the first injection,
+    # the others at one more injection in each of the three rounds
+    assert len(_Simulation.executed) == 4 + 2 * 3
+    assert second[1] > first[1] and second[3] > first[1]
+    assert sorted(fit._fitness_value) == [(0.9,), (1.0,), (1.1,), (1.2,), (2.0,), (3.0,)]
+    assert sorted(fit._sim_value) == sorted(fit._fitness_value)
+    assert len(fit._history) == 6
+    assert len(_complete(fit)) == 6
+    assert len(tmpdir.join('fit').listdir(lambda path: path.isdir())) == 6
+
+class _SpikingSimulation(_Simulation):
+    "Candidates with high resistance are aborted at the largest injection"
+    def execute_for(self, injection_currents, junction_potential, single, **options):
+        super().execute_for(injection_currents, junction_potential, single, **options)
+        if self.params['resistance'].value > 5e8:
+            for wave in self.waves:
+                if wave.injection == max(INJECTIONS):
+                    wave.aborted = 'spikes: 120 > 100'
+
+def test_racing_drops_aborted(tmpdir):
+    fit = _fit(tmpdir, racing=True)
+    fit._make_simulation = _SpikingSimulation.make
+    _Simulation.executed.clear()
+    values = fit.fitness_multi([[1.0], [6.0], [1.1], [1.2]])
+
+    # the aborted candidate is not simulated after the first injection,
+    # even before there is a threshold
+    assert len(_Simulation.executed) == 4 + 3 * 3
+    assert values[1] == fit.fitness_max
+    assert values[0] < values[2] < values[3] < fit.fitness_max
+    assert sorted(fit._fitness_value) == [(1.0,), (1.1,), (1.2,)]
+    assert len(_complete(fit)) == 3
+
+def test_screening(tmpdir):
+    fidelity = optimize.Fidelity(injections=[-2e-10, 2e-10], promote=2)
+    fit = _fit(tmpdir, fidelity=fidelity)
+    _Simulation.executed.clear()
+    values = fit.fitness_multi([[3.0], [1.0], [2.0], [1.2]])
+
+    # all candidates at the two injections, the best two at all four
+    assert sorted(_Simulation.executed, key=len) == [(-2e-10, 2e-10)] * 4 + [INJECTIONS] * 2
+    assert sorted(fit._fitness_value) == [(1.0,), (1.2,)]
+    assert values[1] < values[3] <= values[2] <= values[0]
+    assert len(fit._calibration) == 2
+    assert fit.calibrated(0.5) == 0.5
+
+    # only the simulations at all injections keep their features
+    saved = tmpdir.join('fit').visit(optimize.FEATURES_FILE)
+    assert sorted(path.dirpath().basename for path in saved) == _complete(fit)
+    # the screening simulations are complete at their injections
+    screening = optimize.storage.Manifest(str(tmpdir.join('fit', 'screening')))
+    assert len(screening) == 4
+
+    fit._calibration = [(0.1, 0.2), (0.1, 0.3), (0.1, np.nan)]
+    assert fit.calibrated(0.5) == 0.5
+    fit._calibration = [(0.1, 0.2), (0.2, 0.4), (0.3, 0.6), (np.inf, 1)]
+    assert fit.calibrated(0.5) == pytest.approx(1.0)
+
+def test_screening_aborts(tmpdir):
+    fidelity = optimize.Fidelity(injections=[-2e-10, 2e-10], promote=2)
+    fit = _fit(tmpdir, fidelity=fidelity, abort_criteria=dict(max_spikes=100))
+    fit._make_simulation = _SpikingSimulation.make
+    _Simulation.executed.clear()
+    values = fit.fitness_multi([[6.0], [1.0], [2.0], [1.2]])
+
+    assert fit.screening_sim([6.0]).abort == dict(max_spikes=100)
+    # the aborted candidate is not promoted
+    assert sorted(_Simulation.executed, key=len) == [(-2e-10, 2e-10)] * 4 + [INJECTIONS] * 2
+    assert sorted(fit._fitness_value) == [(1.0,), (1.2,)]
+    assert values[0] == max(values)
+
+def test_surrogate_prescreening(tmpdir):
+    fit = _fit(tmpdir)
+    fit.optimizer = _Optimizer(4)
+    with pytest.raises(ValueError):
+        fit.do_fit(1, surrogate=True, explore=5)
+    with pytest.raises(ValueError):
+        fit.do_fit(1, surrogate=True, oversample=0)
+
+    fit.do_fit(3, surrogate=True, oversample=3, explore=1)
+    # the first population is simulated as asked, the others are picked
+    # from three times as many candidates
+    assert len(fit.optimizer.asked) == 4 + 2 * 12
+    assert len(fit.optimizer.told) == len(fit._fitness_value) == 12
+
+    candidates = [point[0] for point in fit.optimizer.asked[-12:]]
+    told = [point[0] for point, value in fit.optimizer.told[-4:]]
+    assert set(told) <= set(candidates)
+
+class _SlowSimulation(_Simulation):
+    "Candidates with high resistance take a few polls to finish"
+    def ready(self):
+        self.polls = getattr(self, 'polls', 0) + 1
+        return self.params['resistance'].value < 2e8 or self.polls > 3
+
+def test_steady_state(tmpdir):
+    fit = _fit(tmpdir)
+    fit._make_simulation = _SlowSimulation.make
+    fit.optimizer = _Optimizer(4)
+    fit.do_fit(3, steady_state=True, window=6)
+
+    asked = [tuple(point) for point in fit.optimizer.asked]
+    told = [tuple(point) for point, value in fit.optimizer.told]
+    # points asked only to be allowed to tell again are not simulated
+    assert len(told) == len(set(told)) == len(fit._sim_value) == 12
+    assert set(told) <= set(asked)
+    # slow candidates were overtaken by the ones asked after them
+    assert told != [point for point in asked if point in told]
+    assert fit._async
+
+@pytest.mark.parametrize('popsize, window', [(8, 12), (4, 6)])
+@pytest.mark.parametrize('seed', range(5))
+def test_steady_state_with_cma(tmpdir, monkeypatch, popsize, window, seed):
+    # popsize < 6 uses mirrored sampling
+    monkeypatch.chdir(tmpdir)   # cma writes its log to the current directory
+    params = optimize.ParamSet(optimize.AjuParam('resistance', 1e8, min=1e7, max=1e9),
+                               optimize.AjuParam('capacitance', 1.0, min=0.1, max=10),
+                               optimize.AjuParam('junction_potential', 0.0, fixed=True))
+    fit = _fit(tmpdir, params=params)
+    fit._make_simulation = _SlowSimulation.make
+    fit.do_fit(4, popsize=popsize, seed=seed + 1, steady_state=True, window=window,
+               sigma=0.5)
+    assert fit.optimizer.countiter == 4
+    assert len(fit._sim_value) == 4 * popsize
+
+def test_steady_state_rejects_unsupported_options(tmpdir):
+    fit = _fit(tmpdir)
+    fit.optimizer = _Optimizer(4)
+    with pytest.raises(ValueError):
+        fit.do_fit(1, steady_state=True, surrogate=True)
+    fit.racing = True
+    with pytest.raises(ValueError):
+        fit.do_fit(1, steady_state=True)
+    assert fit.optimizer.asked == []
+
+class _OffsetSimulation(_Simulation):
+    """The model is 12 mV below the measurement, like a junction potential
+
+    The baseline is checked on the simulated voltage, as in the worker.
+    """
+    offset = -0.012
+
+    def execute_for(self, injection_currents, junction_potential, single, **options):
+        self.executed.append(tuple(injection_currents))
+        self._result = None
+        resistance = self.params['resistance'].value
+        waves = []
+        for injection in injection_currents:
+            voltage = _trace(injection, resistance, self.features).wave.y + self.offset
+            aborted = None
+            if abs(voltage[0] - self.abort['baseline']) > self.abort['baseline_tolerance']:
+                aborted = '0.9 baseline: {} instead of {}'.format(voltage[0],
+                                                                  self.abort['baseline'])
+            waves.append(optimize._ivcurve(injection, voltage, 0.9, junction_potential,
+                                           self.features, aborted=aborted, dt=1e-3))
+        self._set_result([waves])
+
+def test_abort_baseline_with_junction_potential(tmpdir):
+    params = optimize.ParamSet(optimize.AjuParam('resistance', 1e8, min=1e7, max=1e9),
+                               optimize.AjuParam('junction_potential', -0.012,
+                                                 min=-0.05, max=0.05))
+    fit = _fit(tmpdir, params=params, abort_criteria=dict(baseline_tolerance=0.01))
+    fit._make_simulation = _OffsetSimulation.make
+    _Simulation.executed.clear()
+
+    # with a junction potential of 0 the model is 12 mV off
+    other = fit.sim(params.scale([1e8, 0.0]))
+    assert other.waves[0].aborted.startswith('baseline')
+    assert len(_Simulation.executed) == 1
+
+    # the corrected baseline matches the measurement, and the traces
+    # aborted on the baseline are not reused for it
+    sim = fit.sim(params.scale([1e8, -0.012]))
+    assert sim.abort['baseline'] == pytest.approx(fit.measurement.mean_baseline.x - 0.012)
+    assert len(_Simulation.executed) == 2
+    assert not any(wave.aborted for wave in sim.waves)
+    assert fit.fitness(params.scale([1e8, -0.012])) < 1e-6
+
+def _saved_features(path):
+    fingerprint, injections, values = optimize.pickle.loads(path.read_binary())
+    return optimize._snapshot_keys(values)
+
+def test_features_are_saved_again(tmpdir):
+    fit = _fit(tmpdir)
+    sim = fit.sim([1.0])
+    fit.fitness([1.0])
+    path = tmpdir.join('fit', optimize.os.path.basename(sim.tmpdir.name), optimize.FEATURES_FILE)
+    saved = _saved_features(path)
+    assert saved
+
+    # values computed later are added to the snapshot
+    [wave.falling_curve_tau for wave in sim.waves]
+    fit._save_features(sim)
+    assert _saved_features(path) > saved
+
+def test_features_of_archived_simulations(tmpdir):
+    fit = _fit(tmpdir, simulation_options=dict(archive=True))
+    sim = fit.sim([1.0])
+    fit.fitness([1.0])
+    [wave.falling_curve_tau for wave in sim.waves]
+    fit._save_features(sim)
+    assert not optimize.os.path.exists(sim.tmpdir.name)
+
+    entry, = optimize.storage.ResultArchive(fit.dirname).entries()
+    (i, n, result), = optimize.SimulationResults(fit.dirname, fit.measurement.features).load()
+    result.waves
+    assert result._features_saved == optimize._snapshot_keys(entry.features[2])
+    assert 'FallingCurve' in {name for inj, name, attr in result._features_saved}
@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from ajustador import optimize
+
+def test_load_aborted_simulation(tmpdir):
+    ivfile = str(tmpdir.join(optimize.iv_filename(2e-10)))
+    np.save(ivfile, np.full(101, -0.05))
+
+    iv = optimize.load_simulation(ivfile, simtime=0.9, junction_potential=-0.01, features=[])
+    assert iv.aborted is None
+    assert iv.wave.x[-1] == 0.9
+    np.testing.assert_allclose(iv.wave.y, -0.04)
+
+    with open(ivfile + '.aborted', 'w') as f:
+        print(0.25, 'spikes: 120 > 100', file=f)
+    iv = optimize.load_simulation(ivfile, simtime=0.9, junction_potential=-0.01, features=[])
+    assert iv.aborted == 'spikes: 120 > 100'
+    assert iv.wave.x[-1] == 0.25
+
+def test_simulation_result_is_lazy(tmpdir):
+    params = dict(simtime=0.9,
+                  junction_potential=optimize.AjuParam('junction_potential', -0.01, fixed=True))
+    with open(str(tmpdir.join('params.pickle')), 'wb') as f:
+        optimize.pickle.dump(params, f)
+    for injection in (2e-10, -1e-10):
+        np.save(str(tmpdir.join(optimize.iv_filename(injection))), np.full(101, -0.05))
+
+    result = optimize.MooseSimulationResult(str(tmpdir), features=[])
+    assert '_waves_value' not in result.__dict__
+    assert result.params['simtime'].value == 0.9
+
+    assert list(result.injection) == [-1e-10, 2e-10]
+    np.testing.assert_allclose(result.waves[0].wave.y, -0.04)
+
+class _Params:
+    requires = ()
+    provides = ('baseline_before', 'baseline_after',
+                'steady_after', 'steady_before', 'steady_cutoff')
+    baseline_before = 0.2
+    baseline_after = 0.75
+    steady_after = 0.25
+    steady_before = 0.6
+    steady_cutoff = 80
+
+def test_features_are_restored(tmpdir):
+    with open(str(tmpdir.join('params.pickle')), 'wb') as f:
+        optimize.pickle.dump(dict(simtime=0.9), f)
+    np.save(str(tmpdir.join(optimize.iv_filename(2e-10))), np.full(101, -0.05))
+    features = (_Params(), optimize._features.SteadyState)
+
+    result = optimize.MooseSimulationResult(str(tmpdir), features=features)
+    baseline = result.waves[0].baseline
+    optimize.save_features(str(tmpdir), features, result.waves)
+
+    # poison the trace, so that a recomputed value would differ
+    np.save(str(tmpdir.join(optimize.iv_filename(2e-10))), np.full(101, 0.0))
+    result = optimize.MooseSimulationResult(str(tmpdir), features=features)
+    assert result.waves[0].baseline.x == baseline.x
+
+    class Other(_Params):
+        baseline_before = 0.1
+    result = optimize.MooseSimulationResult(str(tmpdir), features=(Other(), features[1]))
+    assert result.waves[0].baseline.x == 0
+
+    # a snapshot of other injections is not restored
+    optimize.save_features(str(tmpdir), features, result.waves[:0])
+    result = optimize.MooseSimulationResult(str(tmpdir), features=features)
+    assert result.waves[0].baseline.x == 0
+
+def test_aggregates_are_cached(tmpdir):
+    with open(str(tmpdir.join('params.pickle')), 'wb') as f:
+        optimize.pickle.dump(dict(simtime=0.9), f)
+    for injection in (2e-10, -1e-10):
+        np.save(str(tmpdir.join(optimize.iv_filename(injection))), np.full(101, -0.05))
+    features = (_Params(), optimize._features.SteadyState)
+
+    result = optimize.MooseSimulationResult(str(tmpdir), features=features)
+    baseline = result.baseline
+    assert result.baseline is baseline
+    assert result.mean_baseline is result.mean_baseline
+
+    part = result[:1]
+    assert len(part.baseline) == 1
+    assert len(result.baseline) == 2
+    assert part.mean_baseline is not result.mean_baseline
+
+    with pytest.raises(ValueError):
+        result.injection.sort()
+    assert list(result.injection) == [-1e-10, 2e-10]
+
+def test_unindexed_simulations_are_listed(tmpdir):
+    for name, created in (('tmp1', 1), ('tmp2', 2), ('tmp3', 3)):
+        dir = tmpdir.mkdir(name)
+        with open(str(dir.join('params.pickle')), 'wb') as f:
+            optimize.pickle.dump(dict(simtime=0.9), f)
+        np.save(str(dir.join(optimize.iv_filename(2e-10))), np.full(101, -0.05))
+        dir.join('.complete').write('')
+        optimize.os.utime(str(dir.join('params.pickle')), (created, created))
+
+    # a manifest which only lists some of the simulations
+    optimize.storage.Manifest(str(tmpdir)).add('tmp2', dict(simtime=0.9), [2e-10], created=2)
+
+    # only the manifest is used until it is rebuilt
+    results = optimize.SimulationResults(str(tmpdir), features=[])
+    names = [optimize.os.path.basename(result.dirname) for i, n, result in results.load()]
+    assert names == ['tmp2']
+    results.rebuild_manifest()
+    names = [optimize.os.path.basename(result.dirname) for i, n, result in results.load()]
+    assert names == ['tmp1', 'tmp2', 'tmp3']
+    assert results.manifest().names() == ['tmp1', 'tmp2', 'tmp3']
+
+def test_missing_manifest_is_built(tmpdir):
+    dir = tmpdir.mkdir('tmp1')
+    with open(str(dir.join('params.pickle')), 'wb') as f:
+        optimize.pickle.dump(dict(simtime=0.9), f)
+    np.save(str(dir.join(optimize.iv_filename(2e-10))), np.full(101, -0.05))
+    dir.join('.complete').write('')
+
+    results = optimize.SimulationResults(str(tmpdir), features=[])
+    assert [result.name for i, n, result in results.load()] == ['tmp1']
+    assert optimize.storage.Manifest.exists(str(tmpdir))
+
+    # the parameters are taken from the manifest
+    dir.join('params.pickle').remove()
+    (i, n, result), = results.load()
+    assert result.params['simtime'].value == 0.9
@@ -0,0 +1,17 @@
+from ajustador.optimize import AjuParam, Param, ParamSet
+
+def test_postprocessing_params():
+    params = ParamSet(AjuParam('junction_potential', -0.011, min=-0.020, max=-0.005),
+                      AjuParam('RA', 5.0, min=1, max=10),
+                      Param('morph_file', 'D1_short_patch.p'))
+    assert params['junction_potential'].postprocessing
+    assert not params['RA'].postprocessing
+    assert params.postprocessing == (params['junction_potential'],)
+
+    updated = params.updated(junction_potential=-0.015)
+    assert updated['junction_potential'].postprocessing
+
+    a = params.physics_key(params.scale([-0.011, 5.0]))
+    b = params.physics_key(params.scale([-0.015, 5.0]))
+    c = params.physics_key(params.scale([-0.011, 6.0]))
+    assert a == b != c
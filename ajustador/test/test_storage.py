@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+
+from ajustador import storage
+
+def test_simulation_cache(tmpdir):
+    cache = storage.SimulationCache(str(tmpdir.join('cache')))
+    params = dict(RA=np.float64(4.5), model='d1d2', simtime=0.9, junction_potential=-0.013)
+    key = cache.key(params, -5e-11, b'morph')
+
+    assert key == cache.key(dict(params, RA=4.5), -5e-11, b'morph')
+    assert key == cache.key(dict(params, junction_potential=0), -5e-11, b'morph')
+    assert key != cache.key(dict(params, RA=4.6), -5e-11, b'morph')
+    assert key != cache.key(params, -6e-11, b'morph')
+    assert key != cache.key(params, -5e-11, b'other morph')
+
+    with tmpdir.as_cwd():
+        assert not cache.fetch(key, 'ivdata-1.npy')
+        np.save('ivdata-1.npy', np.arange(5.0))
+        cache.store(key, 'ivdata-1.npy')
+        os.mkdir('other')
+        os.chdir('other')
+        assert cache.fetch(key, 'ivdata-1.npy')
+        np.testing.assert_array_equal(np.load('ivdata-1.npy'), np.arange(5.0))
+
+def test_simulation_cache_key_options():
+    from ajustador import optimize
+    params = dict(RA=4.5, simtime=0.9)
+    key = lambda **options: storage.SimulationCache.key(
+        optimize._cache_params(params, options), -5e-11)
+    assert key() == key(abort=None, trace_format={})
+    assert key() != key(abort=dict(max_spikes=100))
+    assert key(abort=dict(max_spikes=100)) != key(abort=dict(max_spikes=50))
+    assert (key(abort=dict(baseline=np.float64(-0.08))) ==
+            key(abort=dict(baseline=-0.08)))
+    assert key() != key(trace_format=dict(dtype='float32'))
+
+def test_manifest(tmpdir):
+    manifest = storage.Manifest(str(tmpdir))
+    manifest.add('tmp1', dict(RA=4.5), [-5e-11, np.float64(2e-10)], created=3)
+    manifest.add('tmp2', dict(RA=5.5), [-5e-11], created=1)
+    manifest.add('tmp3', dict(RA=6.5), [-5e-11], created=2)
+    manifest.set_fitness('tmp1', 0.5)
+    manifest.set_fitness('tmp3', 0.25)
+
+    assert storage.Manifest.exists(str(tmpdir))
+    assert len(manifest) == 3
+    assert manifest.names() == ['tmp2', 'tmp3', 'tmp1']
+    assert manifest.names(last=1) == ['tmp1']
+    assert manifest.top(1) == [('tmp3', 0.25)]
+    assert manifest.entry('tmp1') == (dict(RA=4.5), [-5e-11, 2e-10], 0.5)
+
+def test_result_archive(tmpdir):
+    archive = storage.ResultArchive(str(tmpdir))
+    archive.append('tmp1', dict(RA=4.5), [(-5e-11, np.arange(3.0)), (2e-10, np.ones(4))],
+                   aborted={2e-10: '0.3 spikes: 120 > 100'}, created=1)
+    archive.append('tmp2', dict(RA=5.5), [(-5e-11, np.zeros(2))], created=2)
+
+    # a record which is still being written is skipped
+    with open(archive.filename, 'ab') as f:
+        f.write(archive.HEADER.pack(archive.MAGIC, 100, 100) + b'partial')
+
+    entries = list(archive.entries())
+    assert [entry.name for entry in entries] == ['tmp1', 'tmp2']
+    assert entries[0].params == dict(RA=4.5)
+    assert entries[0].injections == [-5e-11, 2e-10]
+
+    (inj1, v1, ab1), (inj2, v2, ab2) = entries[0].traces()
+    np.testing.assert_array_equal(v1, np.arange(3.0))
+    np.testing.assert_array_equal(v2, np.ones(4))
+    assert ab1 is None and ab2 == '0.3 spikes: 120 > 100'
+
+def test_result_archive_after_crash(tmpdir):
+    archive = storage.ResultArchive(str(tmpdir))
+    archive.append('tmp1', dict(RA=4.5), [(-5e-11, np.arange(3.0))], created=1)
+    size = tmpdir.join(archive.FILENAME).size()
+    archive.append('tmp2', dict(RA=5.5), [(-5e-11, np.zeros(2))], created=2)
+
+    # the writer of tmp2 crashed half-way
+    with open(archive.filename, 'r+b') as f:
+        f.truncate(size + 30)
+    archive.append('tmp3', dict(RA=6.5), [(-5e-11, np.ones(2))], created=3)
+
+    entries = list(archive.entries())
+    assert [entry.name for entry in entries] == ['tmp1', 'tmp3']
+    (inj, voltage, aborted), = entries[1].traces()
+    np.testing.assert_array_equal(voltage, np.ones(2))
+
+def test_trace_formats(tmpdir):
+    t = np.linspace(0, 0.9, 9001)
+    voltage = -0.08 + 0.01 * np.sin(t * 50)
+    filename = str(tmpdir.join('ivdata-1e-10.npy'))
+
+    storage.save_trace(filename, voltage, 0.9)
+    loaded, dt = storage.load_trace(filename)
+    np.testing.assert_array_equal(loaded, voltage)
+    assert dt is None
+
+    storage.save_trace(filename, voltage, 0.9, encoding='delta-zlib')
+    loaded, dt = storage.load_trace(filename)
+    np.testing.assert_array_equal(loaded, voltage)
+    assert dt == 1e-4
+    assert os.path.getsize(filename) < voltage.nbytes
+
+    storage.save_trace(filename, voltage, 0.9, dtype='float32', dt=2e-4, encoding='delta-zlib')
+    loaded, dt = storage.load_trace(filename)
+    assert loaded.dtype == np.float32
+    np.testing.assert_array_equal(loaded, voltage[::2].astype(np.float32))
+    assert abs(dt - 2e-4) < 1e-12
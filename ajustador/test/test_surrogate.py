@@ -0,0 +1,15 @@
+import numpy as np
+
+from ajustador import surrogate
+
+def test_rbf_surrogate_ranking():
+    random = np.random.RandomState(0)
+    points = random.uniform(-2, 2, size=(60, 3))
+    values = (points**2).sum(axis=1)
+
+    model = surrogate.RBFSurrogate()
+    model.fit(points, values)
+    np.testing.assert_allclose(model.predict(points), values, atol=0.2)
+
+    test = np.array([[0, 0, 0], [1, 1, 0], [1.5, -1.5, 1.5]])
+    assert (np.argsort(model.predict(test)) == [0, 1, 2]).all()
@@ -61,7 +61,7 @@ def arange_values(values, func, order=None):
     n = values.shape[1]
     for x, y in zip(values, func):
         ind = [xs[i].flat == x[i] for i in range(n)]
-        ys[ind] = y
+        ys[tuple(ind)] = y
 
     return xs, ys
 
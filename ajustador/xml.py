@@ -66,7 +66,7 @@ def write_model(model, fname):
         out.write(etree.tostring(model))
 
 class NeurordResult(optimize.SimulationResult):
-    def __init__(self, filename, features=[],stim_time=None):
+    def __init__(self, filename, features=[],stim_time=None, params=None):
         # model.h5 is used if only a directory is specified, but a .h5 file with different name can be specified
 
         print('NeurordResults', filename)
@@ -84,7 +84,7 @@ class NeurordResult(optimize.SimulationResult):
                 filenames=glob.glob(filename+'*.h5')
                 print('NeurordResult, exp_set',exp_set, ', files', filenames)
 
-        super().__init__(dirname, features) #define some features here?  Such as norm, baseline, peak, peaktime?
+        super().__init__(dirname, features, params=params) #define some features here?  Such as norm, baseline, peak, peaktime?
 
         output=[nrd_output.Output(fname,stim_time) for fname in filenames]
         output.sort(key=operator.attrgetter('injection'))
@@ -159,16 +159,15 @@ class NeurordSimulation(optimize.Simulation):
             self._set_result(result)
 
     def _set_result(self, result):
-        tag = os.path.join(self.tmpdir.name, '.complete')
-        open(tag, 'w').close()
-        
         output=[nrd_output.Output(result[i],self.stim_time) for i in range(len(result))]
         output.sort(key=operator.attrgetter('injection'))
         self.output=np.array(output,dtype=object)
 
+        self._mark_complete([out.injection for out in output])
+
     @classmethod
-    def make(cls, *, dir, model, measurement, params):
-        return cls(dir=dir, model=model, params=params)
+    def make(cls, *, dir, model, measurement, params, **options):
+        return cls(dir=dir, model=model, params=params, **options)
 
 def execute(p):
     modelfile, outfile, num = p